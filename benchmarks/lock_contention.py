@@ -0,0 +1,100 @@
+"""
+Contention benchmark for the storage file lock.
+
+Runs N coroutines that repeatedly acquire the lock guarding one file, hold it
+briefly and release it, and compares the legacy O_EXCL/polling lock with the
+current ``AsyncFileLock``.
+
+    python benchmarks/lock_contention.py --workers 16 --rounds 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import aiofiles
+
+from williamtoolbox.storage.json_file import AsyncFileLock
+
+
+class LegacyAsyncFileLock:
+    """The original implementation: create ``<file>.lock`` with mode "x" and poll every 100 ms."""
+
+    def __init__(self, lock_file: str):
+        self.lock_file = Path(lock_file + ".lock")
+        self._lock_handle = None
+
+    async def acquire(self, timeout: int = 30):
+        start_time = asyncio.get_running_loop().time()
+        while True:
+            try:
+                self._lock_handle = await aiofiles.open(self.lock_file, mode="x")
+                break
+            except FileExistsError:
+                if asyncio.get_running_loop().time() - start_time > timeout:
+                    raise TimeoutError(f"Could not acquire lock within {timeout} seconds for {self.lock_file}")
+                await asyncio.sleep(0.1)
+
+    async def release(self):
+        if self._lock_handle:
+            await self._lock_handle.close()
+            self.lock_file.unlink()
+            self._lock_handle = None
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+async def run(lock_cls, path: str, workers: int, rounds: int, hold_ms: float):
+    waits = []
+
+    async def worker():
+        for _ in range(rounds):
+            lock = lock_cls(path)
+            start = time.perf_counter()
+            await lock.acquire(timeout=600)
+            waits.append(time.perf_counter() - start)
+            try:
+                await asyncio.sleep(hold_ms / 1000.0)
+            finally:
+                await lock.release()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    elapsed = time.perf_counter() - start
+    return elapsed, waits
+
+
+def report(name, elapsed, waits):
+    ops = len(waits)
+    print(
+        f"{name:<10} ops={ops:<6} total={elapsed:8.3f}s  throughput={ops / elapsed:9.1f} ops/s  "
+        f"wait mean={statistics.mean(waits) * 1000:8.2f}ms  "
+        f"p50={percentile(waits, 50) * 1000:8.2f}ms  p99={percentile(waits, 99) * 1000:8.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File lock contention benchmark")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent coroutines contending for the lock")
+    parser.add_argument("--rounds", type=int, default=50, help="Acquire/release cycles per worker")
+    parser.add_argument("--hold-ms", type=float, default=1.0, help="Time the lock is held per cycle (ms)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, lock_cls in (("legacy", LegacyAsyncFileLock), ("flock", AsyncFileLock)):
+            path = os.path.join(tmp, f"{name}.json")
+            elapsed, waits = asyncio.run(run(lock_cls, path, args.workers, args.rounds, args.hold_ms))
+            report(name, elapsed, waits)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Micro-benchmark for the JSON backends in ``williamtoolbox.storage.serialization``.
+
+Builds a chat history shaped like ``chat_data/<user>/chat.json`` (mixed
+Chinese/English messages) plus a stream of ``chat_events`` lines, and times
+encode/decode with every backend that is installed.
+
+    PYTHONPATH=src python benchmarks/serialization.py --conversations 50 --messages 40
+"""
+import argparse
+import importlib.util
+import random
+import time
+import uuid
+from datetime import datetime
+
+from williamtoolbox.storage import serialization
+
+SAMPLE_TEXT = [
+    "请帮我总结一下这篇文档的主要内容，并列出三个关键结论。",
+    "Here is a summary of the document with the key findings highlighted below.",
+    "```python\ndef add(a, b):\n    return a + b\n```",
+    "根据检索到的资料，Byzer-SQL 支持通过 RAG 服务进行知识库问答。",
+    "The model returned an error: context length exceeded, please retry.",
+]
+
+
+def build_chat_data(conversations: int, messages: int) -> dict:
+    rnd = random.Random(42)
+    now = datetime.now().isoformat()
+    return {
+        "conversations": [
+            {
+                "id": str(uuid.uuid4()),
+                "title": rnd.choice(SAMPLE_TEXT)[:20],
+                "created_at": now,
+                "updated_at": now,
+                "messages": [
+                    {
+                        "id": str(uuid.uuid4()),
+                        "role": "user" if i % 2 == 0 else "assistant",
+                        "content": " ".join(rnd.choice(SAMPLE_TEXT) for _ in range(rnd.randint(1, 8))),
+                        "timestamp": now,
+                    }
+                    for i in range(messages)
+                ],
+            }
+            for _ in range(conversations)
+        ]
+    }
+
+
+def build_events(count: int) -> list:
+    now = datetime.now().isoformat()
+    return [
+        {"index": i, "event": "chunk", "content": SAMPLE_TEXT[i % len(SAMPLE_TEXT)][:8], "timestamp": now}
+        for i in range(count)
+    ]
+
+
+def timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON backend micro-benchmark")
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    chat_data = build_chat_data(args.conversations, args.messages)
+    events = build_events(args.events)
+    size = len(serialization.dumps(chat_data).encode("utf-8"))
+    print(f"chat.json: {args.conversations} conversations x {args.messages} messages, {size / 1024:.0f} KiB")
+    print(f"event lines: {args.events}")
+    print(f"{'backend':<10}{'dumps ms':>12}{'loads ms':>12}{'events ms':>12}")
+
+    results = {}
+    for name in ["json", "orjson", "msgspec"]:
+        if name != "json" and importlib.util.find_spec(name) is None:
+            continue
+        serialization.set_backend(name)
+        text = serialization.dumps(chat_data)
+        assert serialization.loads(text) == chat_data
+        dumps_time = timeit(lambda: serialization.dumps(chat_data), args.repeat)
+        loads_time = timeit(lambda: serialization.loads(text), args.repeat)
+        events_time = timeit(
+            lambda: [serialization.loads(line) for line in [serialization.dumps(e) + "\n" for e in events]],
+            args.repeat,
+        )
+        results[name] = dumps_time + loads_time
+        print(f"{name:<10}{dumps_time * 1000:>12.2f}{loads_time * 1000:>12.2f}{events_time * 1000:>12.2f}")
+
+    for name, total in results.items():
+        if name != "json":
+            print(f"{name}: {results['json'] / total:.1f}x faster than stdlib json on chat.json round trips")
+    serialization.set_backend()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+Load test for ``williamtoolbox.storage.json_file``.
+
+Seeds a scratch directory with realistic data, then runs concurrent workers
+against the public storage functions and reports p50/p99 latency and
+throughput per operation, plus lock wait time (JSON backend only). Results
+are comparable across storage backends and serializers:
+
+    PYTHONPATH=src python benchmarks/storage_bench.py --backend json --serializer json
+    PYTHONPATH=src python benchmarks/storage_bench.py --backend sqlite --serializer orjson
+    PYTHONPATH=src python benchmarks/storage_bench.py --scenario chat --conversations 10000 --processes 4
+
+Scenarios:
+    registry  readers/writers on models.json and rags.json
+    chat      index listing, conversation reads and message appends for one
+              user with ``--conversations`` conversations
+    api_keys  verify_api_key on ``--api-keys`` keys, valid and unknown
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from williamtoolbox.storage import serialization
+from williamtoolbox.storage import json_file as storage
+
+SCENARIOS = ["registry", "chat", "api_keys"]
+CHAT_USER = "bench"
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.lock_waits: Dict[str, List[float]] = defaultdict(list)
+        self.elapsed = 0.0
+
+    async def timed(self, name: str, coro):
+        start = time.perf_counter()
+        result = await coro
+        self.latencies[name].append(time.perf_counter() - start)
+        return result
+
+    def on_lock_wait(self, lock_file: str, shared: bool, seconds: float):
+        self.lock_waits["shared" if shared else "exclusive"].append(seconds)
+
+    def merge(self, other: "Recorder"):
+        for name, values in other.latencies.items():
+            self.latencies[name].extend(values)
+        for name, values in other.lock_waits.items():
+            self.lock_waits[name].extend(values)
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+
+def configure(args, workdir: str):
+    os.chdir(workdir)
+    serialization.set_backend(args.serializer)
+    storage.configure_storage(args.backend, os.path.join(workdir, "bench.db"))
+
+
+# ---- seeding ---------------------------------------------------------------
+
+
+def model_entry(i: int) -> dict:
+    return {
+        "status": "stopped",
+        "deploy_command": {
+            "pretrained_model_type": "saas/openai",
+            "worker_concurrency": 1000,
+            "infer_params": {"saas.base_url": "https://api.example.com/v1", "saas.model": f"model-{i}"},
+            "model": f"model_{i}",
+        },
+        "undeploy_command": f"byzerllm undeploy --model model_{i} --force",
+    }
+
+
+def rag_entry(i: int) -> dict:
+    return {
+        "name": f"rag_{i}",
+        "model": "deepseek_chat",
+        "tokenizer_path": "/home/user/tokenizer.json",
+        "doc_dir": f"/home/user/docs/{i}",
+        "rag_doc_filter_relevance": 2.0,
+        "host": "0.0.0.0",
+        "port": 8000 + i,
+        "status": "stopped",
+    }
+
+
+def conversation(i: int, messages: int) -> dict:
+    now = datetime.now().isoformat()
+    return {
+        "id": f"conv-{i}",
+        "title": f"对话 {i}",
+        "created_at": now,
+        "updated_at": now,
+        "messages": [
+            {
+                "id": str(uuid.uuid4()),
+                "role": "user" if j % 2 == 0 else "assistant",
+                "content": "请总结这份文档的要点。Summarize the key points of this document. " * 4,
+                "timestamp": now,
+            }
+            for j in range(messages)
+        ],
+    }
+
+
+async def seed(args):
+    if "registry" in args.scenarios:
+        await storage.save_models_to_json({f"model_{i}": model_entry(i) for i in range(args.registry_size)})
+        await storage.save_rags_to_json({f"rag_{i}": rag_entry(i) for i in range(args.registry_size)})
+    if "chat" in args.scenarios:
+        batch = 200
+        for start in range(0, args.conversations, batch):
+            await asyncio.gather(
+                *(
+                    storage.save_conversation(CHAT_USER, conversation(i, args.messages))
+                    for i in range(start, min(start + batch, args.conversations))
+                )
+            )
+    if "api_keys" in args.scenarios:
+        expires_at = (datetime.now() + timedelta(days=30)).isoformat()
+        await storage.save_api_keys(
+            {
+                f"sk-{i:032x}": {
+                    "key": f"sk-{i:032x}",
+                    "name": f"key {i}",
+                    "description": None,
+                    "created_at": datetime.now().isoformat(),
+                    "expires_at": -1 if i % 10 == 0 else expires_at,
+                    "is_active": i % 7 != 0,
+                }
+                for i in range(args.api_keys)
+            }
+        )
+    await storage.flush_pending_writes()
+
+
+# ---- workloads -------------------------------------------------------------
+
+
+async def registry_worker(rec: Recorder, rnd: random.Random, args):
+    for _ in range(args.ops):
+        kind = rnd.random()
+        if kind < 0.4:
+            await rec.timed("load_models", storage.load_models_from_json())
+        elif kind < 0.6:
+            await rec.timed("snapshot_rags", storage.snapshot_rags())
+        elif kind < 0.8:
+            rags = await rec.timed("load_rags", storage.load_rags_from_json())
+            # status polling re-saves the registry even when nothing changed
+            await rec.timed("save_rags_unchanged", storage.save_rags_to_json(rags))
+        else:
+            models = await storage.load_models_from_json()
+            name = f"model_{rnd.randrange(args.registry_size)}"
+            models[name]["status"] = rnd.choice(["running", "stopped"])
+            await rec.timed("save_models", storage.save_models_to_json(models))
+
+
+async def chat_worker(rec: Recorder, rnd: random.Random, args):
+    for _ in range(args.ops):
+        kind = rnd.random()
+        conversation_id = f"conv-{rnd.randrange(args.conversations)}"
+        if kind < 0.2:
+            await rec.timed("load_chat_index", storage.load_chat_index(CHAT_USER))
+        elif kind < 0.6:
+            await rec.timed("load_conversation", storage.load_conversation(CHAT_USER, conversation_id))
+        else:
+            message = {
+                "id": str(uuid.uuid4()),
+                "role": "assistant",
+                "content": "这是一个新的回复。This is a new reply. " * 8,
+                "timestamp": datetime.now().isoformat(),
+            }
+            await rec.timed(
+                "append_message",
+                storage.append_conversation_messages(CHAT_USER, conversation_id, [message]),
+            )
+
+
+async def api_key_worker(rec: Recorder, rnd: random.Random, args):
+    for _ in range(args.ops):
+        if rnd.random() < 0.9:
+            key = f"sk-{rnd.randrange(args.api_keys):032x}"
+            await rec.timed("verify_api_key", storage.verify_api_key(key))
+        else:
+            await rec.timed("verify_unknown_key", storage.verify_api_key(f"sk-{uuid.uuid4().hex}"))
+
+
+WORKERS = {"registry": registry_worker, "chat": chat_worker, "api_keys": api_key_worker}
+
+
+async def run_workload(args, seed_offset: int) -> Recorder:
+    rec = Recorder()
+    storage.AsyncFileLock.on_wait = rec.on_lock_wait
+    tasks = []
+    for scenario in args.scenarios:
+        for i in range(args.workers):
+            rnd = random.Random(seed_offset * 10007 + i)
+            tasks.append(WORKERS[scenario](rec, rnd, args))
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    await storage.flush_pending_writes()
+    rec.elapsed = time.perf_counter() - start
+    storage.AsyncFileLock.on_wait = None
+    return rec
+
+
+def run_process(args, workdir: str, index: int) -> Recorder:
+    configure(args, workdir)
+    return asyncio.run(run_workload(args, index))
+
+
+# ---- reporting -------------------------------------------------------------
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def report(args, rec: Recorder) -> None:
+    print(
+        f"backend={args.backend} serializer={serialization.BACKEND} processes={args.processes} "
+        f"workers={args.workers} ops/worker={args.ops} elapsed={rec.elapsed:.2f}s"
+    )
+    header = f"{'operation':<22}{'count':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for name in sorted(rec.latencies):
+        values = rec.latencies[name]
+        print(
+            f"{name:<22}{len(values):>8}{len(values) / rec.elapsed:>10.0f}"
+            f"{percentile(values, 0.5) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}"
+            f"{max(values) * 1000:>10.2f}"
+        )
+    total = sum(len(values) for values in rec.latencies.values())
+    print(f"{'total':<22}{total:>8}{total / rec.elapsed:>10.0f}")
+
+    if rec.lock_waits:
+        print()
+        print(f"{'lock wait':<22}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for mode in sorted(rec.lock_waits):
+            values = rec.lock_waits[mode]
+            print(
+                f"{mode:<22}{len(values):>8}{sum(values):>10.2f}"
+                f"{percentile(values, 0.5) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}"
+                f"{max(values) * 1000:>10.2f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage layer load test")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--serializer", choices=["json", "orjson", "msgspec"], default=None,
+                        help="JSON backend (default: fastest installed)")
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument("--workers", type=int, default=32, help="concurrent coroutines per scenario and process")
+    parser.add_argument("--processes", type=int, default=1, help="processes sharing the same files, like uvicorn workers")
+    parser.add_argument("--ops", type=int, default=200, help="operations per worker")
+    parser.add_argument("--registry-size", type=int, default=50)
+    parser.add_argument("--conversations", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=20, help="messages per seeded conversation")
+    parser.add_argument("--api-keys", type=int, default=5000)
+    parser.add_argument("--workdir", default=None, help="scratch directory (default: a new temp dir)")
+    args = parser.parse_args()
+    args.scenarios = SCENARIOS if args.scenario == "all" else [args.scenario]
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="williamtoolbox-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    configure(args, workdir)
+
+    start = time.perf_counter()
+    asyncio.run(seed(args))
+    print(f"seeded {workdir} in {time.perf_counter() - start:.1f}s")
+
+    if args.processes == 1:
+        rec = asyncio.run(run_workload(args, 0))
+    else:
+        rec = Recorder()
+        # spawn：子进程在 run_process 中自行配置存储，不继承父进程的线程池和连接
+        with ProcessPoolExecutor(max_workers=args.processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(run_process, args, workdir, i) for i in range(args.processes)]
+            for future in futures:
+                rec.merge(future.result())
+    report(args, rec)
+
+
+if __name__ == "__main__":
+    main()
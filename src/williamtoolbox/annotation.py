@@ -10,10 +10,11 @@ from docx.opc.packuri import PackURI
 from docx import Document
 from pydantic import BaseModel
 import json
-from openai import AsyncOpenAI
 from loguru import logger
 from byzerllm.utils.client import code_utils
-from williamtoolbox.storage.json_file import load_config, load_models_from_json, load_rags_from_json
+from williamtoolbox.routing import routing_table
+from williamtoolbox.response_cache import cached_completion
+from williamtoolbox.storage import serialization
 from autocoder.rag.relevant_utils import FilterDoc
 
 
@@ -182,77 +183,39 @@ def query_rag(text: str):
     '''
 
 
-async def chat_with_model(model_name: str, messages: List[Dict[str, str]]) -> str:
-    """与指定模型进行聊天"""
+async def chat_with_model(model_name: str, messages: List[Dict[str, str]], use_cache: bool = True) -> str:
+    """与指定模型进行聊天，use_cache 为 False 时不使用响应缓存"""
     try:
-        # 加载配置
-        config = await load_config()
-        models = await load_models_from_json()
-        
-        if model_name not in models:
+        route = await routing_table.resolve("models", model_name)
+        if route is None:
             raise ValueError(f"Model {model_name} not found")
-            
-        model_info = models[model_name]
-        if model_info["status"] != "running":
+        if route.status != "running":
             raise ValueError(f"Model {model_name} is not running")
-            
-        # 获取OpenAI服务配置
-        openai_server = config.get("openaiServerList", [{}])[0]
-        host = openai_server.get("host", "localhost")
-        port = openai_server.get("port", 8000)
-        if host == "0.0.0.0":
-            host = "127.0.0.1"
-
-        base_url = f"http://{host}:{port}/v1"
-        client = AsyncOpenAI(base_url=base_url, api_key="xxxx")
 
         # 调用模型
-        response = await client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            stream=False,
-            max_tokens=4*1024
-        )
-        return response.choices[0].message.content
+        return await cached_completion(route, messages, use_cache=use_cache, max_tokens=4*1024)
         
     except Exception as e:
         logger.error(f"Error in chat_with_model: {str(e)}")
         raise
 
-async def chat_with_rag(rag_name: str, messages: List[Dict[str, str]]) -> str:
-    """与指定RAG进行聊天"""
+async def chat_with_rag(rag_name: str, messages: List[Dict[str, str]], use_cache: bool = True) -> str:
+    """与指定RAG进行聊天，use_cache 为 False 时不使用响应缓存"""
     try:
-        rags = await load_rags_from_json()
-        
-        if rag_name not in rags:
+        route = await routing_table.resolve("rags", rag_name)
+        if route is None:
             raise ValueError(f"RAG {rag_name} not found")
-            
-        rag_info = rags[rag_name]
-        if rag_info["status"] != "running":
+        if route.status != "running":
             raise ValueError(f"RAG {rag_name} is not running")
-            
-        host = rag_info.get("host", "localhost")
-        port = rag_info.get("port", 8000)
-        if host == "0.0.0.0":
-            host = "127.0.0.1"
-
-        base_url = f"http://{host}:{port}/v1"
-        client = AsyncOpenAI(base_url=base_url, api_key="xxxx")
 
         # 调用RAG
-        response = await client.chat.completions.create(
-            model=rag_info.get("model", "deepseek_chat"),
-            messages=messages,
-            stream=False,
-            max_tokens=4*1024
-        )
-        return response.choices[0].message.content
+        return await cached_completion(route, messages, use_cache=use_cache, max_tokens=4*1024)
         
     except Exception as e:
         logger.error(f"Error in chat_with_rag: {str(e)}")
         raise
 
-async def auto_generate_annotations(rag_name: str, doc: str, model_name: str = "default_model") -> DocText:
+async def auto_generate_annotations(rag_name: str, doc: str, model_name: str = "default_model", use_cache: bool = True) -> DocText:
     # 使用 chat_with_rag 替换 query_rag
     logger.info(f"开始处理文档，文档长度: {len(doc)}")
     
@@ -267,7 +230,7 @@ async def auto_generate_annotations(rag_name: str, doc: str, model_name: str = "
     
     rag_response = await chat_with_rag(rag_name, [
         {"role": "user", "content": final_query}
-    ])
+    ], use_cache=use_cache)
     logger.info(f"RAG 返回结果:\n{rag_response}")
     docs: List[FilterDoc] = [FilterDoc(**doc) for doc in json.loads(rag_response)]    
     
@@ -283,7 +246,7 @@ async def auto_generate_annotations(rag_name: str, doc: str, model_name: str = "
                 file_path = file_path[:file_path.index("#chunk")]
 
             with open(file_path, 'r', encoding='utf-8') as file:
-                v = json.loads(file.read())
+                v = serialization.loads(file.read())
             doc_text = DocText(doc_name=file_path, doc_text=v["doc_text"], annotations=[Annotation(**a) for a in v["annotations"]])
             examples.append(doc_text)
             logger.info(f'成功加载示例文档 {file_path}, 包含 {len(doc_text.annotations)} 条注释')
@@ -298,7 +261,7 @@ async def auto_generate_annotations(rag_name: str, doc: str, model_name: str = "
     
     model_response = await chat_with_model(model_name, [
         {"role": "user", "content": annotation_prompt}
-    ])
+    ], use_cache=use_cache)
     logger.info(f"模型生成注释响应:\n{model_response}")
     
     # 4. 提取注释
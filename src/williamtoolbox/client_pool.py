@@ -0,0 +1,147 @@
+"""Shared ``AsyncOpenAI`` clients, keyed by ``(base_url, api_key)`` and leased per request."""
+import asyncio
+import importlib.util
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Tuple
+
+import httpx
+from loguru import logger
+from openai import AsyncOpenAI
+
+from .storage.json_file import registry_cache
+
+# 安装了 h2 时启用 HTTP/2
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+CLIENT_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=120)
+# 流式回答可能持续很久，读超时沿用 openai 默认的 600 秒
+CLIENT_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+# 这些 registry 变化时，连接目标可能已变，废弃所有池化客户端
+WATCHED_REGISTRIES = frozenset({"models", "rags", "super_analysis", "config"})
+
+
+class _PooledClient:
+    __slots__ = ("key", "client", "refs", "retired")
+
+    def __init__(self, key: Tuple[str, str], client: AsyncOpenAI):
+        self.key = key
+        self.client = client
+        self.refs = 0
+        self.retired = False
+
+
+class ClientLease:
+    """Clients borrowed by one request; ``release()`` returns them all."""
+
+    def __init__(self, pool: "OpenAIClientPool"):
+        self._pool = pool
+        self._clients: List[_PooledClient] = []
+        self._streams: List[Any] = []
+
+    def get(self, base_url: str, api_key: str) -> AsyncOpenAI:
+        pooled = self._pool._acquire(base_url, api_key)
+        self._clients.append(pooled)
+        return pooled.client
+
+    def track(self, stream):
+        """Register a streamed response; ``release()`` closes it if it is still open."""
+        self._streams.append(stream)
+        return stream
+
+    def untrack(self, stream) -> None:
+        """Forget a stream that has been read to the end."""
+        try:
+            self._streams.remove(stream)
+        except ValueError:
+            pass
+
+    def release(self) -> None:
+        streams, self._streams = self._streams, []
+        for stream in streams:
+            response = getattr(stream, "response", None)
+            if response is None or not response.is_closed:
+                # 被取消的请求不会读完响应，主动关闭以释放上游连接
+                self._pool._close_later(stream.close())
+        clients, self._clients = self._clients, []
+        for pooled in clients:
+            self._pool._release(pooled)
+
+
+class OpenAIClientPool:
+    def __init__(self):
+        self._clients: Dict[Tuple[str, str], _PooledClient] = {}
+        self._closing: List[asyncio.Future] = []
+
+    def _new_client(self, base_url: str, api_key: str) -> AsyncOpenAI:
+        http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE and base_url.startswith("https://"),
+            limits=CLIENT_LIMITS,
+            timeout=CLIENT_TIMEOUT,
+        )
+        return AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+
+    def _acquire(self, base_url: str, api_key: str) -> _PooledClient:
+        key = (base_url, api_key)
+        pooled = self._clients.get(key)
+        if pooled is None:
+            pooled = self._clients[key] = _PooledClient(key, self._new_client(*key))
+        pooled.refs += 1
+        return pooled
+
+    def _release(self, pooled: _PooledClient) -> None:
+        pooled.refs -= 1
+        if pooled.retired and pooled.refs == 0:
+            self._close_client(pooled)
+
+    def _close_client(self, pooled: _PooledClient) -> None:
+        self._close_later(pooled.client.close())
+
+    def _close_later(self, coro) -> None:
+        try:
+            future = asyncio.ensure_future(coro)
+        except RuntimeError:
+            # 没有运行中的事件循环（如进程退出时），交给 GC
+            coro.close()
+            return
+        self._closing.append(future)
+        future.add_done_callback(self._closing.remove)
+
+    def lease(self) -> ClientLease:
+        return ClientLease(self)
+
+    @asynccontextmanager
+    async def client(self, base_url: str, api_key: str):
+        """``async with pool.client(base_url, api_key) as client:`` for one-off calls."""
+        lease = self.lease()
+        try:
+            yield lease.get(base_url, api_key)
+        finally:
+            lease.release()
+
+    def retire_all(self) -> None:
+        """Stop handing out the current clients; each closes once its last lease ends."""
+        clients, self._clients = list(self._clients.values()), {}
+        for pooled in clients:
+            pooled.retired = True
+            if pooled.refs == 0:
+                self._close_client(pooled)
+        if clients:
+            logger.info(f"Retired {len(clients)} pooled OpenAI clients")
+
+    async def close(self) -> None:
+        """Retire everything and wait for idle clients to close; call on shutdown."""
+        self.retire_all()
+        if self._closing:
+            await asyncio.gather(*list(self._closing), return_exceptions=True)
+
+
+openai_client_pool = OpenAIClientPool()
+
+
+def _on_registry_change(name: str) -> None:
+    if name in WATCHED_REGISTRIES:
+        openai_client_pool.retire_all()
+
+
+registry_cache.add_listener(_on_registry_change)
@@ -0,0 +1,246 @@
+"""Token-aware context window for outgoing chat requests, with rolling summaries of older turns."""
+import re
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from .client_pool import openai_client_pool
+from .routing import routing_table
+from .storage.json_file import fill_message_fields, snapshot_config, update_conversation_fields
+
+_encoding = None
+_encoding_loaded = False
+
+# 每条消息的角色、分隔符等固定开销
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_MAX_TOKENS = 1024
+SUMMARY_PROMPT = (
+    "请用简洁的语言总结下面这段对话，保留后续对话需要用到的事实、约定、结论和未解决的问题。"
+    "只输出摘要本身。\n\n"
+)
+
+# 中日韩字符大约一个字一个 token，其余文本大约四个字符一个 token
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def _get_encoding():
+    # 首次使用时才加载：get_encoding 可能需要联网下载编码文件，离线时退回估算
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:  # ImportError, or the encoding could not be loaded
+            logger.info(f"tiktoken unavailable, estimating token counts: {e}")
+    return _encoding
+
+
+def token_counter() -> str:
+    """Name of the counter in use, stored with cached counts."""
+    return "tiktoken:cl100k_base" if _get_encoding() is not None else "estimate"
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    """Token count of ``message``, computed once and cached on the message."""
+    counter = token_counter()
+    if message.get("token_counter") != counter or "token_count" not in message:
+        message["token_count"] = count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+        message["token_counter"] = counter
+    return message["token_count"]
+
+
+def reuse_token_counts(messages: List[Dict[str, Any]], stored: List[Dict[str, Any]]) -> None:
+    """Copy cached counts from ``stored`` messages with the same id and content (full-history requests)."""
+    counter = token_counter()
+    known = {msg["id"]: msg for msg in stored if msg.get("token_counter") == counter}
+    for message in messages:
+        previous = known.get(message.get("id"))
+        if previous is not None and previous.get("content") == message.get("content"):
+            message["token_count"] = previous["token_count"]
+            message["token_counter"] = counter
+
+
+class ContextWindow:
+    """The prompt for one request and what it left out."""
+
+    def __init__(
+        self,
+        messages: List[Dict[str, str]],
+        summarize_until: Optional[int],
+        counted: List[Dict[str, Any]],
+        prompt_tokens: int,
+    ):
+        self.messages = messages
+        # index of the last message a refreshed summary should cover, if the cached one is missing or stale
+        self.summarize_until = summarize_until
+        # stored messages that had no cached count yet
+        self.counted = counted
+        # estimated token count of ``messages``, from the cached per-message counts
+        self.prompt_tokens = prompt_tokens
+
+
+def _tail_start(counts: List[int], budget: int, floor: int = 0) -> int:
+    """Earliest index >= ``floor`` whose suffix fits ``budget``; always keeps the last message."""
+    total = 0
+    start = len(counts)
+    while start > floor and (start == len(counts) or total + counts[start - 1] <= budget):
+        total += counts[start - 1]
+        start -= 1
+    return start
+
+
+def _turn_start(messages: List[Dict[str, Any]], start: int) -> int:
+    """First user message at or after ``start`` (the last message if there is none)."""
+    while start < len(messages) - 1 and messages[start]["role"] != "user":
+        start += 1
+    return start
+
+
+def _pinned(messages: List[Dict[str, Any]]) -> int:
+    """Number of leading messages that are never dropped: a system prompt, if any."""
+    return 1 if messages and messages[0]["role"] == "system" else 0
+
+
+def _summary_message(summary: Dict[str, Any]) -> Dict[str, str]:
+    return {"role": "system", "content": f"以下是之前对话的摘要：\n{summary['content']}"}
+
+
+def build_window(conversation: Dict[str, Any], budget: int) -> ContextWindow:
+    """Select the messages of ``conversation`` to send under a ``budget`` of prompt tokens."""
+    messages = conversation.get("messages", [])
+    counter = token_counter()
+    counted = [msg for msg in messages if msg.get("token_counter") != counter or "token_count" not in msg]
+    counts = [message_tokens(msg) for msg in messages]
+    prompt = lambda selected: [{"role": msg["role"], "content": msg["content"]} for msg in selected]
+
+    if budget <= 0:
+        return ContextWindow(prompt(messages), None, counted, sum(counts))
+
+    # 开头的 system 消息总是发送，其余消息分享剩下的预算
+    pinned = _pinned(messages)
+    head = prompt(messages[:pinned])
+    budget -= sum(counts[:pinned])
+    # 截断后从用户消息开始，不以孤立的助手回复开头
+    start = _turn_start(messages, _tail_start(counts, budget, floor=pinned))
+    if start == pinned:
+        return ContextWindow(prompt(messages), None, counted, sum(counts))
+
+    summary = conversation.get("context_summary")
+    covered = -1
+    if summary:
+        covered = next((i for i, msg in enumerate(messages) if msg["id"] == summary.get("until")), -1)
+    if covered >= pinned and summary.get("token_count", 0) + counts[-1] <= budget:
+        with_summary = _turn_start(
+            messages, _tail_start(counts, budget - summary["token_count"], floor=covered + 1)
+        )
+        selected = head + [_summary_message(summary)] + prompt(messages[with_summary:])
+        tokens = sum(counts[:pinned]) + summary["token_count"] + sum(counts[with_summary:])
+        if with_summary == covered + 1:
+            return ContextWindow(selected, None, counted, tokens)
+    else:
+        selected = head + prompt(messages[start:])
+        tokens = sum(counts[:pinned]) + sum(counts[start:])
+
+    # 摘要缺失或已落后：让新摘要覆盖到只剩一半预算的位置，避免每轮都重新生成
+    until = _turn_start(messages, _tail_start(counts, budget // 2, floor=pinned)) - 1
+    return ContextWindow(selected, until if until >= pinned else None, counted, tokens)
+
+
+async def store_token_counts(username: str, conversation_id: str, window: ContextWindow) -> None:
+    """Save the counts ``build_window`` computed for stored messages that had none."""
+    if not window.counted:
+        return
+    try:
+        await fill_message_fields(
+            username,
+            conversation_id,
+            {
+                msg["id"]: {"token_count": msg["token_count"], "token_counter": msg["token_counter"]}
+                for msg in window.counted
+            },
+        )
+    except Exception as e:
+        logger.warning(f"Failed to store token counts of conversation {conversation_id}: {e}")
+
+
+# 正在后台生成摘要的会话，同一会话同时只生成一次
+_refreshing: Dict[str, asyncio.Task] = {}
+
+
+async def _refresh_summary(username: str, conversation: Dict[str, Any], until: int, model_name: str) -> None:
+    route = await routing_table.resolve("models", model_name)
+    if route is None or route.status != "running":
+        logger.warning(f"Summary model {model_name} is not available")
+        return
+    messages = conversation["messages"]
+    summary = conversation.get("context_summary")
+    # system 消息总是单独发送，不计入摘要
+    first = _pinned(messages)
+    parts = []
+    if summary:
+        covered = next((i for i, msg in enumerate(messages) if msg["id"] == summary.get("until")), -1)
+        if covered >= first:
+            first = covered + 1
+            parts.append(f"之前的摘要：\n{summary['content']}\n")
+    if first > until:
+        return
+    for msg in messages[first:until + 1]:
+        parts.append(f"{msg['role']}: {msg['content']}")
+
+    async with openai_client_pool.client(route.base_url, route.api_key) as client:
+        response = await client.chat.completions.create(
+            model=route.model,
+            messages=[{"role": "user", "content": SUMMARY_PROMPT + "\n\n".join(parts)}],
+            stream=False,
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+    content = response.choices[0].message.content or ""
+    await update_conversation_fields(
+        username,
+        conversation["id"],
+        {
+            "context_summary": {
+                "until": messages[until]["id"],
+                "content": content,
+                "token_count": count_tokens(content) + MESSAGE_OVERHEAD_TOKENS,
+                "token_counter": token_counter(),
+            }
+        },
+        bump_version=False,
+    )
+
+
+async def _run_refresh(username: str, conversation: Dict[str, Any], until: int, model_name: str) -> None:
+    key = f"{username}/{conversation['id']}"
+    try:
+        await _refresh_summary(username, conversation, until, model_name)
+    except Exception as e:
+        logger.warning(f"Failed to summarize conversation {conversation['id']}: {e}")
+    finally:
+        _refreshing.pop(key, None)
+
+
+async def schedule_summary(username: str, conversation: Dict[str, Any], window: ContextWindow) -> None:
+    """Refresh the rolling summary in the background if ``window`` had to drop unsummarized turns."""
+    if window.summarize_until is None or window.summarize_until < 0:
+        return
+    model_name = ((await snapshot_config()).get("chatContext") or {}).get("summaryModel")
+    key = f"{username}/{conversation['id']}"
+    if not model_name or key in _refreshing:
+        return
+    _refreshing[key] = asyncio.ensure_future(
+        _run_refresh(username, conversation, window.summarize_until, model_name)
+    )
@@ -0,0 +1,268 @@
+"""Cache for non-streaming completions (``/chat/ask`` and the annotation helpers), off by default."""
+import os
+import time
+import hashlib
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiofiles
+from loguru import logger
+
+from .client_pool import openai_client_pool
+from .routing import Route
+from .storage import serialization
+
+# off | memory | disk（内存 + 磁盘）
+RESPONSE_CACHE_MODE = os.environ.get("WILLIAM_TOOLBOX_RESPONSE_CACHE", "off").lower()
+RESPONSE_CACHE_TTL = float(os.environ.get("WILLIAM_TOOLBOX_RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("WILLIAM_TOOLBOX_RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_DISK_SIZE = int(os.environ.get("WILLIAM_TOOLBOX_RESPONSE_CACHE_DISK_SIZE", "10000"))
+RESPONSE_CACHE_DIR = "response_cache"
+
+
+def _normalize(messages: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+    return [
+        (msg["role"].strip(), (msg.get("content") or "").replace("\r\n", "\n").strip())
+        for msg in messages
+    ]
+
+
+def cache_key(route: Route, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+    document = [
+        route.list_type,
+        route.name,
+        route.base_url,
+        route.model,
+        _normalize(messages),
+        sorted(params.items()),
+    ]
+    return hashlib.sha256(serialization.dumps(document).encode("utf-8")).hexdigest()
+
+
+# 以下磁盘操作在线程中执行，不阻塞事件循环
+def _write_entry(path: str, content: str) -> bool:
+    """Write one entry atomically; returns whether it already existed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    existed = os.path.exists(path)
+    # 先写临时文件再替换，其他进程不会读到写了一半的条目
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return existed
+
+
+def _disk_files() -> List[os.DirEntry]:
+    files = []
+    if not os.path.isdir(RESPONSE_CACHE_DIR):
+        return files
+    for shard in os.scandir(RESPONSE_CACHE_DIR):
+        if shard.is_dir():
+            files.extend(entry for entry in os.scandir(shard.path) if entry.name.endswith(".json"))
+    return files
+
+
+def _mtime(entry: os.DirEntry) -> float:
+    try:
+        return entry.stat().st_mtime
+    except OSError:
+        # 已被其他进程删除
+        return 0.0
+
+
+def _evict_oldest(keep: int) -> Tuple[int, int]:
+    """Delete the least recently written entries beyond ``keep``; returns ``(remaining, removed)``."""
+    files = _disk_files()
+    if len(files) <= keep:
+        return len(files), 0
+    files.sort(key=_mtime)
+    removed = 0
+    for entry in files[:len(files) - keep]:
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return len(files) - removed, removed
+
+
+class ResponseCache:
+    def __init__(self, mode: str = RESPONSE_CACHE_MODE):
+        self.mode = mode
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._disk_count: Optional[int] = None
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "shared": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "expired": 0,
+            "evicted": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("memory", "disk")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(RESPONSE_CACHE_DIR, key[:2], f"{key}.json")
+
+    async def _lookup(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return entry[1]
+            del self._entries[key]
+            self._stats["expired"] += 1
+        if self.mode != "disk":
+            return None
+        path = self._path(key)
+        try:
+            async with aiofiles.open(path, "r", encoding="utf-8") as f:
+                document = serialization.loads(await f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable response cache entry {path}: {e}")
+            return None
+        if document["expires_at"] <= now:
+            self._stats["expired"] += 1
+            await self._remove_file(path)
+            return None
+        self._stats["disk_hits"] += 1
+        self._remember(key, document["expires_at"], document["response"])
+        return document["response"]
+
+    def _remember(self, key: str, expires_at: float, response: str) -> None:
+        self._entries[key] = (expires_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > RESPONSE_CACHE_SIZE:
+            self._entries.popitem(last=False)
+            self._stats["evicted"] += 1
+
+    async def _store(self, key: str, response: str) -> None:
+        expires_at = time.time() + RESPONSE_CACHE_TTL
+        self._remember(key, expires_at, response)
+        if self.mode != "disk":
+            return
+        path = self._path(key)
+        content = serialization.dumps({"expires_at": expires_at, "response": response})
+        try:
+            existed = await asyncio.to_thread(_write_entry, path, content)
+        except Exception as e:
+            logger.warning(f"Failed to write response cache entry {path}: {e}")
+            return
+        if not existed:
+            await self._count_disk_entry()
+
+    async def _remove_file(self, path: str) -> None:
+        try:
+            await asyncio.to_thread(os.remove, path)
+        except OSError:
+            return
+        if self._disk_count is not None:
+            self._disk_count -= 1
+
+    async def _count_disk_entry(self) -> None:
+        if self._disk_count is None:
+            self._disk_count = len(await asyncio.to_thread(_disk_files))
+        else:
+            self._disk_count += 1
+        if self._disk_count <= RESPONSE_CACHE_DISK_SIZE:
+            return
+        # 超出上限时删除最久未写入的条目，一次删到上限的 90%，避免每次写入都扫描目录
+        remaining, evicted = await asyncio.to_thread(_evict_oldest, int(RESPONSE_CACHE_DISK_SIZE * 0.9))
+        self._stats["evicted"] += evicted
+        self._disk_count = remaining
+
+    async def get_or_call(self, key: str, call, use_cache: bool = True) -> str:
+        """Return the cached response for ``key``, or await ``call()`` and cache its result."""
+        if not self.enabled or not use_cache:
+            self._stats["bypassed"] += 1
+            return await call()
+        response = await self._lookup(key)
+        if response is not None:
+            return response
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._stats["shared"] += 1
+            await asyncio.wait([inflight])
+            if inflight.cancelled():
+                # 发起请求的一方被取消了，由当前调用方重新请求
+                return await self.get_or_call(key, call, use_cache)
+            return inflight.result()
+
+        self._stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        else:
+            future.set_result(response)
+            if response is not None:
+                await self._store(key, response)
+            return response
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "ttl": RESPONSE_CACHE_TTL,
+            "entries": len(self._entries),
+            "max_entries": RESPONSE_CACHE_SIZE,
+            "disk_entries": self._disk_count,
+            **self._stats,
+        }
+
+    async def clear(self) -> int:
+        """Drop every entry (memory and disk); returns how many were removed."""
+        removed = len(self._entries)
+        self._entries.clear()
+        if self.mode == "disk":
+            remaining, evicted = await asyncio.to_thread(_evict_oldest, 0)
+            removed += evicted
+            self._disk_count = remaining
+        return removed
+
+
+response_cache = ResponseCache()
+
+
+async def cached_completion(
+    route: Route,
+    messages: List[Dict[str, Any]],
+    use_cache: bool = True,
+    **params: Any,
+) -> str:
+    """
+    Non-streaming chat completion to ``route`` with sampling ``params``
+    (max_tokens, temperature, ...), answered from the response cache when an
+    identical call was made within the TTL.
+    """
+
+    async def call() -> Optional[str]:
+        async with openai_client_pool.client(route.base_url, route.api_key) as client:
+            response = await client.chat.completions.create(
+                model=route.model,
+                messages=messages,
+                stream=False,
+                **params,
+            )
+        return response.choices[0].message.content
+
+    return await response_cache.get_or_call(cache_key(route, messages, params), call, use_cache)
@@ -0,0 +1,183 @@
+"""Routing table for chat requests: ``(list_type, name)`` to the endpoint, credentials and model of the target."""
+import asyncio
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+from .storage.json_file import (
+    registry_cache,
+    snapshot_config,
+    snapshot_models,
+    snapshot_rags,
+    snapshot_super_analysis,
+)
+
+# 检查 registry 是否变化的最短间隔（秒）；本进程的保存会立即失效路由表，其他进程的修改在下次检查时生效
+ROUTING_RECHECK_INTERVAL = 1.0
+
+# 本地 byzerllm/RAG 服务不校验 key
+LOCAL_API_KEY = "xxxx"
+
+DEFAULT_MAX_TOKENS = {"models": 4096, "rags": 8096, "super-analysis": 8096}
+
+SOURCE_REGISTRIES = frozenset({"models", "rags", "super_analysis", "config"})
+
+
+class Route(NamedTuple):
+    list_type: str
+    name: str
+    base_url: str
+    api_key: str
+    model: str
+    max_tokens: int
+    status: str
+    # RAG only: the service streams its reasoning as separate events
+    deep_thought: bool = False
+    # admission limits (see server/admission.py); 0 = unlimited / no queue
+    max_concurrency: int = 0
+    max_queue: int = 0
+    # RAG only: the deep-thought event endpoint supports long-poll ("wait" seconds)
+    deep_thought_long_poll: bool = False
+    # prompt budget in tokens (see context_window.py); 0 = unlimited
+    max_context_tokens: int = 0
+    # telemetry tags (see server/telemetry.py); prices are per million tokens
+    product_type: str = ""
+    input_price: float = 0.0
+    output_price: float = 0.0
+    # ask the backend for token usage in the stream (stream_options.include_usage)
+    include_usage: bool = False
+
+
+def _local_base_url(info) -> str:
+    host = info.get("host", "localhost")
+    port = info.get("port", 8000)
+    if host == "0.0.0.0":
+        host = "127.0.0.1"
+    return f"http://{host}:{port}/v1"
+
+
+def _is_true(value) -> bool:
+    return value in ["True", "true", True]
+
+
+def _limits(config, list_type: str, info) -> Tuple[int, int]:
+    """Admission limits of one entry: its own fields, else the config.json defaults for its list."""
+    defaults = (config.get("chatAdmission") or {}).get(list_type) or {}
+    max_concurrency = info.get("max_concurrency")
+    if max_concurrency is None:
+        max_concurrency = defaults.get("maxConcurrency", 0)
+    max_queue = info.get("max_queue")
+    if max_queue is None:
+        max_queue = defaults.get("maxQueue", 0)
+    return int(max_concurrency), int(max_queue)
+
+
+def _context_tokens(config, list_type: str, info) -> int:
+    """Prompt budget of one entry: its own ``max_context_tokens``, else the config.json default for its list."""
+    value = info.get("max_context_tokens")
+    if value is None:
+        defaults = (config.get("chatContext") or {}).get(list_type) or {}
+        value = defaults.get("maxContextTokens", 0)
+    return int(value)
+
+
+def _build_routes(config, models, rags, super_analyses) -> Dict[Tuple[str, str], Route]:
+    routes: Dict[Tuple[str, str], Route] = {}
+
+    openai_servers = config.get("openaiServerList") or [{}]
+    pro_base_url = _local_base_url(openai_servers[0])
+    for name, info in models.items():
+        if info.get("product_type", "pro") == "lite":
+            infer_params = (info.get("deploy_command") or {}).get("infer_params")
+            if not infer_params:
+                # 单个配置不完整的模型不应导致整个路由表构建失败
+                logger.warning(f"Skipping lite model {name}: deploy_command.infer_params is missing")
+                continue
+            base_url = infer_params.get("saas.base_url", "")
+            api_key = infer_params.get("saas.api_key", "")
+            model = infer_params.get("saas.model", "")
+        else:
+            base_url, api_key, model = pro_base_url, LOCAL_API_KEY, name
+        routes[("models", name)] = Route(
+            "models", name, base_url, api_key, model,
+            DEFAULT_MAX_TOKENS["models"], info.get("status", "stopped"),
+            False, *_limits(config, "models", info),
+            max_context_tokens=_context_tokens(config, "models", info),
+            product_type=info.get("product_type", "pro"),
+            input_price=float(info.get("input_price") or 0.0),
+            output_price=float(info.get("output_price") or 0.0),
+            include_usage=_is_true(info.get("include_usage", False)),
+        )
+
+    for name, info in rags.items():
+        routes[("rags", name)] = Route(
+            "rags", name, _local_base_url(info), LOCAL_API_KEY,
+            info.get("model", "deepseek_chat"), DEFAULT_MAX_TOKENS["rags"],
+            info.get("status", "stopped"), _is_true(info.get("inference_deep_thought", "False")),
+            *_limits(config, "rags", info),
+            deep_thought_long_poll=_is_true(info.get("deep_thought_long_poll", False)),
+            max_context_tokens=_context_tokens(config, "rags", info),
+            product_type=info.get("product_type", "lite"),
+            include_usage=_is_true(info.get("include_usage", False)),
+        )
+
+    for name, info in super_analyses.items():
+        routes[("super-analysis", name)] = Route(
+            "super-analysis", name, _local_base_url(info), LOCAL_API_KEY,
+            info.get("served_model_name", "default"), DEFAULT_MAX_TOKENS["super-analysis"],
+            info.get("status", "stopped"), False, *_limits(config, "super-analysis", info),
+            max_context_tokens=_context_tokens(config, "super-analysis", info),
+            product_type=info.get("product_type", ""),
+            include_usage=_is_true(info.get("include_usage", False)),
+        )
+    return routes
+
+
+class RoutingTable:
+    def __init__(self):
+        self._sources: Optional[tuple] = None
+        self._routes: Dict[Tuple[str, str], Route] = {}
+        self._checked_at = float("-inf")
+
+    def invalidate(self) -> None:
+        self._checked_at = float("-inf")
+
+    async def _routes_now(self) -> Dict[Tuple[str, str], Route]:
+        if time.monotonic() - self._checked_at > ROUTING_RECHECK_INTERVAL:
+            await self._refresh()
+        return self._routes
+
+    async def _refresh(self) -> None:
+        sources = tuple(
+            await asyncio.gather(
+                snapshot_config(), snapshot_models(), snapshot_rags(), snapshot_super_analysis()
+            )
+        )
+        self._checked_at = time.monotonic()
+        # 快照在 registry 未变化时是同一个对象
+        if self._sources is None or any(a is not b for a, b in zip(sources, self._sources)):
+            self._routes = _build_routes(*sources)
+            self._sources = sources
+
+    async def resolve(self, list_type: str, name: str) -> Optional[Route]:
+        """The route for ``name`` in ``list_type`` (models/rags/super-analysis), or None."""
+        return (await self._routes_now()).get((list_type, name))
+
+    async def first_running(self, list_type: str) -> Optional[Route]:
+        """The first running entry of ``list_type``, in registry order."""
+        for (route_type, _), route in (await self._routes_now()).items():
+            if route_type == list_type and route.status == "running":
+                return route
+        return None
+
+
+routing_table = RoutingTable()
+
+
+def _on_registry_change(name: str) -> None:
+    if name in SOURCE_REGISTRIES:
+        routing_table.invalidate()
+
+
+registry_cache.add_listener(_on_registry_change)
@@ -0,0 +1,146 @@
+"""Per-target admission control for chat and search streams: a concurrency limit plus a bounded FIFO queue."""
+import math
+import time
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from ..routing import Route, routing_table
+
+# 还没有完成过请求时，估算 Retry-After 用的平均耗时（秒）
+DEFAULT_SERVICE_TIME = 10.0
+# 平均耗时的指数加权系数
+SERVICE_TIME_WEIGHT = 0.2
+
+
+class QueueFull(Exception):
+    def __init__(self, target: str, retry_after: int):
+        super().__init__(f"Too many requests for {target}, retry after {retry_after}s")
+        self.target = target
+        self.retry_after = retry_after
+
+    def to_http(self) -> HTTPException:
+        return HTTPException(
+            status_code=429, detail=str(self), headers={"Retry-After": str(self.retry_after)}
+        )
+
+
+class Ticket:
+    """A reserved place at one gate; ``release()`` is idempotent."""
+
+    def __init__(self, gate: Optional["_Gate"]):
+        self._gate = gate
+        self._granted: Optional[asyncio.Future] = None
+        self._started_at: Optional[float] = None
+        self._released = False
+
+    @property
+    def position(self) -> Optional[int]:
+        """Place in the queue (1 = next), or None once admitted or released."""
+        if self._granted is None or self._granted.done():
+            return None
+        try:
+            return self._gate.waiters.index(self) + 1
+        except ValueError:
+            return None
+
+    async def wait(self) -> None:
+        """Wait for a free slot."""
+        if self._granted is not None:
+            await self._granted
+
+    def release(self) -> None:
+        if self._released or self._gate is None:
+            return
+        self._released = True
+        self._gate.leave(self)
+
+
+class _Gate:
+    def __init__(self, name: str):
+        self.name = name
+        self.max_concurrency = 0
+        self.max_queue = 0
+        self.active = 0
+        self.waiters: Deque[Ticket] = deque()
+        self.service_time = DEFAULT_SERVICE_TIME
+
+    def retry_after(self) -> int:
+        slots = max(self.max_concurrency, 1)
+        return max(1, math.ceil(self.service_time * (len(self.waiters) + 1) / slots))
+
+    def enter(self) -> Ticket:
+        ticket = Ticket(self)
+        if self.max_concurrency <= 0 or (self.active < self.max_concurrency and not self.waiters):
+            self.active += 1
+            ticket._started_at = time.monotonic()
+            return ticket
+        if len(self.waiters) >= self.max_queue:
+            raise QueueFull(self.name, self.retry_after())
+        ticket._granted = asyncio.get_running_loop().create_future()
+        self.waiters.append(ticket)
+        return ticket
+
+    def leave(self, ticket: Ticket) -> None:
+        if ticket._started_at is None:
+            # 排队中被取消
+            self.waiters.remove(ticket)
+            ticket._granted.cancel()
+            return
+        elapsed = time.monotonic() - ticket._started_at
+        self.service_time += SERVICE_TIME_WEIGHT * (elapsed - self.service_time)
+        self.active -= 1
+        self._admit()
+
+    def _admit(self) -> None:
+        while self.waiters and (self.max_concurrency <= 0 or self.active < self.max_concurrency):
+            ticket = self.waiters.popleft()
+            self.active += 1
+            ticket._started_at = time.monotonic()
+            ticket._granted.set_result(None)
+
+
+class AdmissionController:
+    def __init__(self):
+        self._gates: Dict[Tuple[str, str], _Gate] = {}
+
+    def reserve(self, route: Optional[Route]) -> Ticket:
+        """
+        Take a slot or a place in the queue of ``route``'s target; raises
+        QueueFull when the queue is full. Unknown targets are not limited.
+        """
+        if route is None:
+            return Ticket(None)
+        key = (route.list_type, route.name)
+        gate = self._gates.get(key)
+        if gate is None:
+            gate = self._gates[key] = _Gate(f"{route.list_type} {route.name}")
+        gate.max_concurrency = route.max_concurrency
+        gate.max_queue = route.max_queue
+        # 并发上限调高后，让排队的请求立即进入
+        gate._admit()
+        return gate.enter()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            gate.name: {
+                "active": gate.active,
+                "queued": len(gate.waiters),
+                "max_concurrency": gate.max_concurrency,
+                "max_queue": gate.max_queue,
+            }
+            for gate in self._gates.values()
+        }
+
+
+admission = AdmissionController()
+
+
+async def reserve_stream(list_type: str, name: str) -> Ticket:
+    """Reserve admission for a stream to ``name`` in ``list_type``, or raise HTTP 429."""
+    try:
+        return admission.reserve(await routing_table.resolve(list_type, name))
+    except QueueFull as e:
+        raise e.to_http()
@@ -7,10 +7,10 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List
 from williamtoolbox.storage.json_file import load_file_resources, save_file_resources
+from williamtoolbox.storage import serialization
 from williamtoolbox.annotation import extract_text_from_docx, extract_annotations_from_docx, auto_generate_annotations
 from datetime import datetime
 from pydantic import BaseModel
-import json
 import aiofiles
 
 router = APIRouter()
@@ -121,7 +121,7 @@ async def save_all_annotations(file_uuid: str, annotations: List[Dict[str, Any]]
         # 保存到文件
         save_path = save_dir / f"{file_uuid}.json"
         async with aiofiles.open(save_path, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(save_data, ensure_ascii=False, indent=2))
+            await f.write(serialization.dumps(save_data, indent=2))
             
         return JSONResponse({"message": "Annotations saved successfully"})
         
@@ -134,6 +134,8 @@ class AutoGenerateAnnotationRequest(BaseModel):
     file_uuid: str
     rag_name: str
     model_name: str
+    # False 时跳过响应缓存，重新调用 RAG 和模型
+    use_cache: bool = True
 
 @router.post("/api/annotations/auto_generate")
 async def auto_generate_annotation(request: AutoGenerateAnnotationRequest):
@@ -152,7 +154,7 @@ async def auto_generate_annotation(request: AutoGenerateAnnotationRequest):
         )
         
         # 调用自动生成批注
-        result = await auto_generate_annotations(request.rag_name, doc_text, request.model_name)
+        result = await auto_generate_annotations(request.rag_name, doc_text, request.model_name, request.use_cache)
         
         return JSONResponse({
             "doc_text": result.doc_text,
@@ -34,7 +34,18 @@ from .file_router import router as file_router
 from .apps.annotation_router import router as annotation_router
 from .openapi_router import router as openapi_router
 from .search_router import router as search_router
+from ..storage.json_file import configure_storage, configure_storage_from_env, import_json_into_sqlite, flush_pending_writes
+from ..client_pool import openai_client_pool
+from .stream_tasks import stream_tasks
 app = FastAPI()
+
+
+# 在 include_router 之前注册，保证先于各 router 的启动事件配置存储
+@app.on_event("startup")
+async def configure_storage_event():
+    configure_storage_from_env()
+
+
 app.include_router(chat_router)
 app.include_router(file_router)
 app.include_router(rag_router)
@@ -49,6 +60,16 @@ app.include_router(annotation_router)
 app.include_router(openapi_router)
 app.include_router(search_router)
 
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 停止仍在生成的回答，让它们先保存已生成的部分
+    await stream_tasks.cancel_all("shutdown")
+    # 写回尚在合并窗口内的 registry 保存
+    await flush_pending_writes()
+    await openai_client_pool.close()
+
+
 @app.get("/{full_path:path}")
 async def serve_image(full_path: str, request: Request):
     if "_images" in full_path:
@@ -86,6 +107,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 会话列表分页游标
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -103,7 +126,36 @@ def main():
         default="0.0.0.0",
         help="Host to run the backend server on (default: 0.0.0.0)",
     )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=["json", "sqlite"],
+        default="json",
+        help="Storage backend for models, RAGs, config, users and chat data (default: json)",
+    )
+    parser.add_argument(
+        "--sqlite_path",
+        type=str,
+        default="williamtoolbox.db",
+        help="SQLite database file used when --storage sqlite (default: williamtoolbox.db)",
+    )
+    parser.add_argument(
+        "--import_json",
+        action="store_true",
+        help="Import the existing JSON files into the SQLite database before starting",
+    )
     args = parser.parse_args()
+
+    # Exported so that worker processes pick the same backend
+    os.environ["WILLIAM_TOOLBOX_STORAGE"] = args.storage
+    os.environ["WILLIAM_TOOLBOX_SQLITE_PATH"] = args.sqlite_path
+    if args.import_json:
+        if args.storage != "sqlite":
+            parser.error("--import_json requires --storage sqlite")
+        # 启动事件会复用这里创建的存储
+        configure_storage(args.storage, args.sqlite_path)
+        imported = import_json_into_sqlite()
+        print(f"Imported JSON storage into {args.sqlite_path}: {imported}")
     print(f"Starting backend server on {args.host}:{args.port}")
     uvicorn.run(app, host=args.host, port=args.port)
 
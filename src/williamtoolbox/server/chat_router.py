@@ -1,65 +1,55 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from typing import Optional, Dict, Any
 import os
-import json
 import uuid
 import asyncio
+import time
 from datetime import datetime
-from openai import AsyncOpenAI
 from loguru import logger
 from pydantic import BaseModel
 from .request_types import *
 from ..storage.json_file import *
-import aiofiles
+from ..storage import serialization
+from .event_bus import event_bus
+from .stream_tasks import add_stream_routes, stream_tasks
+from .admission import Ticket, admission
+from .telemetry import StreamMeter, stream_options, telemetry
+from ..client_pool import openai_client_pool
+from ..routing import routing_table
+from ..response_cache import cached_completion, response_cache
+from ..context_window import build_window, message_tokens, reuse_token_counts, schedule_summary, store_token_counts
 import traceback
 from byzerllm.utils.client import code_utils
-from autocoder.utils.stream_thinking import stream_with_thinking_async, separate_stream_thinking_async
+from autocoder.utils.stream_thinking import separate_stream_thinking_async
 
 router = APIRouter()
 
+# 会话列表分页游标：<updated_at>|<id>
+CONVERSATION_CURSOR_SEPARATOR = "|"
+
+
 class AskRequest(BaseModel):
     message: str
+    # False 时跳过响应缓存，总是请求模型
+    use_cache: bool = True
 
 @router.post("/chat/ask")
 async def ask(request: AskRequest):
     try:
-        # 加载配置
-        config = await load_config()
-        
-        # 获取模型列表
-        models = await load_models_from_json()
-        if not models:
-            raise HTTPException(status_code=404, detail="No models available")
-            
-        # 获取第一个运行中的模
-        first_model = None
-        for model in models.keys():
-            if models[model]["status"] == "running":
-                first_model = model
-                break
-
-        if not first_model:
+        # 获取第一个运行中的模型
+        route = await routing_table.first_running("models")
+        if route is None:
             raise HTTPException(status_code=404, detail="No running models available")
-            
-        # 获取OpenAI服务配置
-        openai_server = config.get("openaiServerList", [{}])[0]
-        host = openai_server.get("host", "localhost")
-        port = openai_server.get("port", 8000)
-        if host == "0.0.0.0":
-            host = "127.0.0.1"
-
-        base_url = f"http://{host}:{port}/v1"
-        client = AsyncOpenAI(base_url=base_url, api_key="xxxx")
-
-        # 调用模型
-        response = await client.chat.completions.create(
-            model=first_model,
-            messages=[{"role": "user", "content": request.message}],
-            stream=False,
-            max_tokens=4096
+
+        # 调用模型，相同的问题在缓存有效期内直接返回缓存结果
+        content = await cached_completion(
+            route,
+            [{"role": "user", "content": request.message}],
+            use_cache=request.use_cache,
+            max_tokens=route.max_tokens,
         )
 
-        return {"response": response.choices[0].message.content}
+        return {"response": content}
         
     except Exception as e:
         logger.error(f"Error in ask endpoint: {str(e)}")
@@ -67,38 +57,40 @@ async def ask(request: AskRequest):
 
 
 @router.get("/chat/conversations")
-async def get_conversation_list(username: str):
-    chat_data = await load_chat_data(username)
-    conversation_list = []
-    
-    for conv in chat_data["conversations"]:
-        title = conv["title"]
-        
-        # If title is empty or default, use first user message as title
-        if not title or title == "新的聊天":
-            # Find the first user message
-            for msg in conv["messages"]:
-                if msg["role"] == "user" and msg["content"]:
-                    # Truncate message if too long (30 characters max)
-                    title = msg["content"][:30] + ("..." if len(msg["content"]) > 30 else "")
-                    break
-        
-        conversation_list.append({
-            "id": conv["id"],
-            "title": title,
-            "time": conv["updated_at"].split("T")[0],  # Format date to YYYY-MM-DD
-            "messages": len(conv["messages"]),
-            "created_at": conv["created_at"],
-            "updated_at": conv["updated_at"],
-        })
-    
-    # Sort conversations by updated_at in descending order (newest first)
-    conversation_list.sort(key=lambda x: x["updated_at"], reverse=True)
-    return conversation_list
+async def get_conversation_list(
+    username: str, response: Response, limit: Optional[int] = None, cursor: Optional[str] = None
+):
+    """Conversations, newest first; with ``limit``, one page, continued by passing ``X-Next-Cursor`` as ``cursor``."""
+    before = None
+    if cursor:
+        updated_at, _, conversation_id = cursor.rpartition(CONVERSATION_CURSOR_SEPARATOR)
+        if not updated_at or not conversation_id:
+            raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+        before = (updated_at, conversation_id)
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+
+    # 多取一条，用于判断是否还有下一页
+    metas = await list_conversations(username, None if limit is None else limit + 1, before)
+    if limit is not None and len(metas) > limit:
+        metas = metas[:limit]
+        last = metas[-1]
+        response.headers["X-Next-Cursor"] = f"{last['updated_at']}{CONVERSATION_CURSOR_SEPARATOR}{last['id']}"
+
+    return [
+        {
+            "id": meta["id"],
+            "title": meta["display_title"],
+            "time": meta["updated_at"].split("T")[0],  # Format date to YYYY-MM-DD
+            "messages": meta["message_count"],
+            "created_at": meta["created_at"],
+            "updated_at": meta["updated_at"],
+        }
+        for meta in metas
+    ]
 
 @router.post("/chat/conversations", response_model=Conversation)
 async def create_conversation(username: str, request: CreateConversationRequest):
-    chat_data = await load_chat_data(username)
     new_conversation = Conversation(
         id=str(uuid.uuid4()),
         title=request.title,
@@ -106,17 +98,12 @@ async def create_conversation(username: str, request: CreateConversationRequest)
         updated_at=datetime.now().isoformat(),
         messages=[],
     )
-    chat_data["conversations"].append(new_conversation.model_dump())
-    await save_chat_data(username, chat_data)
+    await save_conversation(username, new_conversation.model_dump())
     return new_conversation
 
 @router.get("/chat/conversations/{conversation_id}", response_model=Conversation)
 async def get_conversation(username: str, conversation_id: str):
-    chat_data = await load_chat_data(username)
-    conversation = next(
-        (conv for conv in chat_data["conversations"] if conv["id"] == conversation_id),
-        None,
-    )
+    conversation = await load_conversation(username, conversation_id)
     if conversation is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
     return conversation
@@ -126,53 +113,198 @@ async def get_conversation(username: str, conversation_id: str):
     response_model=AddMessageResponse,
 )
 async def add_message_stream(username: str, conversation_id: str, request: AddMessageRequest):
+    """Add a user message, as the full ``messages`` history or a single ``message`` delta, and stream the reply."""
     request_id = str(uuid.uuid4())
 
-    chat_data = await load_chat_data(username)
-    conversation = next(
-        (conv for conv in chat_data["conversations"] if conv["id"] == conversation_id),
-        None,
-    )
-    if conversation is None:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    conversation = None
+    if request.message is None:
+        conversation = await load_conversation(username, conversation_id)
+        if conversation is None:
+            raise HTTPException(status_code=404, detail="Conversation not found")
 
-    # Replace the entire conversation messages with the full message history
-    conversation["messages"] = [msg.model_dump() for msg in request.messages]
-    await save_chat_data(username, chat_data)
     response_message_id = str(uuid.uuid4())
 
-    asyncio.create_task(
-        process_message_stream(
-            username, request_id, request, conversation, response_message_id, chat_data=chat_data
+    async def prepare(ticket: Ticket):
+        nonlocal conversation
+        if request.message is None:
+            # Replace the entire conversation messages with the full message history
+            messages = [msg.model_dump() for msg in request.messages]
+            # 未修改的消息沿用已保存的 token 数
+            reuse_token_counts(messages, conversation["messages"])
+            for message in messages:
+                message_tokens(message)
+            conversation["messages"] = messages
+            await save_conversation(username, conversation)
+        else:
+            message = request.message.model_dump()
+            message_tokens(message)
+            try:
+                conversation = await append_conversation_delta(
+                    username,
+                    conversation_id,
+                    message,
+                    request.parent_message_id,
+                    request.version,
+                )
+            except ConversationConflict as e:
+                raise HTTPException(
+                    status_code=409,
+                    detail={
+                        "message": str(e),
+                        "version": e.version,
+                        "last_message_id": e.last_message_id,
+                    },
+                )
+            if conversation is None:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+        return process_message_stream(
+            username, request_id, request, conversation, response_message_id, ticket
         )
+
+    ticket = await stream_tasks.launch(
+        request_id, request.list_type, request.selected_item, prepare, timeout=request.timeout
     )
 
     return AddMessageResponse(
-        request_id=request_id, response_message_id=response_message_id
+        request_id=request_id,
+        response_message_id=response_message_id,
+        version=conversation.get("version"),
+        queue_position=ticket.position,
     )
 
 
-@router.get(
-    "/chat/conversations/events/{request_id}/{index}", response_model=EventResponse
-)
-async def get_message_events(request_id: str, index: int):
-    file_path = await get_event_file_path(request_id)
-    if not os.path.exists(file_path):
-        raise HTTPException(
-            status_code=404, detail=f"No events found for request_id: {request_id}"
-        )
+add_stream_routes(router, "/chat/conversations/events")
+
 
-    events = []
-    if not os.path.exists(file_path):
-        return EventResponse(events=[])
+# 流式回答期间每隔多少秒把已收到的部分保存一次，进程崩溃时不至于丢失长回答
+REPLY_CHECKPOINT_INTERVAL = float(os.environ.get("WILLIAM_TOOLBOX_REPLY_CHECKPOINT_SECONDS", "5"))
 
-    with open(file_path, "r") as f:
-        for line in f:
-            event = json.loads(line)
-            if event["index"] >= index:
-                events.append(event)
 
-    return EventResponse(events=events)
+class ReplyBuffer:
+    """The assistant reply of one stream, accumulated in memory and checkpointed while it streams."""
+
+    def __init__(self, username: str, conversation_id: str, message_id: str):
+        self.username = username
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.chunks = []
+        self.thoughts = []
+        self._saved_parts = 0
+        self._checkpointed_at = time.monotonic()
+        self._checkpoint_task = None
+
+    def append(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._maybe_checkpoint()
+
+    def add_thought(self, thought: str) -> None:
+        self.thoughts.append(thought)
+        self._maybe_checkpoint()
+
+    def message(self, partial: bool = False) -> Dict[str, Any]:
+        message = {
+            "id": self.message_id,
+            "role": "assistant",
+            "content": "".join(self.chunks),
+            "timestamp": datetime.now().isoformat(),
+            "thoughts": list(self.thoughts),
+        }
+        if partial:
+            message["partial"] = True
+        else:
+            message_tokens(message)
+        return message
+
+    def _maybe_checkpoint(self) -> None:
+        # 崩溃时不丢失长回答：按间隔在后台保存带 partial 标记的部分回复，finish() 以同一 id 覆盖
+        if time.monotonic() - self._checkpointed_at < REPLY_CHECKPOINT_INTERVAL:
+            return
+        if self._checkpoint_task is not None and not self._checkpoint_task.done():
+            return
+        self._checkpointed_at = time.monotonic()
+        self._checkpoint_task = asyncio.create_task(self._save(partial=True))
+
+    async def _save(self, partial: bool) -> Optional[Dict[str, Any]]:
+        parts = len(self.chunks) + len(self.thoughts)
+        if partial and parts == self._saved_parts:
+            return None
+        try:
+            conversation = await append_conversation_messages(
+                self.username, self.conversation_id, [self.message(partial)]
+            )
+            self._saved_parts = parts
+            return conversation
+        except Exception as e:
+            if not partial:
+                raise
+            logger.warning(f"Failed to checkpoint reply {self.message_id}: {e}")
+
+    async def finish(self) -> Optional[Dict[str, Any]]:
+        """Wait for a running checkpoint, then save the complete reply; returns the conversation."""
+        if self._checkpoint_task is not None:
+            await self._checkpoint_task
+        return await self._save(partial=False)
+
+
+# 深度思考事件的轮询间隔：有新事件时从最小值开始，空轮询时指数增长到最大值（秒）
+DEEP_THOUGHT_POLL_MIN = 0.05
+DEEP_THOUGHT_POLL_MAX = 0.5
+# 连续这么久（秒）没有新的思考事件时停止转发
+DEEP_THOUGHT_IDLE_TIMEOUT = 60.0
+# RAG 支持长轮询（条目中 deep_thought_long_poll 为 true）时，单次请求在服务端等待的时间（秒）
+DEEP_THOUGHT_LONG_POLL_WAIT = 10.0
+# 回答流结束后等待剩余思考事件的时间（秒）
+DEEP_THOUGHT_DRAIN_TIMEOUT = 5.0
+
+
+async def relay_deep_thoughts(client, clients, route, request_id: str, stream, reply: ReplyBuffer) -> None:
+    """Forward the reasoning events of a deep-thought RAG request as ``thought`` events until the answer starts."""
+    index = 0
+    delay = DEEP_THOUGHT_POLL_MIN
+    idle_since = time.monotonic()
+    # RAG 通过一次聊天补全返回事件：提示词为 {"request_id", "index"}，回复为 {"events": [...]}
+    query = {"request_id": request_id, "index": index}
+    # 长轮询时由服务端挂起请求，客户端无需休眠
+    if route.deep_thought_long_poll:
+        query["wait"] = DEEP_THOUGHT_LONG_POLL_WAIT
+    try:
+        while True:
+            query["index"] = index
+            round_response = await client.chat.completions.create(
+                model=route.model,
+                messages=[{"role": "user", "content": serialization.dumps(query)}],
+                stream=True,
+                max_tokens=route.max_tokens,
+            )
+            clients.track(round_response)
+            parts = []
+            async for chunk in round_response:
+                v = chunk.choices[0].delta.content
+                if v is not None:
+                    parts.append(v)
+            # 已读完的响应无需在 release() 时关闭，轮询多轮时避免列表持续增长
+            clients.untrack(round_response)
+            evts = serialization.loads("".join(parts))
+            if not evts["events"]:
+                if time.monotonic() - idle_since > DEEP_THOUGHT_IDLE_TIMEOUT:
+                    logger.warning(f"No deep thought events for {request_id}, stop relaying")
+                    return
+                if not route.deep_thought_long_poll:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, DEEP_THOUGHT_POLL_MAX)
+                continue
+            delay = DEEP_THOUGHT_POLL_MIN
+            idle_since = time.monotonic()
+            for evt in evts["events"]:
+                index += 1
+                if evt["event_type"] == "thought":
+                    reply.add_thought(evt["content"])
+                    stream.publish("thought", evt["content"])
+                elif evt["event_type"] in ("chunk", "done"):
+                    return
+    except Exception as e:
+        # 思考过程只是附加信息，转发失败不影响回答
+        logger.warning(f"Deep thought relay for {request_id} failed: {e}")
 
 
 async def process_message_stream(
@@ -181,347 +313,224 @@ async def process_message_stream(
     request: AddMessageRequest,
     conversation: Conversation,
     response_message_id: str,
-    chat_data: ChatData,
+    ticket: Ticket,
 ):
-    file_path = await get_event_file_path(request_id)
-    idx = 0
-    thoughts = []
-    async with aiofiles.open(file_path, "w") as event_file:
-        try:
-            config = await load_config()
-            if request.list_type == "models":
-                model_name = request.selected_item
-                models = await load_models_from_json()                
-                # 获取模型信息
-                model_info = models[model_name]
-                product_type = model_info.get("product_type", "pro")
-
-                if product_type == "pro":
-                    openai_server = config.get("openaiServerList", [{}])[0]
-                    
-                    host = openai_server.get("host", "localhost")
-                    port = openai_server.get("port", 8000)
-                    if host == "0.0.0.0":
-                        host = "127.0.0.1"
-
-                    base_url = f"http://{host}:{port}/v1"
-                    api_key = "xxxx"
-                    real_model_name = model_name
-                elif product_type == "lite":
-                    base_url = model_info["deploy_command"]["infer_params"].get("saas.base_url", "")
-                    api_key = model_info["deploy_command"]["infer_params"].get("saas.api_key", "")
-                    real_model_name = model_info["deploy_command"]["infer_params"].get("saas.model", "")
-
-                client = AsyncOpenAI(base_url=base_url, api_key=api_key)
-
-                response = await client.chat.completions.create(
-                    model=real_model_name,
-                    messages=[
-                        {"role": msg["role"], "content": msg["content"]}
-                        for msg in conversation["messages"]
-                    ],
-                    stream=True,
-                    max_tokens=4096,
-                    extra_body={"request_id":request_id},
-                )
-                
-                thinking_gen,content_gen = await separate_stream_thinking_async(response)
-                async for chunk in thinking_gen:
-                    if chunk:
-                        event = {
-                            "index": idx,
-                            "event": "stream_thought",
-                            "content": chunk,
-                            "timestamp": datetime.now().isoformat(),
-                        }
-                        await event_file.write(
-                            json.dumps(event, ensure_ascii=False) + "\n"
-                        )
-                        await event_file.flush()
-                        idx += 1
+    stream = event_bus.open(request_id)
+    conversation_id = conversation["id"]
+    reply = ReplyBuffer(username, conversation_id, response_message_id)
+    window = None
+    meter = StreamMeter("chat", request_id, username, request.list_type, request.selected_item)
+    clients = openai_client_pool.lease()
+    try:
+        # 排队等待目标服务的并发名额
+        await ticket.wait()
+        meter.admitted()
+        route = await routing_table.resolve(request.list_type, request.selected_item)
+        if route is None:
+            raise ValueError(f"{request.list_type} {request.selected_item} not found")
+        # 按目标的 token 上限截断早期对话，或以缓存的摘要代替
+        window = build_window(conversation, route.max_context_tokens)
+        meter.sent(route, window.prompt_tokens)
+
+        if request.list_type == "models":
+            client = clients.get(route.base_url, route.api_key)
+
+            response = await client.chat.completions.create(
+                model=route.model,
+                messages=window.messages,
+                stream=True,
+                max_tokens=route.max_tokens,
+                stream_options=stream_options(route),
+                extra_body={"request_id":request_id},
+            )
+            clients.track(response)
+            response = meter.wrap(response)
+            
+            thinking_gen,content_gen = await separate_stream_thinking_async(response)
+            async for chunk in thinking_gen:
+                if chunk:
+                    stream.publish("stream_thought", chunk)
+
+            async for chunk in content_gen:
+                if chunk:
+                    stream.publish("chunk", chunk)
+                    reply.append(chunk)
+
+        elif request.list_type == "super-analysis":
+            logger.info(f"Super Analysis {request.selected_item} is using {route.base_url}")
+            
+            client = clients.get(route.base_url, route.api_key)
+            response = await client.chat.completions.create(
+                model=route.model,
+                messages=window.messages,
+                stream=True,
+                max_tokens=route.max_tokens,
+                stream_options=stream_options(route),
+                extra_body={"request_id":request_id},
+            )
+            clients.track(response)
+            response = meter.wrap(response)
+            thinking_gen,content_gen = await separate_stream_thinking_async(response)
+            async for chunk in thinking_gen:
+                if chunk:
+                    stream.publish("stream_thought", chunk)
+
+            async for chunk in content_gen:
+                if chunk:
+                    stream.publish("chunk", chunk)
+                    reply.append(chunk)
+
+        elif request.list_type == "rags":
+            logger.info(f"RAG {request.selected_item} is using {route.base_url}")
+            inference_deep_thought = route.deep_thought
+
+            client = clients.get(route.base_url, route.api_key)
+            
+            extra_body = {}
+            if "only_contexts" in request.extra_metadata and request.extra_metadata["only_contexts"]:
+                extra_body = {
+                    "extra_body": {
+                        "only_contexts": True
+                    }
+                }
 
-                async for chunk in content_gen:
-                    if chunk:
-                        event = {
-                            "index": idx,
-                            "event": "chunk",
-                            "content": chunk,
-                            "timestamp": datetime.now().isoformat(),
-                        }
-                        await event_file.write(
-                            json.dumps(event, ensure_ascii=False) + "\n"
-                        )
-                        await event_file.flush()
-                        idx += 1 
-
-            elif request.list_type == "super-analysis":
-                super_analyses = await load_super_analysis_from_json()
-                analysis_info = super_analyses.get(request.selected_item, {})
-                host = analysis_info.get("host", "localhost")
-                port = analysis_info.get("port", 8000)
-                if host == "0.0.0.0":
-                    host = "127.0.0.1"
-
-                base_url = f"http://{host}:{port}/v1"
-
-                logger.info(f"Super Analysis {request.selected_item} is using {base_url}")
-                
-                client = AsyncOpenAI(base_url=base_url, api_key="xxxx")
-                response = await client.chat.completions.create(
-                    model=analysis_info.get("served_model_name", "default"),
-                    messages=[
-                        {"role": msg["role"], "content": msg["content"]}
-                        for msg in conversation["messages"]
-                    ],
-                    stream=True,
-                    max_tokens=8096,
-                    extra_body={"request_id":request_id},
-                )
+            response = await client.chat.completions.create(
+                model=route.model,
+                messages=window.messages,
+                stream=True,
+                max_tokens=route.max_tokens,
+                stream_options=stream_options(route),
+                extra_body={
+                    **extra_body
+                },
+            )
+            clients.track(response)
+            response = meter.wrap(response)
+            if not inference_deep_thought:                    
                 thinking_gen,content_gen = await separate_stream_thinking_async(response)
                 async for chunk in thinking_gen:
                     if chunk:
-                        event = {
-                            "index": idx,
-                            "event": "stream_thought",
-                            "content": chunk,
-                            "timestamp": datetime.now().isoformat(),
-                        }
-                        await event_file.write(
-                            json.dumps(event, ensure_ascii=False) + "\n"
-                        )
-                        await event_file.flush()
-                        idx += 1
-
+                        stream.publish("thought", chunk)
                 async for chunk in content_gen:
                     if chunk:
-                        event = {
-                            "index": idx,
-                            "event": "chunk",
-                            "content": chunk,
-                            "timestamp": datetime.now().isoformat(),
-                        }
-                        await event_file.write(
-                            json.dumps(event, ensure_ascii=False) + "\n"
-                        )
-                        await event_file.flush()
-                        idx += 1        
-
-            elif request.list_type == "rags":
-                rags = await load_rags_from_json()
-                rag_info = rags.get(request.selected_item, {})
-                host = rag_info.get("host", "localhost")
-                port = rag_info.get("port", 8000)
-                if host == "0.0.0.0":
-                    host = "127.0.0.1"
-
-                base_url = f"http://{host}:{port}/v1"
-
-                logger.info(f"RAG {request.selected_item} is using {base_url}")
-                inference_deep_thought = rag_info.get(
-                    "inference_deep_thought", "False"
-                ) in ["True", "true", True]
-
-                client = AsyncOpenAI(base_url=base_url, api_key="xxxx")
-                
-                extra_body = {}
-                if "only_contexts" in request.extra_metadata and request.extra_metadata["only_contexts"]:
-                    extra_body = {
-                        "extra_body": {
-                            "only_contexts": True
-                        }
-                    }
-
-                response = await client.chat.completions.create(
-                    model=rag_info.get("model", "deepseek_chat"),
-                    messages=[
-                        {"role": msg["role"], "content": msg["content"]}
-                        for msg in conversation["messages"]
-                    ],
-                    stream=True,
-                    max_tokens=8096,
-                    extra_body={
-                        **extra_body
-                    },
+                        stream.publish("chunk", chunk)
+                        reply.append(chunk)
+            else:
+                # 思考过程与回答并行转发：回答流不必等到思考结束才开始读取
+                relay = asyncio.create_task(
+                    relay_deep_thoughts(client, clients, route, request_id, stream, reply)
                 )
-                if not inference_deep_thought:                    
-                    thinking_gen,content_gen = await separate_stream_thinking_async(response)
-                    async for chunk in thinking_gen:
-                        if chunk:
-                            event = {
-                                "index": idx,
-                                "event": "thought",
-                                "content": chunk,
-                                "timestamp": datetime.now().isoformat(),
-                            }
-                            await event_file.write(
-                                json.dumps(event, ensure_ascii=False) + "\n"
-                            )
-                            await event_file.flush()
-
-                            idx += 1
-                    async for chunk in content_gen:
-                        if chunk:
-                            event = {
-                                "index": idx,
-                                "event": "chunk",                                
-                                "content": chunk,
-                                "timestamp": datetime.now().isoformat(),
-                            }
-                            await event_file.write(
-                                json.dumps(event, ensure_ascii=False) + "\n"
-                            )
-                            await event_file.flush()
-
-                            idx += 1
-                else:                    
-                    index = 0
-                    is_in_thought = True
-                    client = AsyncOpenAI(base_url=base_url, api_key="xxxx")
-                    counter = 0
-                    while is_in_thought and counter < 60:                        
-                        round_response = await client.chat.completions.create(
-                            model=rag_info.get("model", "deepseek_chat"),
-                            messages=[
-                                {
-                                    "role": "user",
-                                    "content": json.dumps(
-                                        {"request_id": request_id, "index": index},
-                                        ensure_ascii=False,
-                                    ),
-                                }
-                            ],
-                            stream=True,
-                            max_tokens=8096                            
-                        )
-                        result = ""
-                        async for chunk in round_response:
-                            v = chunk.choices[0].delta.content
-                            if v is not None:
-                                result += v
-                        logger.info(f"result: {result}")                                
-                        evts = json.loads(result)
-                        if not evts["events"]:
-                            await asyncio.sleep(1)
-                            counter += 1
-                            continue
-                        counter = 0
-                        for evt in evts["events"]:                            
-                            if evt["event_type"] == "thought":
-                                thoughts.append(evt["content"])
-                                event = {
-                                    "index": idx,
-                                    "event": "thought",
-                                    "content": evt["content"],
-                                    "timestamp": datetime.now().isoformat(),
-                                }
-                                await event_file.write(
-                                    json.dumps(event, ensure_ascii=False) + "\n"
-                                )
-                                await event_file.flush()                            
-                                idx += 1
-                            if evt["event_type"] == "chunk" or evt["event_type"] == "done":
-                                is_in_thought = False
-                            index += 1  
-                    asyncio.sleep(1)                                 
-
+                try:
                     async for chunk in response:
                         if chunk.choices[0].delta.content:
-                            event = {
-                                "index": idx,
-                                "event": "chunk",
-                                "content": chunk.choices[0].delta.content,
-                                "timestamp": datetime.now().isoformat(),
-                            }
-                            await event_file.write(
-                                json.dumps(event, ensure_ascii=False) + "\n"
-                            )
-                            await event_file.flush()
-
-                            idx += 1
+                            stream.publish("chunk", chunk.choices[0].delta.content)
+                            reply.append(chunk.choices[0].delta.content)
+                    # 回答结束后，给剩余的思考事件一点时间转发完
+                    await asyncio.wait_for(asyncio.shield(relay), DEEP_THOUGHT_DRAIN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    relay.cancel()
+
+    except asyncio.CancelledError:
+        # 用户停止、超时或无人读取；已生成的部分照常保存
+        reason = stream_tasks.cancel_reason(request_id) or "cancelled"
+        meter.finish("cancelled", reason)
+        stream.publish("cancelled", reason)
+    except Exception as e:
+        # Add error event
+        meter.finish("error", str(e))
+        stream.publish("error", str(e))
+        logger.error(traceback.format_exc())
+    finally:
+        meter.finish()
+        clients.release()
+        ticket.release()
+    stream_tasks.complete(request_id)
+
+    # Save the assistant's response, replacing any partial checkpoint. This
+    # happens before "done" so that the event can carry the new conversation
+    # version for the client's next delta request.
+    conversation = None
+    try:
+        conversation = await reply.finish()
+    except Exception as e:
+        stream.publish("error", f"Failed to save reply: {e}")
+        logger.error(traceback.format_exc())
+    if conversation is not None:
+        stream.publish("done", "", version=conversation.get("version"))
+    else:
+        stream.publish("done", "")
+    await stream.close()
 
-        except Exception as e:
-            # Add error event
-            error_event = {
-                "index": idx,
-                "event": "error",
-                "content": str(e),
-                "timestamp": datetime.now().isoformat(),
-            }
-            await event_file.write(json.dumps(error_event, ensure_ascii=False) + "\n")
-            await event_file.flush()
-            logger.error(traceback.format_exc())
-
-        await event_file.write(
-            json.dumps(
-                {
-                    "index": idx,
-                    "event": "done",
-                    "content": "",
-                    "timestamp": datetime.now().isoformat(),
-                },
-                ensure_ascii=False,
-            )
-            + "\n"
-        )
-        await event_file.flush()
+    if window is not None:
+        await store_token_counts(username, conversation_id, window)
+        if conversation is not None:
+            await schedule_summary(username, conversation, window)
 
-    s = ""
-    async with aiofiles.open(file_path, "r") as event_file:
-        async for line in event_file:
-            event = json.loads(line)
-            if event["event"] == "chunk":
-                s += event["content"]
 
-    # Add the assistant's response to the messages list
-    conversation["messages"] = [msg.model_dump() for msg in request.messages] + [
-        {
-            "id": response_message_id,
-            "role": "assistant",
-            "content": s,
-            "timestamp": datetime.now().isoformat(),
-            "thoughts": thoughts,
-        }
-    ]
-    await save_chat_data(username, chat_data)
+@router.get("/chat/telemetry")
+async def get_chat_telemetry():
+    """Latency, token usage, cost and errors per target and per user, plus the admission queues."""
+    return {**telemetry.summary(), "admission": admission.stats()}
+
+
+@router.get("/chat/response-cache")
+async def get_response_cache_stats():
+    """Hit/miss counters and size of the response cache of /chat/ask and annotations."""
+    return response_cache.stats()
+
+
+@router.delete("/chat/response-cache")
+async def clear_response_cache():
+    return {"removed": await response_cache.clear()}
+
+
+@router.get("/chat/telemetry/records")
+async def get_chat_telemetry_records(limit: int = 0):
+    """The most recent per-request telemetry records as JSONL."""
+    return Response(
+        "".join(serialization.dumps(record) + "\n" for record in telemetry.recent(limit)),
+        media_type="application/x-ndjson",
+    )
 
 
 @router.put("/chat/conversations/{conversation_id}")
 async def update_conversation(username: str, conversation_id: str, request: Conversation):
     """Update an existing conversation with new data."""
-    chat_data = await load_chat_data(username)
-
-    # Find and update the conversation
-    for conv in chat_data["conversations"]:
-        if conv["id"] == conversation_id:
-            logger.info(f"Updating conversation {conversation_id}")
-            conv.update(
-                {
-                    "title": request.title,
-                    "messages": [msg.model_dump() for msg in request.messages],
-                    "updated_at": datetime.now().isoformat(),
-                }
-            )
-            await save_chat_data(username, chat_data)
-            return conv
+    conv = await load_conversation(username, conversation_id)
+    if conv is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
 
-    raise HTTPException(status_code=404, detail="Conversation not found")
+    logger.info(f"Updating conversation {conversation_id}")
+    messages_before = conv["messages"]
+    conv.update(
+        {
+            "title": request.title,
+            "messages": [msg.model_dump() for msg in request.messages],
+            "updated_at": datetime.now().isoformat(),
+        }
+    )
+    reuse_token_counts(conv["messages"], messages_before)
+    await save_conversation(username, conv)
+    return conv
 
 
 @router.put("/chat/conversations/{conversation_id}/title")
 async def update_conversation_title(username: str, conversation_id: str, request: UpdateTitleRequest):
     """Update only the title of an existing conversation."""
-    chat_data = await load_chat_data(username)
-
-    # Find and update the conversation title
-    for conv in chat_data["conversations"]:
-        if conv["id"] == conversation_id:
-            logger.info(f"Updating title for conversation {conversation_id}")
-            conv["title"] = request.title
-            conv["updated_at"] = datetime.now().isoformat()
-            await save_chat_data(username, chat_data)
-            return {"message": "Title updated successfully", "title": request.title}
-
-    raise HTTPException(status_code=404, detail="Conversation not found")
+    logger.info(f"Updating title for conversation {conversation_id}")
+    try:
+        conv = await update_conversation_fields(
+            username,
+            conversation_id,
+            {"title": request.title, "updated_at": datetime.now().isoformat()},
+        )
+    except ValueError:
+        conv = None
+    if conv is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return {"message": "Title updated successfully", "title": request.title}
 
 
 class ExtractCSVRequest(BaseModel):
@@ -542,9 +551,8 @@ async def extract_csv(request: ExtractCSVRequest):
 
 @router.delete("/chat/conversations/{conversation_id}")
 async def delete_conversation(username: str, conversation_id: str):
-    chat_data = await load_chat_data(username)
-    chat_data["conversations"] = [
-        conv for conv in chat_data["conversations"] if conv["id"] != conversation_id
-    ]
-    await save_chat_data(username, chat_data)
+    try:
+        await delete_conversation_data(username, conversation_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"message": "Conversation deleted successfully"}
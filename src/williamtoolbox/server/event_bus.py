@@ -0,0 +1,360 @@
+"""In-process event bus for streamed chat and search replies, optionally persisted to ``chat_events/``."""
+import os
+import sys
+import time
+import array
+import asyncio
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi import HTTPException, Request
+from loguru import logger
+from sse_starlette.sse import EventSourceResponse
+
+from ..storage import serialization
+from ..storage.json_file import get_event_file_path
+
+# 每个请求在内存中保留的事件数，超出后丢弃最早的事件（已持久化的仍可从磁盘读取）
+EVENT_BUFFER_SIZE = int(os.environ.get("WILLIAM_TOOLBOX_EVENT_BUFFER_SIZE", "10000"))
+# 结束的流在内存中保留的时间（秒）
+EVENT_STREAM_TTL = 600
+# 持久化批量写盘的间隔（秒）
+EVENT_PERSIST_INTERVAL = 0.05
+# 长轮询 / SSE 单次等待新事件的上限（秒）
+EVENT_WAIT_MAX = 30
+# 流不在本进程内存中时，SSE 轮询事件文件的间隔（秒）
+EVENT_FILE_POLL_INTERVAL = 0.5
+# 同类型的连续文本片段在时间窗口内（毫秒）或达到字符上限前合并为一个事件；窗口为 0 时不合并
+EVENT_COALESCE_WINDOW = float(os.environ.get("WILLIAM_TOOLBOX_EVENT_COALESCE_MS", "30")) / 1000
+EVENT_COALESCE_MAX_CHARS = int(os.environ.get("WILLIAM_TOOLBOX_EVENT_COALESCE_MAX_CHARS", "1024"))
+# 只合并前端按字符串拼接的事件；"thought" 每条在前端单独展示，不能合并
+COALESCED_EVENT_TYPES = frozenset({"chunk", "stream_thought"})
+EVENT_PERSIST = os.environ.get("WILLIAM_TOOLBOX_EVENT_PERSIST", "true").lower() not in ("0", "false", "no")
+
+
+class EventStream:
+    """
+    Ordered events of one request. Only the producer publishes; any number of readers.
+
+    Consecutive ``chunk``/``stream_thought`` deltas are merged into one event
+    until ``coalesce_window`` seconds pass or ``coalesce_max_chars`` is
+    reached; publishing any other event type, or closing, emits the pending
+    text first so ordering is preserved.
+    """
+
+    def __init__(
+        self,
+        request_id: str,
+        capacity: int = EVENT_BUFFER_SIZE,
+        persist: bool = EVENT_PERSIST,
+        coalesce_window: float = EVENT_COALESCE_WINDOW,
+        coalesce_max_chars: int = EVENT_COALESCE_MAX_CHARS,
+    ):
+        self.request_id = request_id
+        self.capacity = capacity
+        self.persist = persist
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_chars = coalesce_max_chars
+        self.closed = False
+        self.closed_at: Optional[float] = None
+        # last time a poller or SSE client in this process asked for events
+        self.last_seen = time.monotonic()
+        self._events: List[Dict[str, Any]] = []
+        # index of self._events[0]; grows when old events are dropped
+        self._base = 0
+        self._changed = asyncio.Event()
+        self._pending_lines: List[bytes] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self._file_path: Optional[str] = None
+        self._file_size = 0
+        self._coalesce_type: Optional[str] = None
+        self._coalesce_parts: List[str] = []
+        self._coalesce_chars = 0
+        self._coalesce_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def next_index(self) -> int:
+        return self._base + len(self._events)
+
+    def publish(self, event_type: str, content: Any, **fields) -> None:
+        """Append an event (possibly merged with the previous delta); the index is assigned on emit."""
+        if self.closed:
+            raise RuntimeError(f"Event stream {self.request_id} is closed")
+        if (
+            self.coalesce_window > 0
+            and event_type in COALESCED_EVENT_TYPES
+            and not fields
+            and isinstance(content, str)
+        ):
+            if self._coalesce_type != event_type:
+                self._flush_coalesced()
+                self._coalesce_type = event_type
+                self._coalesce_timer = asyncio.get_running_loop().call_later(
+                    self.coalesce_window, self._flush_coalesced
+                )
+            self._coalesce_parts.append(content)
+            self._coalesce_chars += len(content)
+            if self._coalesce_chars >= self.coalesce_max_chars:
+                self._flush_coalesced()
+            return
+        self._flush_coalesced()
+        self._emit(event_type, content, fields)
+
+    def _flush_coalesced(self) -> None:
+        if self._coalesce_timer is not None:
+            self._coalesce_timer.cancel()
+            self._coalesce_timer = None
+        if self._coalesce_type is None:
+            return
+        event_type, content = self._coalesce_type, "".join(self._coalesce_parts)
+        self._coalesce_type = None
+        self._coalesce_parts = []
+        self._coalesce_chars = 0
+        self._emit(event_type, content, {})
+
+    def _emit(self, event_type: str, content: Any, fields: Dict[str, Any]) -> None:
+        event = {
+            "index": self.next_index,
+            "event": event_type,
+            "content": content,
+            "timestamp": datetime.now().isoformat(),
+            **fields,
+        }
+        self._events.append(event)
+        # 超出容量两倍时批量裁剪，摊还 O(1)
+        if len(self._events) > 2 * self.capacity:
+            drop = len(self._events) - self.capacity
+            del self._events[:drop]
+            self._base += drop
+        if self.persist:
+            self._pending_lines.append((serialization.dumps(event) + "\n").encode("utf-8"))
+            if self._flush_task is None:
+                self._flush_task = asyncio.ensure_future(self._flush_later())
+        self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self, index: int, timeout: Optional[float] = None) -> bool:
+        """Wait until an event with ``index`` exists or the stream closes; False on timeout."""
+        self.last_seen = time.monotonic()
+        while self.next_index <= index and not self.closed:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def read(self, index: int) -> List[Dict[str, Any]]:
+        """Events with ``index >= index``."""
+        self.last_seen = time.monotonic()
+        if index >= self._base or not self.persist:
+            return self._events[max(0, index - self._base):]
+        # 内存中已丢弃的部分从磁盘回放
+        await self.flush()
+        return await read_event_file(self._file_path, index)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(EVENT_PERSIST_INTERVAL)
+        await self.flush()
+
+    async def flush(self) -> None:
+        # a scheduled flush that finds nothing pending is a no-op
+        self._flush_task = None
+        async with self._flush_lock:
+            if not self._pending_lines:
+                return
+            lines, self._pending_lines = self._pending_lines, []
+            truncate = self._file_path is None
+            if truncate:
+                self._file_path = await get_event_file_path(self.request_id)
+            offsets = array.array("Q")
+            position = self._file_size
+            for line in lines:
+                offsets.append(position)
+                position += len(line)
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(
+                    None, _append_events, self._file_path, b"".join(lines), offsets, truncate
+                )
+            except OSError as e:
+                logger.error(f"Failed to persist events for {self.request_id}: {e}")
+                return
+            self._file_size = position
+
+    async def close(self) -> None:
+        """Mark the stream finished and write out pending events."""
+        self._flush_coalesced()
+        self.closed = True
+        self.closed_at = time.monotonic()
+        if self.persist:
+            await self.flush()
+        self._notify()
+
+
+# 每个事件在事件文件中的字节偏移（小端 uint64），从第 N 个事件读取时直接定位
+def _index_path(file_path: str) -> str:
+    return file_path + ".idx"
+
+
+def marker_path(file_path: str, kind: str) -> str:
+    """``<event file>.seen`` / ``.cancel``: signals left for the producing process."""
+    return f"{file_path}.{kind}"
+
+
+def touch_marker(path: str) -> None:
+    with open(path, "a"):
+        pass
+    os.utime(path)
+
+
+def refresh_marker(path: str) -> None:
+    """Update the mtime of an existing marker; a missing one (stream finished) is not recreated."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _append_events(file_path: str, data: bytes, offsets: "array.array", truncate: bool) -> None:
+    mode = "wb" if truncate else "ab"
+    # 先写事件再写偏移，偏移永远指向已存在的数据
+    with open(file_path, mode) as f:
+        f.write(data)
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    with open(_index_path(file_path), mode) as f:
+        f.write(offsets.tobytes())
+
+
+def _read_event_file(file_path: str, index: int) -> List[Dict[str, Any]]:
+    start = 0
+    try:
+        with open(_index_path(file_path), "rb") as f:
+            count = os.fstat(f.fileno()).st_size // 8
+            if count:
+                # 偏移表可能落后于事件文件，从最后一个已知偏移开始向后扫描
+                f.seek(min(index, count - 1) * 8)
+                start = int.from_bytes(f.read(8), "little")
+    except FileNotFoundError:
+        # 没有偏移表（旧版本写的文件），从头扫描
+        pass
+
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        data = f.read()
+    events = []
+    lines = data.split(b"\n")
+    # 最后一段没有换行符：为空，或是正在写入的不完整行
+    for line in lines[:-1]:
+        if not line.strip():
+            continue
+        event = serialization.loads(line)
+        if event["index"] >= index:
+            events.append(event)
+    return events
+
+
+async def read_event_file(file_path: str, index: int) -> List[Dict[str, Any]]:
+    """Events with ``index >= index`` from a persisted event file, read off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _read_event_file, file_path, index)
+
+
+class EventBus:
+    def __init__(self):
+        self._streams: Dict[str, EventStream] = {}
+
+    def open(self, request_id: str) -> EventStream:
+        """Return the stream for ``request_id``, creating it if needed."""
+        self._evict_expired()
+        stream = self._streams.get(request_id)
+        if stream is None:
+            stream = self._streams[request_id] = EventStream(request_id)
+        return stream
+
+    def get(self, request_id: str) -> Optional[EventStream]:
+        return self._streams.get(request_id)
+
+    def discard(self, request_id: str) -> None:
+        """Drop a stream whose producer never started."""
+        self._streams.pop(request_id, None)
+
+    async def read(self, request_id: str, index: int, wait: float = 0) -> Optional[List[Dict[str, Any]]]:
+        """
+        Events of ``request_id`` from ``index`` on, from memory or, failing
+        that, from the persisted file. None if the request is unknown.
+        With ``wait`` > 0 an in-memory stream with no new events is awaited
+        for up to that many seconds (long-poll).
+        """
+        stream = self._streams.get(request_id)
+        if stream is not None:
+            if wait > 0:
+                await stream.wait(index, timeout=min(wait, EVENT_WAIT_MAX))
+            return await stream.read(index)
+        file_path = await get_event_file_path(request_id)
+        if not os.path.exists(file_path):
+            return None
+        # 流可能由其他进程产生，告诉它仍有人在读取
+        refresh_marker(marker_path(file_path, "seen"))
+        return await read_event_file(file_path, index)
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        expired = [
+            request_id
+            for request_id, stream in self._streams.items()
+            if stream.closed and now - stream.closed_at > EVENT_STREAM_TTL
+        ]
+        for request_id in expired:
+            del self._streams[request_id]
+
+
+event_bus = EventBus()
+
+
+async def _iter_events(request: Request, request_id: str, index: int) -> AsyncIterator[Dict[str, Any]]:
+    """Yield events from ``index`` on until ``done`` or the client disconnects."""
+    while not await request.is_disconnected():
+        stream = event_bus.get(request_id)
+        if stream is not None:
+            events = await stream.read(index)
+            if not events:
+                if stream.closed:
+                    return
+                await stream.wait(index, timeout=EVENT_WAIT_MAX)
+                continue
+        else:
+            # 由其他进程产生（或已被逐出内存）的流，从事件文件读取
+            events = await event_bus.read(request_id, index) or []
+            if not events:
+                await asyncio.sleep(EVENT_FILE_POLL_INTERVAL)
+                continue
+        for event in events:
+            yield event
+            index = event["index"] + 1
+            if event["event"] == "done":
+                return
+
+
+async def event_source(request: Request, request_id: str, index: int = 0) -> EventSourceResponse:
+    """
+    Server-Sent Events response for ``request_id``. Each SSE message has the
+    event type as ``event``, the index as ``id`` and the JSON event (same
+    shape as the polling endpoints) as ``data``. Resumes from ``index`` or,
+    on reconnect, after the ``Last-Event-ID`` sent by the browser.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id is not None and last_event_id.isdigit():
+        index = max(index, int(last_event_id) + 1)
+    if event_bus.get(request_id) is None and not os.path.exists(await get_event_file_path(request_id)):
+        raise HTTPException(status_code=404, detail=f"No events found for request_id: {request_id}")
+
+    async def generator():
+        async for event in _iter_events(request, request_id, index):
+            yield {"id": str(event["index"]), "event": event["event"], "data": serialization.dumps(event)}
+
+    return EventSourceResponse(generator())
@@ -13,13 +13,19 @@ from autocoder import models as autocoder_models
 
 router = APIRouter()
 
-# Load supported models from JSON file
-supported_models = b_load_models_from_json()
+supported_models = {}
 
-# If the JSON file is empty or doesn't exist, use the default models
-if not supported_models:
-    supported_models = {}
-    b_save_models_to_json(supported_models)
+
+@router.on_event("startup")
+async def load_supported_models():
+    # 启动时（存储已配置后）再读取，使用 SQLite 时不会读写 models.json
+    global supported_models
+    supported_models = await load_models_from_json()
+
+    # If the JSON file is empty or doesn't exist, use the default models
+    if not supported_models:
+        supported_models = {}
+        await save_models_to_json(supported_models)
 
 
 def deploy_command_to_string(cmd: DeployCommand) -> str:
@@ -118,6 +124,9 @@ async def add_model(model: AddModelRequest):
                 "is_reasoning": model.is_reasoning or False,
                 "input_price": model.input_price or 0.0,
                 "output_price": model.output_price or 0.0,
+                "max_concurrency": model.max_concurrency,
+                "max_queue": model.max_queue,
+                "max_context_tokens": model.max_context_tokens,
                 "deploy_command": DeployCommand(
                     pretrained_model_type=model.pretrained_model_type,
                     cpus_per_worker=model.cpus_per_worker,
@@ -154,6 +163,9 @@ async def add_model(model: AddModelRequest):
             "is_reasoning": model.is_reasoning or False,
             "input_price": model.input_price or 0.0,
             "output_price": model.output_price or 0.0,
+            "max_concurrency": model.max_concurrency,
+            "max_queue": model.max_queue,
+            "max_context_tokens": model.max_context_tokens,
             "deploy_command": DeployCommand(
                 pretrained_model_type=model.pretrained_model_type,
                 cpus_per_worker=model.cpus_per_worker,
@@ -223,6 +235,9 @@ async def update_model(model_name: str, request: AddModelRequest):
                 "is_reasoning": request.is_reasoning or False,
                 "input_price": request.input_price or 0.0,
                 "output_price": request.output_price or 0.0,
+                "max_concurrency": request.max_concurrency,
+                "max_queue": request.max_queue,
+                "max_context_tokens": request.max_context_tokens,
                 "deploy_command": DeployCommand(
                     pretrained_model_type=request.pretrained_model_type,
                     cpus_per_worker=request.cpus_per_worker,
@@ -262,6 +277,9 @@ async def update_model(model_name: str, request: AddModelRequest):
         model_info['is_reasoning'] = request.is_reasoning
         model_info['input_price'] = request.input_price
         model_info['output_price'] = request.output_price
+        model_info['max_concurrency'] = request.max_concurrency
+        model_info['max_queue'] = request.max_queue
+        model_info['max_context_tokens'] = request.max_context_tokens
 
         models[model_name] = model_info
         await save_models_to_json(models)
@@ -1,5 +1,5 @@
 from typing import Optional, Any, List, Dict
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 class OpenAIServiceStartRequest(BaseModel):
     host: str = Field(default="0.0.0.0")
@@ -39,10 +39,24 @@ class ChatData(BaseModel):
 
 
 class AddMessageRequest(BaseModel):
-    messages: List[Message]  # Change to accept full message history
+    messages: List[Message] = []  # Change to accept full message history
+    # 增量模式：只发送新消息 message，附带客户端已知的最后一条消息 id（空会话为 None）
+    # 和可选的会话版本；服务端历史已变化时返回 409
+    message: Optional[Message] = None
+    parent_message_id: Optional[str] = None
+    version: Optional[int] = None
     list_type: str
     selected_item: str
     extra_metadata: Optional[Dict[str, Any]] = Field(default_factory=dict)
+    # 流的最长运行时间（秒），超时后取消；不能超过服务端的 STREAM_DEADLINE
+    timeout: Optional[float] = None
+
+    @model_validator(mode="after")
+    def check_message_mode(self):
+        # messages（完整历史）和 message（增量）必须且只能提供一个
+        if (self.message is None) == (not self.messages):
+            raise ValueError("Provide either 'messages' (full history) or 'message' (delta), not both")
+        return self
 
 from enum import Enum
 
@@ -64,6 +78,10 @@ class AddModelRequest(BaseModel):
     is_reasoning: Optional[bool] = Field(default=None)
     input_price: Optional[float] = Field(default=None)
     output_price: Optional[float] = Field(default=None)
+    # 聊天并发与排队上限，None 时使用 config.json 中 chatAdmission 的默认值
+    max_concurrency: Optional[int] = Field(default=None)
+    max_queue: Optional[int] = Field(default=None)
+    max_context_tokens: Optional[int] = Field(default=None)
 
 
 class AddRAGRequest(BaseModel):
@@ -88,6 +106,10 @@ class AddRAGRequest(BaseModel):
     without_contexts: bool = Field(default=False)
     product_type: ProductType = Field(default=ProductType.lite)
     infer_params: Optional[Dict[str, Any]] = Field(default_factory=dict)
+    # 聊天并发与排队上限，None 时使用 config.json 中 chatAdmission 的默认值
+    max_concurrency: Optional[int] = Field(default=None)
+    max_queue: Optional[int] = Field(default=None)
+    max_context_tokens: Optional[int] = Field(default=None)
     model_config = {"protected_namespaces": ()}  
 
 
@@ -107,6 +129,10 @@ class DeployCommand(BaseModel):
 class AddMessageResponse(BaseModel):
     request_id: str
     response_message_id: str
+    # 追加用户消息后的会话版本
+    version: Optional[int] = None
+    # 目标服务繁忙时在队列中的位置（1 表示下一个），可通过 status 接口查询最新位置；None 表示无需排队
+    queue_position: Optional[int] = None
 
 class EventResponse(BaseModel):
     events: list[Dict[str, Any]]
@@ -130,6 +156,10 @@ class AddSuperAnalysisRequest(BaseModel):
     context_rag_base_url: str
     byzer_sql_url: str = Field(default="http://127.0.0.1:9003/run/script")
     host: str = Field(default="0.0.0.0")
+    # 聊天并发与排队上限，None 时使用 config.json 中 chatAdmission 的默认值
+    max_concurrency: Optional[int] = Field(default=None)
+    max_queue: Optional[int] = Field(default=None)
+    max_context_tokens: Optional[int] = Field(default=None)
 class RunSQLRequest(BaseModel):
     sql: str
     engine_url: str
@@ -1,19 +1,24 @@
 from fastapi import APIRouter, HTTPException
 from typing import Optional, Dict, Any
 import os
-import json
 import uuid
 import asyncio
 from datetime import datetime
-from openai import AsyncOpenAI
 from loguru import logger
 from pydantic import BaseModel
 from .request_types import *
 from ..storage.json_file import *
-import aiofiles
+from ..storage import serialization
+from .event_bus import event_bus
+from .stream_tasks import add_stream_routes, stream_tasks
+from .admission import Ticket
+from .telemetry import StreamMeter, stream_options
+from ..client_pool import openai_client_pool
+from ..routing import routing_table
+from ..context_window import build_window
 import traceback
 from byzerllm.utils.client import code_utils
-from autocoder.utils.stream_thinking import stream_with_thinking_async, separate_stream_thinking_async
+from autocoder.utils.stream_thinking import separate_stream_thinking_async
 
 router = APIRouter()
 
@@ -26,38 +31,23 @@ async def add_message_stream(username: str, request: AddMessageRequest):
     request_id = str(uuid.uuid4())    
     response_message_id = str(uuid.uuid4())
 
-    asyncio.create_task(
-        process_message_stream(
-            username, request_id, request, response_message_id
+    async def prepare(ticket: Ticket):
+        return process_message_stream(
+            username, request_id, request, response_message_id, ticket
         )
+
+    ticket = await stream_tasks.launch(
+        request_id, request.list_type, request.selected_item, prepare, timeout=request.timeout
     )
 
     return AddMessageResponse(
-        request_id=request_id, response_message_id=response_message_id
+        request_id=request_id,
+        response_message_id=response_message_id,
+        queue_position=ticket.position,
     )
 
 
-@router.get(
-    "/chat/search/events/{request_id}/{index}", response_model=EventResponse
-)
-async def get_message_events(request_id: str, index: int):
-    file_path = await get_event_file_path(request_id)
-    if not os.path.exists(file_path):
-        raise HTTPException(
-            status_code=404, detail=f"No events found for request_id: {request_id}"
-        )
-
-    events = []
-    if not os.path.exists(file_path):
-        return EventResponse(events=[])
-
-    with open(file_path, "r") as f:
-        for line in f:
-            event = json.loads(line)
-            if event["index"] >= index:
-                events.append(event)
-
-    return EventResponse(events=events)
+add_stream_routes(router, "/chat/search/events")
 
 
 async def process_message_stream(
@@ -65,102 +55,70 @@ async def process_message_stream(
     request_id: str,
     request: AddMessageRequest,
     response_message_id: str,
+    ticket: Ticket,
 ):
-    file_path = await get_event_file_path(request_id)
-    idx = 0
-    thoughts = []
-    async with aiofiles.open(file_path, "w") as event_file:
-        try:            
-            if request.list_type == "rags":
-                rags = await load_rags_from_json()
-                rag_info = rags.get(request.selected_item, {})
-                host = rag_info.get("host", "localhost")
-                port = rag_info.get("port", 8000)
-                if host == "0.0.0.0":
-                    host = "127.0.0.1"
-
-                base_url = f"http://{host}:{port}/v1"
-
-                logger.info(f"RAG {request.selected_item} is using {base_url}")                
-                client = AsyncOpenAI(base_url=base_url, api_key="xxxx")
-                                
-
-                response = await client.chat.completions.create(
-                    model=rag_info.get("model", "deepseek_chat"),
-                    messages=[
-                            {"role": msg.role, "content": msg.content}
-                            for msg in request.messages
-                    ],
-                    stream=True,
-                    max_tokens=8096,
-                    extra_body={
-                        "extra_body": {
-                            "only_contexts": True
-                        }
-                    },
-                )
-                thinking_gen,content_gen = await separate_stream_thinking_async(response)
-                async for chunk in thinking_gen:
-                    if chunk:
-                        event = {
-                            "index": idx,
-                            "event": "thought",
-                            "content": chunk,
-                            "timestamp": datetime.now().isoformat(),
-                        }
-                        await event_file.write(
-                            json.dumps(event, ensure_ascii=False) + "\n"
-                        )
-                        await event_file.flush()
-
-                        idx += 1
-                async for chunk in content_gen:
-                    if chunk:
-                        event = {
-                            "index": idx,
-                            "event": "chunk",                                
-                            "content": chunk,
-                            "timestamp": datetime.now().isoformat(),
-                        }
-                        await event_file.write(
-                            json.dumps(event, ensure_ascii=False) + "\n"
-                        )
-                        await event_file.flush()
-
-                        idx += 1
-                    
-                
-
-        except Exception as e:
-            # Add error event
-            error_event = {
-                "index": idx,
-                "event": "error",
-                "content": str(e),
-                "timestamp": datetime.now().isoformat(),
-            }
-            await event_file.write(json.dumps(error_event, ensure_ascii=False) + "\n")
-            await event_file.flush()
-            logger.error(traceback.format_exc())
-
-        await event_file.write(
-            json.dumps(
-                {
-                    "index": idx,
-                    "event": "done",
-                    "content": "",
-                    "timestamp": datetime.now().isoformat(),
+    stream = event_bus.open(request_id)
+    meter = StreamMeter("search", request_id, username, request.list_type, request.selected_item)
+    clients = openai_client_pool.lease()
+    try:            
+        # 排队等待目标服务的并发名额
+        await ticket.wait()
+        meter.admitted()
+        if request.list_type == "rags":
+            route = await routing_table.resolve("rags", request.selected_item)
+            if route is None:
+                raise ValueError(f"RAG {request.selected_item} not found")
+
+            logger.info(f"RAG {request.selected_item} is using {route.base_url}")
+            client = clients.get(route.base_url, route.api_key)
+            # 搜索请求不保存会话，超出 token 上限时只截断早期对话
+            window = build_window(
+                {"messages": [msg.model_dump() for msg in request.messages]},
+                route.max_context_tokens,
+            )
+            messages = window.messages
+            meter.sent(route, window.prompt_tokens)
+
+            response = await client.chat.completions.create(
+                model=route.model,
+                messages=messages,
+                stream=True,
+                max_tokens=route.max_tokens,
+                stream_options=stream_options(route),
+                extra_body={
+                    "extra_body": {
+                        "only_contexts": True
+                    }
                 },
-                ensure_ascii=False,
             )
-            + "\n"
-        )
-        await event_file.flush()
-
-    s = ""
-    async with aiofiles.open(file_path, "r") as event_file:
-        async for line in event_file:
-            event = json.loads(line)
-            if event["event"] == "chunk":
-                s += event["content"]
+            clients.track(response)
+            response = meter.wrap(response)
+            thinking_gen,content_gen = await separate_stream_thinking_async(response)
+            async for chunk in thinking_gen:
+                if chunk:
+                    stream.publish("thought", chunk)
+            async for chunk in content_gen:
+                if chunk:
+                    stream.publish("chunk", chunk)
+                
+            
+
+    except asyncio.CancelledError:
+        # 用户停止、超时或无人读取
+        reason = stream_tasks.cancel_reason(request_id) or "cancelled"
+        meter.finish("cancelled", reason)
+        stream.publish("cancelled", reason)
+    except Exception as e:
+        # Add error event
+        meter.finish("error", str(e))
+        stream.publish("error", str(e))
+        logger.error(traceback.format_exc())
+    finally:
+        meter.finish()
+        clients.release()
+        ticket.release()
+    stream_tasks.complete(request_id)
+
+    stream.publish("done", "")
+    await stream.close()
     
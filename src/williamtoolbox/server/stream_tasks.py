@@ -0,0 +1,236 @@
+"""Registry of the background tasks that produce chat and search streams, so they can be cancelled."""
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from loguru import logger
+
+from ..storage.json_file import get_event_file_path
+from .admission import Ticket, reserve_stream
+from .event_bus import EVENT_PERSIST, event_bus, event_source, marker_path, touch_marker
+from .request_types import EventResponse
+
+# 单个流的最长运行时间（秒），请求可指定更短的 timeout；0 表示不限制
+STREAM_DEADLINE = float(os.environ.get("WILLIAM_TOOLBOX_STREAM_DEADLINE", "1800"))
+# 超过该时间（秒）没有轮询或 SSE 客户端读取事件时取消流；0 表示不检查
+STREAM_IDLE_TIMEOUT = float(os.environ.get("WILLIAM_TOOLBOX_STREAM_IDLE_TIMEOUT", "0"))
+STREAM_WATCHDOG_INTERVAL = 1.0
+
+
+def _remove_markers(file_path: str, kinds) -> None:
+    for kind in kinds:
+        try:
+            os.remove(marker_path(file_path, kind))
+        except FileNotFoundError:
+            pass
+
+
+class _StreamTask:
+    __slots__ = ("request_id", "task", "deadline", "reason", "file_path", "ticket")
+
+    def __init__(
+        self,
+        request_id: str,
+        task: asyncio.Task,
+        deadline: Optional[float],
+        file_path: str,
+        ticket: Optional[Ticket],
+    ):
+        self.request_id = request_id
+        self.task = task
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+        self.file_path = file_path
+        self.ticket = ticket
+
+
+class StreamTaskRegistry:
+    def __init__(self):
+        self._tasks: Dict[str, _StreamTask] = {}
+        self._watchdog: Optional[asyncio.Task] = None
+
+    async def start(
+        self, request_id: str, coro, timeout: Optional[float] = None, ticket: Optional[Ticket] = None
+    ) -> asyncio.Task:
+        """
+        Run ``coro`` as the producer of ``request_id``. ``timeout`` (seconds)
+        shortens the deadline but never extends it past ``STREAM_DEADLINE``;
+        ``ticket`` is its admission ticket, reported by ``status()``.
+        """
+        limits = [t for t in (timeout, STREAM_DEADLINE) if t and t > 0]
+        deadline = time.monotonic() + min(limits) if limits else None
+        file_path = await get_event_file_path(request_id)
+        if EVENT_PERSIST:
+            # 清理同名请求遗留的取消标记，.seen 存在表示流仍在运行
+            _remove_markers(file_path, ("cancel",))
+            touch_marker(marker_path(file_path, "seen"))
+
+        task = asyncio.create_task(coro)
+        self._tasks[request_id] = _StreamTask(request_id, task, deadline, file_path, ticket)
+        task.add_done_callback(lambda _: self.complete(request_id))
+        if self._watchdog is None or self._watchdog.done():
+            self._watchdog = asyncio.create_task(self._watch())
+        return task
+
+    async def launch(
+        self,
+        request_id: str,
+        list_type: str,
+        name: str,
+        prepare: Callable[[Ticket], Awaitable[Any]],
+        timeout: Optional[float] = None,
+    ) -> Ticket:
+        """
+        Reserve admission to ``name`` in ``list_type`` (HTTP 429 when full),
+        let ``prepare(ticket)`` save what the request needs and return the
+        producer coroutine, then open the event stream and start it. The slot
+        is returned if any step fails or the task ends.
+        """
+        # 目标服务的并发和队列都已满时直接返回 429
+        ticket = await reserve_stream(list_type, name)
+        try:
+            coro = await prepare(ticket)
+            try:
+                # 先创建事件流，避免轮询在任务启动前到达时返回 404
+                event_bus.open(request_id)
+                task = await self.start(request_id, coro, timeout, ticket)
+            except BaseException:
+                coro.close()
+                event_bus.discard(request_id)
+                raise
+        except BaseException:
+            ticket.release()
+            raise
+        # 任务在开始执行前就被取消时也要归还名额
+        task.add_done_callback(lambda _: ticket.release())
+        return ticket
+
+    def complete(self, request_id: str) -> None:
+        """
+        Called by the producer once its upstream phase is over, so that a late
+        cancel cannot interrupt saving the reply.
+        """
+        entry = self._tasks.pop(request_id, None)
+        if entry is not None and EVENT_PERSIST:
+            _remove_markers(entry.file_path, ("seen", "cancel"))
+
+    def status(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """``queued`` (with its queue position) or ``running`` for a stream of this process, else None."""
+        entry = self._tasks.get(request_id)
+        if entry is None:
+            return None
+        position = entry.ticket.position if entry.ticket is not None else None
+        if position is not None:
+            return {"request_id": request_id, "state": "queued", "queue_position": position}
+        return {"request_id": request_id, "state": "running", "queue_position": None}
+
+    def cancel_reason(self, request_id: str) -> Optional[str]:
+        entry = self._tasks.get(request_id)
+        return entry.reason if entry is not None else None
+
+    def cancel(self, request_id: str, reason: str = "cancelled") -> bool:
+        """Cancel the task of ``request_id`` in this process; False if there is none."""
+        entry = self._tasks.get(request_id)
+        if entry is None:
+            return False
+        if entry.reason is None:
+            entry.reason = reason
+            logger.info(f"Cancelling stream {request_id}: {reason}")
+            entry.task.cancel()
+        return True
+
+    async def request_cancel(self, request_id: str) -> Optional[str]:
+        """
+        Cancel ``request_id`` wherever it runs. Returns ``"cancelled"`` if it
+        ran here, ``"requested"`` if another process was asked to stop it via
+        the marker file, or None if the request is unknown or finished.
+        """
+        if self.cancel(request_id):
+            return "cancelled"
+        if event_bus.get(request_id) is not None:
+            # 本进程产生的流，已经结束
+            return None
+        file_path = await get_event_file_path(request_id)
+        if EVENT_PERSIST and os.path.exists(marker_path(file_path, "seen")):
+            touch_marker(marker_path(file_path, "cancel"))
+            return "requested"
+        return None
+
+    async def cancel_all(self, reason: str = "shutdown") -> None:
+        """Cancel every running stream and wait for them to save their replies."""
+        tasks = [entry.task for entry in self._tasks.values()]
+        for request_id in list(self._tasks):
+            self.cancel(request_id, reason)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _idle(self, entry: _StreamTask, now: float) -> bool:
+        stream = event_bus.get(entry.request_id)
+        if stream is None or now - stream.last_seen <= STREAM_IDLE_TIMEOUT:
+            return False
+        if EVENT_PERSIST:
+            try:
+                seen_at = os.path.getmtime(marker_path(entry.file_path, "seen"))
+            except OSError:
+                return True
+            return time.time() - seen_at > STREAM_IDLE_TIMEOUT
+        return True
+
+    async def _watch(self) -> None:
+        while self._tasks:
+            await asyncio.sleep(STREAM_WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            for entry in list(self._tasks.values()):
+                if entry.reason is not None:
+                    continue
+                if entry.deadline is not None and now > entry.deadline:
+                    self.cancel(entry.request_id, "timeout")
+                elif STREAM_IDLE_TIMEOUT > 0 and self._idle(entry, now):
+                    self.cancel(entry.request_id, "idle")
+                elif EVENT_PERSIST and os.path.exists(marker_path(entry.file_path, "cancel")):
+                    self.cancel(entry.request_id, "cancelled")
+
+
+stream_tasks = StreamTaskRegistry()
+
+
+def add_stream_routes(router: APIRouter, prefix: str) -> None:
+    """Register the cancel, status, SSE and poll endpoints of the streams under ``prefix``."""
+
+    @router.post(f"{prefix}/{{request_id}}/cancel")
+    async def cancel_message_stream(request_id: str):
+        """Stop generating the reply of ``request_id``; what was streamed so far is kept."""
+        status = await stream_tasks.request_cancel(request_id)
+        if status is None:
+            raise HTTPException(
+                status_code=404, detail=f"No running stream for request_id: {request_id}"
+            )
+        return {"request_id": request_id, "status": status}
+
+    # status / stream 需注册在 /{index} 路由之前，否则会被当作 index 解析
+    @router.get(f"{prefix}/{{request_id}}/status")
+    async def get_message_stream_status(request_id: str):
+        """Whether ``request_id`` is still queued for the target (and where) or running."""
+        status = stream_tasks.status(request_id)
+        if status is None:
+            raise HTTPException(
+                status_code=404, detail=f"No running stream for request_id: {request_id}"
+            )
+        return status
+
+    @router.get(f"{prefix}/{{request_id}}/stream")
+    async def stream_message_events(request: Request, request_id: str, index: int = 0):
+        """Push events as Server-Sent Events, resuming from ``index`` or Last-Event-ID."""
+        return await event_source(request, request_id, index)
+
+    @router.get(f"{prefix}/{{request_id}}/{{index}}", response_model=EventResponse)
+    async def get_message_events(request_id: str, index: int, wait: float = 0):
+        # wait > 0: 没有新事件时最多等待 wait 秒（长轮询）
+        events = await event_bus.read(request_id, index, wait=wait)
+        if events is None:
+            raise HTTPException(
+                status_code=404, detail=f"No events found for request_id: {request_id}"
+            )
+        return EventResponse(events=events)
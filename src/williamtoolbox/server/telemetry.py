@@ -0,0 +1,310 @@
+"""Latency, usage and error telemetry for streamed chat and search completions."""
+import os
+import time
+import bisect
+import asyncio
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+import aiofiles
+from loguru import logger
+from openai import NOT_GIVEN
+
+from ..context_window import count_tokens
+from ..routing import Route
+from ..storage import serialization
+
+# 设置后，每条记录追加写入该 JSONL 文件
+TELEMETRY_FILE = os.environ.get("WILLIAM_TOOLBOX_TELEMETRY_FILE", "")
+# 内存中保留的最近记录条数
+TELEMETRY_RECENT = int(os.environ.get("WILLIAM_TOOLBOX_TELEMETRY_RECENT", "1000"))
+
+# 直方图的桶上界（毫秒），最后一个桶收集更大的值
+LATENCY_BUCKETS_MS = (
+    1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+    1000, 2500, 5000, 10000, 30000, 60000, 120000, 300000,
+)
+
+
+def stream_options(route: Route):
+    """``stream_options`` argument for a completion to ``route``."""
+    return {"include_usage": True} if route.include_usage else NOT_GIVEN
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the ``q`` quantile (None when empty or in the overflow bucket)."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                **{str(bound): n for bound, n in zip(LATENCY_BUCKETS_MS, self.counts)},
+                "+Inf": self.counts[-1],
+            },
+        }
+
+
+class _TargetStats:
+    def __init__(self, list_type: str, name: str):
+        self.list_type = list_type
+        self.name = name
+        self.product_type = ""
+        self.requests = 0
+        self.status: Dict[str, int] = {}
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.cost = 0.0
+        # 生成阶段（首个 token 到结束）的总时长，用于计算吞吐
+        self.generation_seconds = 0.0
+        self.queue_wait_ms = Histogram()
+        self.ttft_ms = Histogram()
+        self.itl_ms = Histogram()
+        self.duration_ms = Histogram()
+        self.last_error: Optional[str] = None
+
+    def add(self, record: Dict[str, Any]) -> None:
+        self.product_type = record["product_type"] or self.product_type
+        self.requests += 1
+        self.status[record["status"]] = self.status.get(record["status"], 0) + 1
+        self.tokens_in += record["tokens_in"]
+        self.tokens_out += record["tokens_out"]
+        self.cost += record["cost"]
+        for field in ("queue_wait_ms", "ttft_ms", "itl_ms", "duration_ms"):
+            if record[field] is not None:
+                getattr(self, field).observe(record[field])
+        if record["ttft_ms"] is not None and record["duration_ms"] is not None:
+            self.generation_seconds += max(record["duration_ms"] - record["ttft_ms"], 0) / 1000
+        if record["error"]:
+            self.last_error = record["error"]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "list_type": self.list_type,
+            "name": self.name,
+            "product_type": self.product_type,
+            "requests": self.requests,
+            "status": dict(self.status),
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "cost": round(self.cost, 6),
+            "output_tokens_per_second": (
+                self.tokens_out / self.generation_seconds if self.generation_seconds else None
+            ),
+            "queue_wait_ms": self.queue_wait_ms.to_dict(),
+            "ttft_ms": self.ttft_ms.to_dict(),
+            "itl_ms": self.itl_ms.to_dict(),
+            "duration_ms": self.duration_ms.to_dict(),
+            "last_error": self.last_error,
+        }
+
+
+class Telemetry:
+    def __init__(self):
+        self._targets: Dict[Tuple[str, str], _TargetStats] = {}
+        self._users: Dict[str, Dict[str, float]] = {}
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=TELEMETRY_RECENT)
+        self._pending: List[str] = []
+        self._writer: Optional[asyncio.Task] = None
+        self.started_at = datetime.now().isoformat()
+
+    def record(self, record: Dict[str, Any]) -> None:
+        key = (record["list_type"], record["name"])
+        stats = self._targets.get(key)
+        if stats is None:
+            stats = self._targets[key] = _TargetStats(*key)
+        stats.add(record)
+
+        user = self._users.setdefault(
+            record["username"], {"requests": 0, "errors": 0, "tokens_in": 0, "tokens_out": 0, "cost": 0.0}
+        )
+        user["requests"] += 1
+        user["errors"] += record["status"] == "error"
+        user["tokens_in"] += record["tokens_in"]
+        user["tokens_out"] += record["tokens_out"]
+        user["cost"] += record["cost"]
+
+        self._recent.append(record)
+        if TELEMETRY_FILE:
+            self._export(record)
+
+    def _export(self, record: Dict[str, Any]) -> None:
+        self._pending.append(serialization.dumps(record) + "\n")
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write())
+
+    async def _write(self) -> None:
+        # 一次写入期间积累的记录在下一轮批量写入
+        while self._pending:
+            lines, self._pending = self._pending, []
+            try:
+                async with aiofiles.open(TELEMETRY_FILE, "a", encoding="utf-8") as f:
+                    await f.write("".join(lines))
+            except Exception as e:
+                logger.warning(f"Failed to export {len(lines)} telemetry records: {e}")
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "since": self.started_at,
+            "targets": [stats.to_dict() for stats in self._targets.values()],
+            "users": {
+                username: {**totals, "cost": round(totals["cost"], 6)}
+                for username, totals in self._users.items()
+            },
+        }
+
+    def recent(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        records = list(self._recent)
+        return records[-limit:] if limit else records
+
+
+telemetry = Telemetry()
+# 正在后台估算 token 数的记录，保留引用以免任务被回收
+_estimating: Set[asyncio.Task] = set()
+
+
+class StreamMeter:
+    """Timing and usage of one streamed completion."""
+
+    def __init__(self, kind: str, request_id: str, username: str, list_type: str, name: str):
+        self.kind = kind
+        self.request_id = request_id
+        self.username = username
+        self.list_type = list_type
+        self.name = name
+        self.route: Optional[Route] = None
+        self.created_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.sent_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        # 本地估算的提示词 token 数（ContextWindow.prompt_tokens），后端未返回 usage 时使用
+        self.prompt_tokens = 0
+        self.parts: List[str] = []
+        self.usage = None
+        self._finished = False
+
+    def admitted(self) -> None:
+        self.admitted_at = time.monotonic()
+
+    def sent(self, route: Route, prompt_tokens: int) -> None:
+        """Call right before the upstream request; TTFT is measured from here."""
+        self.route = route
+        self.prompt_tokens = prompt_tokens
+        self.sent_at = time.monotonic()
+
+    def wrap(self, stream):
+        """Iterate ``stream`` while recording token times and usage; drops usage-only chunks."""
+        return _MeteredStream(stream, self)
+
+    def _chunk(self, chunk) -> bool:
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:
+            self.usage = usage
+        if not chunk.choices:
+            # include_usage 时最后一个 chunk 只带 usage，没有 choices
+            return False
+        delta = chunk.choices[0].delta
+        text = delta.content or getattr(delta, "reasoning_content", None)
+        if text:
+            now = time.monotonic()
+            if self.first_token_at is None:
+                self.first_token_at = now
+            self.last_token_at = now
+            self.parts.append(text)
+        return True
+
+    def finish(self, status: str = "ok", error: Optional[str] = None) -> None:
+        """Record the request once; ``status`` is ``ok``, ``error`` or ``cancelled``."""
+        if self._finished:
+            return
+        self._finished = True
+        now = time.monotonic()
+        ms = lambda start, end: round((end - start) * 1000, 3) if start is not None and end is not None else None
+        route = self.route
+        record = {
+            "timestamp": datetime.now().isoformat(),
+            "kind": self.kind,
+            "request_id": self.request_id,
+            "username": self.username,
+            "list_type": self.list_type,
+            "name": self.name,
+            "product_type": route.product_type if route is not None else "",
+            "status": status,
+            "error": error,
+            "queue_wait_ms": ms(self.created_at, self.admitted_at),
+            "ttft_ms": ms(self.sent_at, self.first_token_at),
+            "itl_ms": None,
+            "duration_ms": ms(self.sent_at, now),
+        }
+        if self.usage is not None:
+            self._record(record, self.usage.prompt_tokens or 0, self.usage.completion_tokens or 0, "upstream")
+        elif not self.parts:
+            self._record(record, self.prompt_tokens, 0, "estimate")
+        else:
+            # 长回答的本地计数较慢，放到线程中，不阻塞事件循环
+            task = asyncio.create_task(self._record_estimate(record))
+            _estimating.add(task)
+            task.add_done_callback(_estimating.discard)
+
+    async def _record_estimate(self, record: Dict[str, Any]) -> None:
+        try:
+            tokens_out = await asyncio.to_thread(count_tokens, "".join(self.parts))
+        except Exception as e:
+            logger.warning(f"Failed to count reply tokens of {self.request_id}: {e}")
+            tokens_out = 0
+        self._record(record, self.prompt_tokens, tokens_out, "estimate")
+
+    def _record(self, record: Dict[str, Any], tokens_in: int, tokens_out: int, usage_source: str) -> None:
+        itl_ms = None
+        if self.first_token_at is not None and tokens_out > 1:
+            itl_ms = round((self.last_token_at - self.first_token_at) * 1000 / (tokens_out - 1), 3)
+        cost = 0.0
+        if self.route is not None:
+            cost = (tokens_in * self.route.input_price + tokens_out * self.route.output_price) / 1_000_000
+        record.update(
+            itl_ms=itl_ms, tokens_in=tokens_in, tokens_out=tokens_out, usage_source=usage_source, cost=cost
+        )
+        telemetry.record(record)
+
+
+class _MeteredStream:
+    def __init__(self, stream, meter: StreamMeter):
+        self._stream = stream
+        self._meter = meter
+
+    @property
+    def response(self):
+        return self._stream.response
+
+    async def close(self) -> None:
+        await self._stream.close()
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            if self._meter._chunk(chunk):
+                yield chunk
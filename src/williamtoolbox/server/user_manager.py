@@ -1,51 +1,43 @@
-import json
 import os
 import hashlib
 from typing import Dict, List, Optional
-import aiofiles
-from ..storage.json_file import with_file_lock
+from ..storage.json_file import USERS_JSON_PATH, load_users, save_users, get_sqlite_store
+
+
+def _default_users() -> Dict:
+    return {
+        "admin": {
+            "password": "admin",
+            "is_admin": True,
+            "first_login": True,
+            "permissions": ["*"],
+            "model_permissions": ["*"],
+            "rag_permissions": ["*"]
+        }
+    }
 
 
 class UserManager:
     def __init__(self):
-        self.user_file = "./users.json"
-        self._ensure_user_file()
-
-    def _ensure_user_file(self):
-        if not os.path.exists(self.user_file):
-            with open(self.user_file, 'w') as f:
-                json.dump({
-                    "admin": {
-                        "password": "admin",
-                        "is_admin": True,
-                        "first_login": True,
-                        "permissions": ["*"],
-                        "model_permissions": ["*"],
-                        "rag_permissions": ["*"]
-                    }
-                }, f, indent=2)
+        self.user_file = USERS_JSON_PATH
 
     def _hash_password(self, password: str) -> str:
         return hashlib.sha256(password.encode()).hexdigest()
 
     async def _load_users(self) -> Dict:
-        async with with_file_lock(self.user_file):
-            if os.path.exists(self.user_file):
-                async with aiofiles.open(self.user_file, "r") as f:
-                    content = await f.read()
-                    users = json.loads(content)
-                    # Ensure admin always has full permissions
-                    if "admin" in users:
-                        users["admin"]["model_permissions"] = ["*"]
-                        users["admin"]["rag_permissions"] = ["*"]
-                    return users
-            return {}
+        users = await load_users()
+        if not users and (get_sqlite_store() is not None or not os.path.exists(self.user_file)):
+            # 还没有用户（新建的数据库或 users.json 不存在），首次使用时写入默认管理员
+            users = _default_users()
+            await save_users(users)
+        # Ensure admin always has full permissions
+        if "admin" in users:
+            users["admin"]["model_permissions"] = ["*"]
+            users["admin"]["rag_permissions"] = ["*"]
+        return users
 
     async def _save_users(self, users: Dict):
-        async with with_file_lock(self.user_file):
-            async with aiofiles.open(self.user_file, "w") as f:
-                content = json.dumps(users, indent=2, ensure_ascii=False)
-                await f.write(content)
+        await save_users(users)
 
     async def authenticate(self, username: str, password: str) -> tuple[bool, bool, List[str]]:
         users = await self._load_users()
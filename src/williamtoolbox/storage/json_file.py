@@ -1,47 +1,164 @@
 import os
-import json
+import tempfile
 import aiofiles
 import aiofiles.os
 import asyncio
 from contextlib import asynccontextmanager
-import asyncio
-import aiofiles
-from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, NamedTuple, Tuple, List, Callable
+from types import MappingProxyType
 from datetime import datetime, timedelta
+import time
 import uuid
+import hashlib
+import bisect
+import weakref
+from collections import OrderedDict
+import psutil
+from loguru import logger
+
+from . import serialization
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 锁被占用时轮询的初始和最大间隔（秒），每次翻倍
+LOCK_POLL_MIN = 0.0005
+LOCK_POLL_MAX = 0.025
+
 
 class AsyncFileLock:
-    def __init__(self, lock_file: str):
+    """
+    Cross-process reader-writer advisory lock on ``<file>.lock``.
+
+    Uses ``fcntl.flock`` where available and the ``filelock`` package
+    elsewhere. Acquisition never blocks a thread: a held lock is retried with
+    ``LOCK_NB`` and exponential backoff. Exclusive waiters of one process
+    first queue on a per-path ``asyncio.Lock``, so only one of them polls and
+    the next is woken as soon as the holder releases. The lock belongs to the
+    open file descriptor: when the holder dies the OS drops it, so a crashed
+    process cannot leave a stale lock behind. The holder writes its PID into
+    the lock file, which is reported when acquisition times out.
+
+    With ``shared=True`` any number of readers may hold the lock at once; only
+    exclusive (writer) holders are mutually exclusive. The ``filelock``
+    fallback has no shared mode and always locks exclusively.
+
+    ``on_wait``, if set, is called with ``(lock_file, shared, seconds)`` after
+    every successful acquisition; the benchmarks use it to measure lock wait.
+    """
+
+    on_wait: Optional[Callable[[str, bool, float], None]] = None
+    _gates: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def __init__(self, lock_file: str, shared: bool = False):
         self.lock_file = Path(lock_file+".lock")
-        self._lock = asyncio.Lock()
-        self._lock_handle = None  # 初始化为 None
+        self.shared = shared
+        self._fd = None
+        self._fallback_lock = None
+        self._gate: Optional[asyncio.Lock] = None
+
+    def _try_acquire(self):
+        """Take the lock without blocking; None if it is held elsewhere."""
+        if fcntl is None:
+            from filelock import FileLock, Timeout
+
+            lock = FileLock(str(self.lock_file))
+            try:
+                lock.acquire(timeout=0)
+            except Timeout:
+                return None
+            return lock
+
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+            if not self.shared:
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, str(os.getpid()).encode(), 0)
+        except BaseException as e:
+            os.close(fd)
+            if isinstance(e, BlockingIOError):
+                return None
+            raise
+        return fd
+
+    @staticmethod
+    def _release_handle(handle):
+        if handle is None:
+            return
+        if isinstance(handle, int):
+            # 关闭文件描述符即释放 flock；锁文件保留，删除它会与其他等待者产生竞争
+            os.close(handle)
+        else:
+            handle.release()
+
+    def holder_pid(self) -> Optional[int]:
+        """PID recorded by the last holder of the lock, if any."""
+        try:
+            with open(self.lock_file, "r") as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+    def _timeout_error(self, timeout: float) -> TimeoutError:
+        pid = self.holder_pid()
+        holder = ""
+        if pid is not None:
+            holder = f" (held by pid {pid}, {'alive' if psutil.pid_exists(pid) else 'not running'})"
+        return TimeoutError(f"Could not acquire lock within {timeout} seconds for {self.lock_file}{holder}")
 
     async def acquire(self, timeout: int = 30):
-        async with self._lock:  # 确保线程安全
-            start_time = asyncio.get_running_loop().time()
+        started = time.perf_counter()
+        deadline = started + timeout
+        if not self.shared:
+            key = str(self.lock_file)
+            gate = AsyncFileLock._gates.get(key)
+            if gate is None:
+                gate = AsyncFileLock._gates[key] = asyncio.Lock()
+            try:
+                await asyncio.wait_for(gate.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise self._timeout_error(timeout) from None
+            self._gate = gate
+        try:
+            delay = LOCK_POLL_MIN
             while True:
-                try:
-                    # 尝试创建锁文件
-                    self._lock_handle = await aiofiles.open(self.lock_file, mode="x")
+                handle = self._try_acquire()
+                if handle is not None:
                     break
-                except FileExistsError:
-                    # 如果锁文件存在，等待一小段时间重试
-                    if asyncio.get_running_loop().time() - start_time > timeout:
-                        raise TimeoutError(f"Could not acquire lock within {timeout} seconds for {self.lock_file}")
-                    await asyncio.sleep(0.1)
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise self._timeout_error(timeout)
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, LOCK_POLL_MAX)
+        except BaseException:
+            self._release_gate()
+            raise
+        if isinstance(handle, int):
+            self._fd = handle
+        else:
+            self._fallback_lock = handle
+        if AsyncFileLock.on_wait is not None:
+            AsyncFileLock.on_wait(str(self.lock_file), self.shared, time.perf_counter() - started)
+
+    def _release_gate(self):
+        gate, self._gate = self._gate, None
+        if gate is not None:
+            gate.release()
 
     async def release(self):
-        async with self._lock:  # 确保线程安全
-            if self._lock_handle:
-                await self._lock_handle.close()  # 关闭锁文件
-                self.lock_file.unlink()  # 删除锁文件
-                self._lock_handle = None  # 重置
+        handle, self._fd = self._fd, None
+        fallback, self._fallback_lock = self._fallback_lock, None
+        self._release_handle(handle)
+        self._release_handle(fallback)
+        self._release_gate()
 
 @asynccontextmanager
-async def with_file_lock(file_path: str, timeout: int = 30):
-    lock = AsyncFileLock(file_path)
+async def with_file_lock(file_path: str, timeout: int = 30, shared: bool = False):
+    lock = AsyncFileLock(file_path, shared=shared)
     try:
         await lock.acquire(timeout=timeout)
         yield
@@ -49,6 +166,536 @@ async def with_file_lock(file_path: str, timeout: int = 30):
         await lock.release()
 
 
+def _atomic_write_text(file_path: str, content: str) -> None:
+    """
+    Write ``content`` to a temp file next to ``file_path`` and rename it into
+    place, so readers only ever see the old or the new file, never a partial one.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(file_path)}.", suffix=".tmp", dir=directory
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        try:
+            os.chmod(tmp_path, os.stat(file_path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+async def atomic_write_text(file_path: str, content: str) -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _atomic_write_text, file_path, content)
+
+
+def _copy_json(value):
+    """Cheap structural copy of a parsed JSON document (dicts/lists only)."""
+    if isinstance(value, dict):
+        return {k: _copy_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(v) for v in value]
+    return value
+
+
+def _freeze(value):
+    """Turn a parsed JSON document into a read-only view (mappingproxy/tuple)."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class FileSignature(NamedTuple):
+    mtime_ns: int
+    size: int
+    inode: int
+
+
+def _file_signature(file_path: str) -> Optional[FileSignature]:
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return FileSignature(st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _content_digest(content: str) -> bytes:
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+
+class _RegistryEntry:
+    __slots__ = ("signature", "data", "content_digest", "_derived")
+
+    def __init__(self, signature: FileSignature, data: Any, content_digest: Optional[bytes] = None):
+        self.signature = signature
+        self.data = data
+        # digest of the file content this entry was read from / written as
+        self.content_digest = content_digest
+        self._derived: Dict[str, Any] = {}
+
+    def derived(self, key: str, build):
+        """Return a value computed from this version of the document, built at most once."""
+        if key not in self._derived:
+            self._derived[key] = build(self.data)
+        return self._derived[key]
+
+    def snapshot(self):
+        return self.derived("snapshot", _freeze)
+
+
+class RegistryCache:
+    """In-process write-through cache for the JSON registry files."""
+
+    # 按文件路径缓存，用 mtime/size/inode 校验，其他进程的修改在下次读取时生效；
+    # load_* 调用方拿到可修改的副本，只读调用方共享冻结的快照
+
+    def __init__(self):
+        self._entries: Dict[str, _RegistryEntry] = {}
+        self._listeners: List[Callable[[str], None]] = []
+
+    def add_listener(self, callback: Callable[[str], None]) -> None:
+        """
+        Call ``callback(registry_name)`` whenever a cached document is
+        replaced by a different version (``models``, ``rags``, ...), whether
+        it was saved here or changed by another process and reloaded.
+        """
+        self._listeners.append(callback)
+
+    def lookup(self, file_path: str, signature: Optional[FileSignature]) -> Optional[_RegistryEntry]:
+        entry = self._entries.get(file_path)
+        if entry is None or signature is None or entry.signature != signature:
+            return None
+        return entry
+
+    def peek(self, file_path: str) -> Optional[_RegistryEntry]:
+        """The last cached entry for ``file_path``, without checking that it is current."""
+        return self._entries.get(file_path)
+
+    def store(
+        self, file_path: str, signature: FileSignature, data: Any, content_digest: Optional[bytes] = None
+    ) -> _RegistryEntry:
+        entry = _RegistryEntry(signature, data, content_digest)
+        previous = self._entries.get(file_path)
+        self._entries[file_path] = entry
+        if previous is not None and previous.signature != signature:
+            name = file_path[len("sqlite:"):] if file_path.startswith("sqlite:") else _registry_name(file_path)
+            for callback in self._listeners:
+                try:
+                    callback(name)
+                except Exception as e:
+                    logger.error(f"Registry change listener failed for {name}: {e}")
+        return entry
+
+    def invalidate(self, file_path: Optional[str] = None) -> None:
+        if file_path is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(file_path, None)
+
+
+registry_cache = RegistryCache()
+
+
+# Optional SQLite engine. When configured, every registry and chat function in
+# this module reads and writes the database instead of the JSON files.
+# 启动时由 backend_server 配置一次，导入本模块不会创建任何存储
+_sqlite_store = None
+_storage_config: Optional[Tuple[str, str]] = None
+
+
+def configure_storage(backend: str = "json", sqlite_path: str = "williamtoolbox.db") -> None:
+    """Select the storage engine: ``json`` (default) or ``sqlite``. Repeating the same choice is a no-op."""
+    global _sqlite_store, _storage_config
+    # fork 出的子进程不能沿用父进程的 SQLiteStore
+    if _storage_config == (backend, sqlite_path) and (_sqlite_store is None or _sqlite_store.pid == os.getpid()):
+        return
+    if backend == "sqlite":
+        from .sqlite_store import SQLiteStore
+
+        _sqlite_store = SQLiteStore(sqlite_path)
+    elif backend == "json":
+        _sqlite_store = None
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    _storage_config = (backend, sqlite_path)
+    registry_cache.invalidate()
+
+
+def configure_storage_from_env() -> None:
+    """Apply the backend exported by ``backend_server.main`` (uvicorn workers are separate processes)."""
+    configure_storage(
+        os.environ.get("WILLIAM_TOOLBOX_STORAGE", "json"),
+        os.environ.get("WILLIAM_TOOLBOX_SQLITE_PATH", "williamtoolbox.db"),
+    )
+
+
+def get_sqlite_store():
+    return _sqlite_store
+
+
+def _registry_name(file_path: str) -> str:
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+
+async def _load_sqlite_registry_entry(file_path: str) -> Optional[_RegistryEntry]:
+    registry = _registry_name(file_path)
+    cache_key = f"sqlite:{registry}"
+    entry = registry_cache.lookup(cache_key, await _sqlite_store.registry_version(registry))
+    if entry is not None:
+        return entry
+    version, data = await _sqlite_store.load_registry(registry)
+    if version is None:
+        registry_cache.invalidate(cache_key)
+        return None
+    return registry_cache.store(cache_key, version, data)
+
+
+async def _load_registry_entry(file_path: str) -> Optional[_RegistryEntry]:
+    """Return the cached entry for ``file_path``, reading the file only if it changed."""
+    if _sqlite_store is not None:
+        return await _load_sqlite_registry_entry(file_path)
+
+    entry = registry_cache.lookup(file_path, _file_signature(file_path))
+    if entry is not None:
+        return entry
+
+    # Saves replace the file atomically, so readers only need to keep writers
+    # out while they stat and read; they never block each other.
+    async with with_file_lock(file_path, shared=True):
+        return await _read_registry_entry(file_path)
+
+
+async def _read_registry_entry(file_path: str) -> Optional[_RegistryEntry]:
+    """Read ``file_path`` through the cache; the caller must hold its lock."""
+    signature = _file_signature(file_path)
+    entry = registry_cache.lookup(file_path, signature)
+    if entry is not None:
+        return entry
+    if signature is None:
+        registry_cache.invalidate(file_path)
+        return None
+    async with aiofiles.open(file_path, "r") as f:
+        content = await f.read()
+    return registry_cache.store(file_path, signature, serialization.loads(content), _content_digest(content))
+
+
+async def _load_registry(file_path: str, default: Any = None) -> Any:
+    entry = await _load_registry_entry(file_path)
+    if entry is None:
+        return {} if default is None else default
+    return _copy_json(entry.data)
+
+
+_EMPTY_SNAPSHOT = MappingProxyType({})
+
+
+async def _snapshot_registry(file_path: str):
+    entry = await _load_registry_entry(file_path)
+    if entry is None:
+        return _EMPTY_SNAPSHOT
+    return entry.snapshot()
+
+
+def _registry_unchanged(file_path: str, digest: bytes) -> bool:
+    """True if ``file_path`` still holds exactly the content with ``digest``."""
+    entry = registry_cache.lookup(file_path, _file_signature(file_path))
+    return entry is not None and entry.content_digest == digest
+
+
+async def _write_registry(
+    file_path: str, data: Any, indent: Optional[int] = None, content: Optional[str] = None
+) -> None:
+    """
+    Write ``data`` (already serialized as ``content`` if given) and make it the
+    cached document; the caller must hold the exclusive lock. Skipped when the
+    file already has this exact content.
+    """
+    if content is None:
+        content = serialization.dumps(data, indent=indent)
+    digest = _content_digest(content)
+    if _registry_unchanged(file_path, digest):
+        return
+    await atomic_write_text(file_path, content)
+    # Write-through: the saved object becomes the cached document.
+    registry_cache.store(file_path, _file_signature(file_path), _copy_json(data), digest)
+
+
+# 同一 registry 在该时间窗口内的连续保存合并为一次写入（秒）
+SAVE_COALESCE_WINDOW = 0.05
+
+
+class _PendingSave:
+    __slots__ = ("data", "content", "flush_now", "done")
+
+    def __init__(self):
+        self.data = None
+        self.content: Optional[str] = None
+        self.flush_now = asyncio.Event()
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class RegistryWriter:
+    """Group commit for registry saves."""
+
+    # 第一次保存开启批次，SAVE_COALESCE_WINDOW 秒后写盘，期间的保存替换批次内容，
+    # 所有调用方在批次落盘后返回；同一 registry 的批次按顺序提交，内容未变的保存直接返回
+
+    def __init__(self):
+        self._pending: Dict[str, _PendingSave] = {}
+        self._committing: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def _unchanged(file_path: str, data: Any, content: Optional[str]) -> bool:
+        if _sqlite_store is not None:
+            # Compared with the last version this process saw, without a
+            # query, so the save is still queued in call order. If another
+            # worker changed the row since, skipping is equivalent to this
+            # save having landed just before theirs.
+            entry = registry_cache.peek(f"sqlite:{_registry_name(file_path)}")
+            return entry is not None and entry.data == data
+        return _registry_unchanged(file_path, _content_digest(content))
+
+    async def save(self, file_path: str, data: Any, indent: Optional[int] = None) -> None:
+        content = None if _sqlite_store is not None else serialization.dumps(data, indent=indent)
+        if (
+            file_path not in self._pending
+            and file_path not in self._committing
+            and self._unchanged(file_path, data, content)
+        ):
+            return
+
+        pending = self._pending.get(file_path)
+        if pending is None:
+            pending = self._pending[file_path] = _PendingSave()
+            asyncio.ensure_future(self._commit_later(file_path, pending))
+        # callers may keep mutating ``data`` after save returns
+        pending.data = _copy_json(data)
+        pending.content = content
+        await asyncio.shield(pending.done)
+
+    async def _commit_later(self, file_path: str, pending: _PendingSave) -> None:
+        try:
+            await asyncio.wait_for(pending.flush_now.wait(), SAVE_COALESCE_WINDOW)
+        except asyncio.TimeoutError:
+            pass
+        previous = self._committing.get(file_path)
+        if previous is not None:
+            await asyncio.wait([previous])
+        # From here on new saves start the next batch
+        del self._pending[file_path]
+        self._committing[file_path] = pending.done
+        try:
+            await _commit_registry(file_path, pending.data, pending.content)
+        except Exception as e:
+            logger.error(f"Failed to save {file_path}: {e}")
+            pending.done.set_exception(e)
+            # 调用方可能都已取消，避免 "exception was never retrieved"
+            pending.done.exception()
+        else:
+            pending.done.set_result(None)
+        finally:
+            if self._committing.get(file_path) is pending.done:
+                del self._committing[file_path]
+
+    async def flush(self, file_path: Optional[str] = None) -> None:
+        """Write pending batches now (all registries if ``file_path`` is None) and wait for them."""
+        paths = [file_path] if file_path is not None else list(set(self._pending) | set(self._committing))
+        waiters = []
+        for path in paths:
+            pending = self._pending.get(path)
+            if pending is not None:
+                pending.flush_now.set()
+                waiters.append(pending.done)
+            elif path in self._committing:
+                waiters.append(self._committing[path])
+        if waiters:
+            await asyncio.wait(waiters)
+
+
+registry_writer = RegistryWriter()
+
+
+async def flush_pending_writes() -> None:
+    """Flush coalesced registry saves; call on shutdown."""
+    await registry_writer.flush()
+
+
+async def _commit_registry(file_path: str, data: Any, content: Optional[str]) -> None:
+    if _sqlite_store is not None:
+        registry = _registry_name(file_path)
+        version = await _sqlite_store.save_registry(registry, data)
+        registry_cache.store(f"sqlite:{registry}", version, data)
+        return
+
+    async with with_file_lock(file_path):
+        await _write_registry(file_path, data, content=content)
+
+
+async def _save_registry(file_path: str, data: Any, indent: Optional[int] = None) -> None:
+    await registry_writer.save(file_path, data, indent=indent)
+
+
+async def _update_registry(file_path: str, update, default: Any = None) -> Any:
+    """
+    Read-modify-write ``file_path`` under one exclusive lock.
+
+    ``update`` receives a private copy of the current document, mutates it
+    in place and may return a value, which is passed back to the caller.
+    """
+    # a coalesced save still in flight would otherwise overwrite this update
+    await registry_writer.flush(file_path)
+
+    if _sqlite_store is not None:
+        registry = _registry_name(file_path)
+        version, data, result = await _sqlite_store.update_registry(registry, update, default)
+        registry_cache.store(f"sqlite:{registry}", version, data)
+        return result
+
+    async with with_file_lock(file_path):
+        entry = await _read_registry_entry(file_path)
+        if entry is None:
+            data = {} if default is None else default
+        else:
+            data = _copy_json(entry.data)
+        result = update(data)
+        await _write_registry(file_path, data)
+        return result
+
+
+# 追加日志的日志文件超过该大小且大于快照时触发合并
+JOURNAL_COMPACT_MIN_BYTES = 64 * 1024
+
+
+def _trim_torn_tail(path: str, block: int = 65536) -> None:
+    """Cut a journal back to its last newline, dropping a line torn by a crash."""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return
+    try:
+        end = os.fstat(fd).st_size
+        if end == 0 or os.pread(fd, 1, end - 1) == b"\n":
+            return
+        position = end
+        while position > 0:
+            start = max(position - block, 0)
+            newline = os.pread(fd, position - start, start).rfind(b"\n")
+            if newline >= 0:
+                os.ftruncate(fd, start + newline + 1)
+                return
+            position = start
+        os.ftruncate(fd, 0)
+    finally:
+        os.close(fd)
+
+
+class JsonJournal:
+    """A JSON document stored as a snapshot file plus an append-only JSONL journal."""
+
+    # 日志超过快照大小时合并为新快照；合并中途崩溃会重放同一批操作，所以操作必须幂等。
+    # 除 load / load_entry 外的方法要求调用方持有 file_path 的排他锁
+
+    def __init__(self, file_path: str, replay: Callable[[Any, List[Dict[str, Any]]], Any], cached: bool = False):
+        self.file_path = file_path
+        self.journal_path = file_path + ".journal"
+        self.replay = replay
+        self.cached = cached
+
+    def _signature(self):
+        return (_file_signature(self.file_path), _file_signature(self.journal_path))
+
+    async def read(self) -> Optional[Any]:
+        """Current document (owned by the caller), or None if there is no snapshot."""
+        signature = self._signature()
+        if signature[0] is None:
+            return None
+        if self.cached:
+            entry = registry_cache.lookup(self.file_path, signature)
+            if entry is not None:
+                return _copy_json(entry.data)
+
+        async with aiofiles.open(self.file_path, "r") as f:
+            document = serialization.loads(await f.read())
+        ops = []
+        if signature[1] is not None:
+            async with aiofiles.open(self.journal_path, "r") as f:
+                for line in (await f.read()).splitlines():
+                    if not line.strip():
+                        continue
+                    try:
+                        ops.append(serialization.loads(line))
+                    except ValueError:
+                        # 进程崩溃可能留下不完整的最后一行，忽略即可（下次 append 前会截掉）
+                        continue
+        document = self.replay(document, ops)
+        if self.cached:
+            registry_cache.store(self.file_path, signature, _copy_json(document))
+        return document
+
+    async def load(self) -> Optional[Any]:
+        async with with_file_lock(self.file_path, shared=True):
+            return await self.read()
+
+    async def load_entry(self) -> Optional[_RegistryEntry]:
+        """
+        The cache entry of the current document, without copying it
+        (``cached=True`` only). Its data must not be modified.
+        """
+        async with with_file_lock(self.file_path, shared=True):
+            signature = self._signature()
+            if signature[0] is None:
+                return None
+            entry = registry_cache.lookup(self.file_path, signature)
+            if entry is None:
+                await self.read()
+                entry = registry_cache.peek(self.file_path)
+            return entry
+
+    async def write(self, document: Any) -> None:
+        """Replace the document with a fresh snapshot and drop the journal."""
+        await atomic_write_text(self.file_path, serialization.dumps(document))
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+        if self.cached:
+            registry_cache.store(self.file_path, self._signature(), _copy_json(document))
+
+    async def append(self, ops: List[Dict[str, Any]], document: Any) -> None:
+        """
+        Append ``ops``. ``document`` is the state after applying them, used to
+        refresh the cache and as the new snapshot if the journal gets compacted.
+        """
+        content = "".join(serialization.dumps(op) + "\n" for op in ops)
+        _trim_torn_tail(self.journal_path)
+        async with aiofiles.open(self.journal_path, "a") as f:
+            await f.write(content)
+
+        snapshot_signature, journal_signature = self._signature()
+        if journal_signature.size > max(JOURNAL_COMPACT_MIN_BYTES, snapshot_signature.size):
+            await self.write(document)
+        elif self.cached:
+            registry_cache.store(self.file_path, (snapshot_signature, journal_signature), _copy_json(document))
+
+    async def remove(self) -> None:
+        for path in (self.file_path, self.journal_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if self.cached:
+            registry_cache.invalidate(self.file_path)
+
+
 # Path to the models.json file
 MODELS_JSON_PATH = "models.json"
 RAGS_JSON_PATH = "rags.json"
@@ -56,77 +703,421 @@ SUPER_ANALYSIS_JSON_PATH = "super_analysis.json"
 
 # Path to the chat.json file
 CHAT_JSON_PATH = "chat.json"
+CHAT_DATA_DIR = "chat_data"
+DEFAULT_CONVERSATION_TITLE = "新的聊天"
 
+# 聊天记录按会话拆分存储：
+#   chat_data/<user>/index.json              会话索引（id、标题、时间、消息数）
+#   chat_data/<user>/conversations/<id>.json 单个会话的完整内容
+# 两者都带有 .journal 追加日志（见 JsonJournal），追加消息只写一行。
+# 旧版的 chat_data/<user>/chat.json 会在首次访问时自动迁移。
 
-# Function to load chat data from JSON file for a specific user
-async def load_chat_data(username: str):
-    chat_dir = os.path.join("chat_data", username)
-    chat_file = os.path.join(chat_dir, "chat.json")
-    os.makedirs(chat_dir, exist_ok=True)        
-    if os.path.exists(chat_file):
-        async with aiofiles.open(chat_file, "r") as f:
-            content = await f.read()
-            return json.loads(content)
-    return {"conversations": []}
 
+def _chat_dir(username: str) -> str:
+    return os.path.join(CHAT_DATA_DIR, username)
 
-# Function to save chat data to JSON file for a specific user
-async def save_chat_data(username: str, data):
-    chat_dir = os.path.join("chat_data", username)
-    chat_file = os.path.join(chat_dir, "chat.json")
-    os.makedirs(chat_dir, exist_ok=True)
-    
-    async with with_file_lock(chat_file):
-        async with aiofiles.open(chat_file, "w") as f:
-            content = json.dumps(data, ensure_ascii=False)
-            await f.write(content)
+
+def _chat_index_path(username: str) -> str:
+    return os.path.join(_chat_dir(username), "index.json")
+
+
+def _conversation_path(username: str, conversation_id: str) -> str:
+    if not conversation_id or conversation_id in (".", "..") or os.path.basename(conversation_id) != conversation_id:
+        raise ValueError(f"Invalid conversation id: {conversation_id}")
+    return os.path.join(_chat_dir(username), "conversations", f"{conversation_id}.json")
+
+
+def _replay_chat_index(index: Dict[str, Any], ops: List[Dict[str, Any]]) -> Dict[str, Any]:
+    for op in ops:
+        if op["op"] == "put":
+            index[op["meta"]["id"]] = op["meta"]
+        elif op["op"] == "delete":
+            index.pop(op["id"], None)
+    return index
+
+
+def _replay_conversation(conversation: Dict[str, Any], ops: List[Dict[str, Any]]) -> Dict[str, Any]:
+    positions = None
+    for op in ops:
+        if op["op"] == "message":
+            # 按消息 id 覆盖或追加，重复回放结果不变
+            if positions is None:
+                positions = {msg["id"]: i for i, msg in enumerate(conversation["messages"])}
+            message = op["message"]
+            position = positions.get(message["id"])
+            if position is None:
+                positions[message["id"]] = len(conversation["messages"])
+                conversation["messages"].append(message)
+            else:
+                conversation["messages"][position] = message
+        elif op["op"] == "update":
+            conversation.update(op["fields"])
+    return conversation
+
+
+def _chat_index_journal(username: str) -> JsonJournal:
+    return JsonJournal(_chat_index_path(username), _replay_chat_index, cached=True)
+
+
+def _conversation_journal(username: str, conversation_id: str) -> JsonJournal:
+    return JsonJournal(_conversation_path(username, conversation_id), _replay_conversation)
+
+
+def conversation_display_title(conversation: Dict[str, Any]) -> str:
+    title = conversation.get("title", "")
+
+    # If title is empty or default, use first user message as title
+    if not title or title == DEFAULT_CONVERSATION_TITLE:
+        for msg in conversation.get("messages", []):
+            if msg["role"] == "user" and msg["content"]:
+                # Truncate message if too long (30 characters max)
+                title = msg["content"][:30] + ("..." if len(msg["content"]) > 30 else "")
+                break
+    return title
+
+
+def _conversation_meta(conversation: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": conversation["id"],
+        "title": conversation.get("title", ""),
+        "display_title": conversation_display_title(conversation),
+        "created_at": conversation["created_at"],
+        "updated_at": conversation["updated_at"],
+        "message_count": len(conversation.get("messages", [])),
+    }
+
+
+async def _ensure_chat_layout(username: str) -> None:
+    """Create the per-user chat directory, migrating a legacy chat.json if present."""
+    if _sqlite_store is not None:
+        return
+    index_path = _chat_index_path(username)
+    if os.path.exists(index_path):
+        return
+    os.makedirs(os.path.join(_chat_dir(username), "conversations"), exist_ok=True)
+    legacy_file = os.path.join(_chat_dir(username), CHAT_JSON_PATH)
+
+    async with with_file_lock(index_path):
+        if os.path.exists(index_path):
+            return
+        index = {}
+        if os.path.exists(legacy_file):
+            async with aiofiles.open(legacy_file, "r") as f:
+                legacy = serialization.loads(await f.read())
+            for conv in legacy.get("conversations", []):
+                await _conversation_journal(username, conv["id"]).write(conv)
+                index[conv["id"]] = _conversation_meta(conv)
+        await _chat_index_journal(username).write(index)
+        if os.path.exists(legacy_file):
+            os.replace(legacy_file, legacy_file + ".migrated")
+
+
+# 索引缓存条目上维护的 (updated_at, id) 升序列表，会话列表分页时二分查找
+_RECENT_ORDER = "recent_order"
+
+
+def _recent_order(index: Dict[str, Any]) -> List[Tuple[str, str]]:
+    return sorted((meta["updated_at"], meta["id"]) for meta in index.values())
+
+
+def _update_recent_order(
+    order: List[Tuple[str, str]], index: Dict[str, Any], ops: List[Dict[str, Any]]
+) -> List[Tuple[str, str]]:
+    """``order`` of ``index`` after applying ``ops``, without re-sorting."""
+    order = list(order)
+    changed: Dict[str, Optional[Dict[str, Any]]] = {}
+    for op in ops:
+        conversation_id = op["meta"]["id"] if op["op"] == "put" else op["id"]
+        old = changed[conversation_id] if conversation_id in changed else index.get(conversation_id)
+        if old is not None:
+            position = bisect.bisect_left(order, (old["updated_at"], conversation_id))
+            if position < len(order) and order[position] == (old["updated_at"], conversation_id):
+                del order[position]
+        new = op["meta"] if op["op"] == "put" else None
+        if new is not None:
+            bisect.insort(order, (new["updated_at"], conversation_id))
+        changed[conversation_id] = new
+    return order
+
+
+def _put_is_current(username: str, index: Dict[str, Any], meta: Dict[str, Any]) -> bool:
+    # 会话锁释放后才更新索引：较新的更新或删除可能已先写入索引
+    stored = index.get(meta["id"])
+    if stored is not None and stored["updated_at"] > meta["updated_at"]:
+        return False
+    return os.path.exists(_conversation_path(username, meta["id"]))
+
+
+async def _append_chat_index(username: str, ops: List[Dict[str, Any]]) -> None:
+    """Apply index ops; must not be called while holding a conversation lock."""
+    journal = _chat_index_journal(username)
+    async with with_file_lock(journal.file_path):
+        index = await journal.read() or {}
+        ops = [op for op in ops if op["op"] != "put" or _put_is_current(username, index, op["meta"])]
+        if not ops:
+            return
+        before = registry_cache.peek(journal.file_path)
+        order = before._derived.get(_RECENT_ORDER) if before is not None else None
+        await journal.append(ops, _replay_chat_index(index, ops))
+        after = registry_cache.peek(journal.file_path)
+        # 沿用上一版本的排序，只更新变化的会话
+        if order is not None and after is not None and after is not before:
+            after._derived[_RECENT_ORDER] = _update_recent_order(order, before.data, ops)
+
+
+async def load_chat_index(username: str) -> Dict[str, Dict[str, Any]]:
+    """Conversation metadata for ``username`` keyed by conversation id, in creation order."""
+    if _sqlite_store is not None:
+        return await _sqlite_store.load_chat_index(username)
+    await _ensure_chat_layout(username)
+    return await _chat_index_journal(username).load() or {}
+
+
+async def list_conversations(
+    username: str, limit: Optional[int] = None, before: Optional[Tuple[str, str]] = None
+) -> List[Dict[str, Any]]:
+    """Conversation metadata, newest first: at most ``limit`` entries after the ``(updated_at, id)`` cursor ``before``."""
+    if _sqlite_store is not None:
+        return await _sqlite_store.list_conversations(username, limit, before)
+    await _ensure_chat_layout(username)
+    entry = await _chat_index_journal(username).load_entry()
+    if entry is None:
+        return []
+    order = entry.derived(_RECENT_ORDER, _recent_order)
+    end = len(order) if before is None else bisect.bisect_left(order, tuple(before))
+    start = 0 if limit is None else max(end - limit, 0)
+    return [dict(entry.data[conversation_id]) for _, conversation_id in reversed(order[start:end])]
+
+
+async def load_conversation(username: str, conversation_id: str) -> Optional[Dict[str, Any]]:
+    """Load a single conversation, or None if it does not exist."""
+    if _sqlite_store is not None:
+        return await _sqlite_store.load_conversation(username, conversation_id)
+    await _ensure_chat_layout(username)
+    try:
+        journal = _conversation_journal(username, conversation_id)
+    except ValueError:
+        return None
+    return await journal.load()
+
+
+async def save_conversation(username: str, conversation: Dict[str, Any]) -> None:
+    """
+    Write one conversation in full and refresh its entry in the user's index.
+    Its ``version`` becomes the stored version plus one, read under the lock.
+    """
+    if _sqlite_store is not None:
+        await _sqlite_store.save_conversation(username, conversation, _conversation_meta)
+        return
+    await _ensure_chat_layout(username)
+    journal = _conversation_journal(username, conversation["id"])
+    async with with_file_lock(journal.file_path):
+        stored = await journal.read()
+        base = conversation if stored is None else stored
+        conversation["version"] = base.get("version", 0) + 1
+        await journal.write(conversation)
+    await _append_chat_index(username, [{"op": "put", "meta": _conversation_meta(conversation)}])
+
+
+class ConversationConflict(Exception):
+    """The stored conversation no longer matches what the client based its change on."""
+
+    def __init__(self, version: int, last_message_id: Optional[str]):
+        super().__init__(
+            f"Conversation has changed (version {version}, last message {last_message_id})"
+        )
+        self.version = version
+        self.last_message_id = last_message_id
+
+
+async def _update_conversation(
+    username: str,
+    conversation_id: str,
+    make_ops: Callable[[Dict[str, Any]], List[Dict[str, Any]]],
+    bump_version: bool = True,
+) -> Optional[Dict[str, Any]]:
+    """Atomically apply the journal ops returned by ``make_ops``; returns the updated conversation, or None."""
+
+    def ops_for(conversation: Dict[str, Any]) -> List[Dict[str, Any]]:
+        ops = make_ops(conversation)
+        # 只有客户端看不到的记账字段变化时不增加 version
+        if bump_version:
+            ops.append({"op": "update", "fields": {"version": conversation.get("version", 0) + 1}})
+        return ops
+
+    if _sqlite_store is not None:
+        return await _sqlite_store.update_conversation(
+            username, conversation_id, lambda conv: _replay_conversation(conv, ops_for(conv)), _conversation_meta
+        )
+
+    await _ensure_chat_layout(username)
+    journal = _conversation_journal(username, conversation_id)
+    async with with_file_lock(journal.file_path):
+        conversation = await journal.read()
+        if conversation is None:
+            return None
+        ops = ops_for(conversation)
+        conversation = _replay_conversation(conversation, ops)
+        await journal.append(ops, conversation)
+    await _append_chat_index(username, [{"op": "put", "meta": _conversation_meta(conversation)}])
+    return conversation
+
+
+async def append_conversation_messages(
+    username: str,
+    conversation_id: str,
+    messages: List[Dict[str, Any]],
+    fields: Optional[Dict[str, Any]] = None,
+    bump_version: bool = True,
+) -> Optional[Dict[str, Any]]:
+    """
+    Append (or replace, by message id) ``messages`` and set top-level ``fields``
+    of a conversation without rewriting it. Returns the updated conversation,
+    or None if it does not exist.
+    """
+    ops = [{"op": "message", "message": message} for message in messages]
+    if fields:
+        ops.append({"op": "update", "fields": fields})
+    return await _update_conversation(username, conversation_id, lambda conv: list(ops), bump_version)
+
+
+async def append_conversation_delta(
+    username: str,
+    conversation_id: str,
+    message: Dict[str, Any],
+    parent_message_id: Optional[str],
+    version: Optional[int] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Append ``message`` only if the stored history still ends with
+    ``parent_message_id`` (None for an empty conversation) and, when given,
+    the conversation is still at ``version``; raises ConversationConflict
+    otherwise. Returns the updated conversation, or None if it does not exist.
+    """
+
+    def make_ops(conversation: Dict[str, Any]) -> List[Dict[str, Any]]:
+        messages = conversation["messages"]
+        last_message_id = messages[-1]["id"] if messages else None
+        current_version = conversation.get("version", 0)
+        if last_message_id != parent_message_id or (version is not None and version != current_version):
+            raise ConversationConflict(current_version, last_message_id)
+        return [
+            {"op": "message", "message": message},
+            {"op": "update", "fields": {"updated_at": datetime.now().isoformat()}},
+        ]
+
+    return await _update_conversation(username, conversation_id, make_ops)
+
+
+async def fill_message_fields(
+    username: str, conversation_id: str, fields_by_id: Dict[str, Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    """
+    Set ``fields_by_id[message_id]`` on stored messages that do not have those
+    fields yet, without bumping the version. Messages that were removed or
+    already carry the fields are left alone.
+    """
+
+    def make_ops(conversation: Dict[str, Any]) -> List[Dict[str, Any]]:
+        ops = []
+        for message in conversation["messages"]:
+            fields = fields_by_id.get(message["id"])
+            if fields and any(key not in message for key in fields):
+                ops.append({"op": "message", "message": {**fields, **message}})
+        return ops
+
+    return await _update_conversation(username, conversation_id, make_ops, bump_version=False)
+
+
+async def update_conversation_fields(
+    username: str, conversation_id: str, fields: Dict[str, Any], bump_version: bool = True
+) -> Optional[Dict[str, Any]]:
+    """Set top-level fields (title, updated_at, ...) of a conversation."""
+    return await append_conversation_messages(username, conversation_id, [], fields, bump_version)
+
+
+async def delete_conversation_data(username: str, conversation_id: str) -> bool:
+    """Delete a conversation; returns False if it did not exist."""
+    if _sqlite_store is not None:
+        return await _sqlite_store.delete_conversation(username, conversation_id)
+    await _ensure_chat_layout(username)
+    journal = _conversation_journal(username, conversation_id)
+    existed = conversation_id in await load_chat_index(username)
+    async with with_file_lock(journal.file_path):
+        await journal.remove()
+        # .lock 文件保留：持锁时删除会让等待者和新打开者锁住不同的 inode
+    # 先删除会话文件，之后到达的索引 put 会因文件不存在而被丢弃
+    await _append_chat_index(username, [{"op": "delete", "id": conversation_id}])
+    return existed
+
+
+CONFIG_JSON_PATH = "config.json"
+
+DEFAULT_CONFIG = {
+    "saasBaseUrls": [
+        {"value": "https://ark.cn-beijing.volces.com/api/v3", "label": "火山方舟"},
+        {"value": "https://api.siliconflow.cn/v1", "label": "硅基流动"},
+        {"value": "https://api.deepseek.com/beta", "label": "DeepSeek"},
+        {"value": "https://dashscope.aliyuncs.com/compatible-mode/v1", "label": "通义千问"},
+        {"value": "https://api.moonshot.cn/v1", "label": "Kimi"}
+    ],
+    "pretrainedModelTypes": [
+        {"value": "saas/openai", "label": "OpenAI 兼容模型"},
+        {"value": "saas/qianwen", "label": "通义千问"},
+        {"value": "saas/qianwen_vl", "label": "通义千问视觉"},
+        {"value": "saas/claude", "label": "Claude"}
+    ],
+    "openaiServerList": [],
+    "commons": [
+    ],
+    # 聊天/搜索的默认并发与排队上限，可在 models/rags/super_analysis 条目中用
+    # max_concurrency / max_queue 单独覆盖；0 表示不限制并发 / 不排队（默认不限制，按需开启）
+    "chatAdmission": {
+        "models": {"maxConcurrency": 0, "maxQueue": 0},
+        "rags": {"maxConcurrency": 0, "maxQueue": 0},
+        "super-analysis": {"maxConcurrency": 0, "maxQueue": 0},
+    },
+    # 发送给模型的上下文 token 上限，可在条目中用 max_context_tokens 单独覆盖；0 表示不限制。
+    # summaryModel 为 models 中的模型名，用于把超出上限的早期对话压缩成摘要，留空则直接截断
+    "chatContext": {
+        "summaryModel": "",
+        "models": {"maxContextTokens": 32000},
+        "rags": {"maxContextTokens": 16000},
+        "super-analysis": {"maxContextTokens": 16000},
+    },
+}
+
+
+def _merge_default_config(user_config):
+    # Merge user config with default config
+    for key in DEFAULT_CONFIG:
+        if key not in user_config:
+            user_config[key] = _copy_json(DEFAULT_CONFIG[key])
+    return user_config
 
 
 # Add this function to load the config
 async def load_config():
-    config_path = "config.json"
-    default_config = {
-        "saasBaseUrls": [
-            {"value": "https://ark.cn-beijing.volces.com/api/v3", "label": "火山方舟"},
-            {"value": "https://api.siliconflow.cn/v1", "label": "硅基流动"},
-            {"value": "https://api.deepseek.com/beta", "label": "DeepSeek"},
-            {"value": "https://dashscope.aliyuncs.com/compatible-mode/v1", "label": "通义千问"},
-            {"value": "https://api.moonshot.cn/v1", "label": "Kimi"}
-        ],
-        "pretrainedModelTypes": [
-            {"value": "saas/openai", "label": "OpenAI 兼容模型"},
-            {"value": "saas/qianwen", "label": "通义千问"},
-            {"value": "saas/qianwen_vl", "label": "通义千问视觉"},
-            {"value": "saas/claude", "label": "Claude"}
-        ],
-        "openaiServerList": [],
-        "commons": [            
-        ]
-    }
+    user_config = await _load_registry(CONFIG_JSON_PATH, default=_copy_json(DEFAULT_CONFIG))
+    return _merge_default_config(user_config)
+
 
-    async with with_file_lock(config_path):
-        if os.path.exists(config_path):
-            async with aiofiles.open(config_path, "r") as f:
-                content = await f.read()
-                user_config = json.loads(content)
-                
-                # Merge user config with default config
-                for key in default_config:
-                    if key not in user_config:
-                        user_config[key] = default_config[key]
-                
-                return user_config
-                
-        return default_config
+async def snapshot_config():
+    """Read-only view of the merged configuration, shared between callers."""
+    entry = await _load_registry_entry(CONFIG_JSON_PATH)
+    if entry is None:
+        return _DEFAULT_CONFIG_SNAPSHOT
+    return entry.derived(
+        "config", lambda data: _freeze(_merge_default_config(_copy_json(data)))
+    )
+
+
+_DEFAULT_CONFIG_SNAPSHOT = _freeze(DEFAULT_CONFIG)
 
 
 async def save_config(config):
     """Save the configuration to file."""
-    config_path = "config.json"
-    async with with_file_lock(config_path):
-        async with aiofiles.open(config_path, "w") as f:
-            content = json.dumps(config, ensure_ascii=False)
-            await f.write(content)
+    await _save_registry(CONFIG_JSON_PATH, config)
 
 
 # Path to the models.json file
@@ -136,108 +1127,97 @@ RAGS_JSON_PATH = "rags.json"
 
 # Function to load models from JSON file
 async def load_models_from_json():
-    async with with_file_lock(MODELS_JSON_PATH):
-        if os.path.exists(MODELS_JSON_PATH):
-            async with aiofiles.open(MODELS_JSON_PATH, "r") as f:
-                content = await f.read()
-                return json.loads(content)
-        return {}
+    return await _load_registry(MODELS_JSON_PATH)
 
 
 # Function to save models to JSON file
 async def save_models_to_json(models):
-    async with with_file_lock(MODELS_JSON_PATH):
-        async with aiofiles.open(MODELS_JSON_PATH, "w") as f:
-            content = json.dumps(models, ensure_ascii=False)
-            await f.write(content)
+    await _save_registry(MODELS_JSON_PATH, models)
+
+
+async def snapshot_models():
+    """Read-only view of models.json for callers that never mutate it."""
+    return await _snapshot_registry(MODELS_JSON_PATH)
 
 
 def b_load_models_from_json():    
+    if _sqlite_store is not None:
+        return _sqlite_store.read_registry(_registry_name(MODELS_JSON_PATH))
     if os.path.exists(MODELS_JSON_PATH):
         with open(MODELS_JSON_PATH, "r") as f:
             content = f.read()
-            return json.loads(content)
+            return serialization.loads(content)
     return {}
 
 
 def b_save_models_to_json(models):    
-    with open(MODELS_JSON_PATH, "w") as f:
-        content = json.dumps(models, ensure_ascii=False)
-        f.write(content)
+    if _sqlite_store is not None:
+        _sqlite_store.write_registry(_registry_name(MODELS_JSON_PATH), models)
+        return
+    content = serialization.dumps(models)
+    _atomic_write_text(MODELS_JSON_PATH, content)
 
 
 # Function to load RAGs from JSON file
 async def load_rags_from_json():
-    async with with_file_lock(RAGS_JSON_PATH):
-        if os.path.exists(RAGS_JSON_PATH):
-            async with aiofiles.open(RAGS_JSON_PATH, "r") as f:
-                content = await f.read()
-                return json.loads(content)
-        return {}
+    return await _load_registry(RAGS_JSON_PATH)
 
 
 # Function to save RAGs to JSON file
 async def save_rags_to_json(rags):
-    async with with_file_lock(RAGS_JSON_PATH):
-        async with aiofiles.open(RAGS_JSON_PATH, "w") as f:
-            content = json.dumps(rags, ensure_ascii=False)
-            await f.write(content)
+    await _save_registry(RAGS_JSON_PATH, rags)
+
+
+async def snapshot_rags():
+    """Read-only view of rags.json for callers that never mutate it."""
+    return await _snapshot_registry(RAGS_JSON_PATH)
 
 # Function to load Super Analysis from JSON file
 async def load_super_analysis_from_json():
-    async with with_file_lock(SUPER_ANALYSIS_JSON_PATH):
-        if os.path.exists(SUPER_ANALYSIS_JSON_PATH):
-            async with aiofiles.open(SUPER_ANALYSIS_JSON_PATH, "r") as f:
-                content = await f.read()
-                return json.loads(content)
-        return {}
+    return await _load_registry(SUPER_ANALYSIS_JSON_PATH)
 
 # Function to save Super Analysis to JSON file
 async def save_super_analysis_to_json(analyses):
-    async with with_file_lock(SUPER_ANALYSIS_JSON_PATH):
-        async with aiofiles.open(SUPER_ANALYSIS_JSON_PATH, "w") as f:
-            content = json.dumps(analyses, ensure_ascii=False)
-            await f.write(content)
+    await _save_registry(SUPER_ANALYSIS_JSON_PATH, analyses)
+
+async def snapshot_super_analysis():
+    """Read-only view of super_analysis.json for callers that never mutate it."""
+    return await _snapshot_registry(SUPER_ANALYSIS_JSON_PATH)
 
 async def get_event_file_path(request_id: str) -> str:
     os.makedirs("chat_events", exist_ok=True)
     return f"chat_events/{request_id}.json"
 
 
+BYZER_SQL_JSON_PATH = "byzer_sql.json"
+
 async def load_byzer_sql_from_json():
-    byzer_sql_path = "byzer_sql.json"
-    async with with_file_lock(byzer_sql_path):
-        if os.path.exists(byzer_sql_path):
-            async with aiofiles.open(byzer_sql_path, "r") as f:
-                content = await f.read()
-                return json.loads(content)  
-        return {}     
+    return await _load_registry(BYZER_SQL_JSON_PATH)
 
 async def save_byzer_sql_to_json(services) -> None:
-    byzer_sql_path = "byzer_sql.json"
-    async with with_file_lock(byzer_sql_path):
-        async with aiofiles.open(byzer_sql_path, "w") as f:
-            content = json.dumps(services, ensure_ascii=False)
-            await f.write(content)
+    await _save_registry(BYZER_SQL_JSON_PATH, services)
+
+# Users related functions
+USERS_JSON_PATH = "./users.json"
+
+async def load_users() -> Dict[str, Any]:
+    """Load users from JSON file"""
+    return await _load_registry(USERS_JSON_PATH)
+
+async def save_users(users: Dict[str, Any]) -> None:
+    """Save users to JSON file"""
+    await _save_registry(USERS_JSON_PATH, users, indent=2)
 
 # File resources related functions
 FILE_RESOURCES_JSON_PATH = "file_resources.json"
 
 async def load_file_resources() -> Dict[str, Any]:
     """Load file resources from JSON file"""
-    async with with_file_lock(FILE_RESOURCES_JSON_PATH):
-        if os.path.exists(FILE_RESOURCES_JSON_PATH):
-            async with aiofiles.open(FILE_RESOURCES_JSON_PATH, "r") as f:
-                content = await f.read()
-                return json.loads(content)
-        return {}
+    return await _load_registry(FILE_RESOURCES_JSON_PATH)
 
 async def save_file_resources(resources: Dict[str, Any]) -> None:
     """Save file resources to JSON file"""
-    async with with_file_lock(FILE_RESOURCES_JSON_PATH):
-        async with aiofiles.open(FILE_RESOURCES_JSON_PATH, "w") as f:
-            content = json.dumps(resources, ensure_ascii=False)
-            await f.write(content)
+    await _save_registry(FILE_RESOURCES_JSON_PATH, resources)
 
 
 # API Key related functions
@@ -245,24 +1225,15 @@ API_KEYS_JSON_PATH = "api_keys.json"
 
 async def load_api_keys() -> Dict[str, Any]:
     """Load API keys from JSON file"""
-    async with with_file_lock(API_KEYS_JSON_PATH):
-        if os.path.exists(API_KEYS_JSON_PATH):
-            async with aiofiles.open(API_KEYS_JSON_PATH, "r") as f:
-                content = await f.read()
-                return json.loads(content)
-        return {}
+    return await _load_registry(API_KEYS_JSON_PATH)
 
 async def save_api_keys(api_keys: Dict[str, Any]) -> None:
     """Save API keys to JSON file"""
-    async with with_file_lock(API_KEYS_JSON_PATH):
-        async with aiofiles.open(API_KEYS_JSON_PATH, "w") as f:
-            content = json.dumps(api_keys, ensure_ascii=False)
-            await f.write(content)
+    await _save_registry(API_KEYS_JSON_PATH, api_keys)
+    api_key_index.invalidate()
 
 async def create_api_key(name: str, description: Optional[str] = None, expires_in_days: int = 30) -> Dict[str, Any]:
     """Create a new API key"""
-    api_keys = await load_api_keys()
-    
     # Generate a unique API key
     api_key = f"sk-{uuid.uuid4().hex}"
     
@@ -278,36 +1249,147 @@ async def create_api_key(name: str, description: Optional[str] = None, expires_i
         "is_active": True
     }    
     
-    api_keys[api_key] = api_key_info
-    await save_api_keys(api_keys)
+    def update(api_keys):
+        api_keys[api_key] = api_key_info
+
+    await _update_registry(API_KEYS_JSON_PATH, update)
+    api_key_index.invalidate()
     return api_key_info
 
 async def revoke_api_key(key: str) -> None:
     """Revoke an API key"""
-    api_keys = await load_api_keys()
-    if key in api_keys:
-        api_keys[key]["is_active"] = False
-        await save_api_keys(api_keys)
+    def update(api_keys):
+        if key in api_keys:
+            api_keys[key]["is_active"] = False
+
+    await _update_registry(API_KEYS_JSON_PATH, update)
+    api_key_index.invalidate()
+
+def _build_api_key_index(api_keys: Dict[str, Any]) -> Dict[str, float]:
+    """Map every active key to its expiry as a POSIX timestamp (inf = never expires)."""
+    index = {}
+    for key, key_info in api_keys.items():
+        if not key_info.get("is_active"):
+            continue
+        expires_at = key_info.get("expires_at")
+        # -1 means never expire
+        if expires_at == -1:
+            index[key] = float("inf")
+            continue
+        try:
+            index[key] = datetime.fromisoformat(expires_at).timestamp()
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring API key {key_info.get('name')} with invalid expires_at: {expires_at}")
+    return index
+
+
+# 其他进程（uvicorn worker）对 api_keys 的修改最多延迟这么久被发现
+API_KEY_RECHECK_INTERVAL = 1.0
+API_KEY_NEGATIVE_CACHE_SIZE = 10000
+
+
+class ApiKeyIndex:
+    """In-memory index of the active API keys, rebuilt per version of the api_keys registry."""
+
+    # 最多每 API_KEY_RECHECK_INTERVAL 秒检查一次 registry；未知的 key 强制检查一次，
+    # 之后记入有上限的负缓存，直到 registry 变化
+
+    def __init__(self):
+        self._entry: Optional[_RegistryEntry] = None
+        self._index: Dict[str, float] = {}
+        self._checked_at = float("-inf")
+        self._misses: "OrderedDict[str, None]" = OrderedDict()
+
+    def invalidate(self) -> None:
+        self._checked_at = float("-inf")
+
+    async def _refresh(self) -> None:
+        entry = await _load_registry_entry(API_KEYS_JSON_PATH)
+        self._checked_at = time.monotonic()
+        if entry is not self._entry:
+            self._entry = entry
+            self._index = {} if entry is None else entry.derived("api_key_index", _build_api_key_index)
+            self._misses.clear()
+
+    async def verify(self, api_key: str) -> bool:
+        if time.monotonic() - self._checked_at > API_KEY_RECHECK_INTERVAL:
+            await self._refresh()
+        expires_at = self._index.get(api_key)
+        if expires_at is None:
+            if api_key in self._misses:
+                return False
+            await self._refresh()
+            expires_at = self._index.get(api_key)
+            if expires_at is None:
+                self._misses[api_key] = None
+                if len(self._misses) > API_KEY_NEGATIVE_CACHE_SIZE:
+                    self._misses.popitem(last=False)
+                return False
+        return expires_at > time.time()
+
+
+api_key_index = ApiKeyIndex()
+
 
 async def verify_api_key(api_key: str) -> bool:
     """Verify if an API key is valid and not expired"""
-    api_keys = await load_api_keys()
-    if api_key not in api_keys:
-        return False
-    
-    key_info = api_keys[api_key]
-    if not key_info["is_active"]:
-        return False
-    
-    # -1 means never expire
-    if key_info["expires_at"] == -1:
-        return True
-        
-    expires_at = datetime.fromisoformat(key_info["expires_at"])
-    if expires_at < datetime.now():
-        return False
-    
-    return True
+    return await api_key_index.verify(api_key)
+
+# 可导入 SQLite 的 JSON 文件，按 registry 名称索引
+REGISTRY_JSON_PATHS = {
+    _registry_name(path): path
+    for path in (
+        MODELS_JSON_PATH,
+        RAGS_JSON_PATH,
+        SUPER_ANALYSIS_JSON_PATH,
+        BYZER_SQL_JSON_PATH,
+        CONFIG_JSON_PATH,
+        FILE_RESOURCES_JSON_PATH,
+        API_KEYS_JSON_PATH,
+        USERS_JSON_PATH,
+    )
+}
+
+
+def _read_journal_sync(file_path: str, replay) -> Optional[Any]:
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "r") as f:
+        document = serialization.loads(f.read())
+    ops = []
+    if os.path.exists(file_path + ".journal"):
+        with open(file_path + ".journal", "r") as f:
+            for line in f:
+                try:
+                    ops.append(serialization.loads(line))
+                except ValueError:
+                    continue
+    return replay(document, ops)
+
+
+def _iter_json_conversations(user_dir: str):
+    """Yield the conversations stored under ``chat_data/<user>`` in either JSON layout."""
+    index = _read_journal_sync(os.path.join(user_dir, "index.json"), _replay_chat_index)
+    if index is not None:
+        for conversation_id in index:
+            conversation_file = os.path.join(user_dir, "conversations", f"{conversation_id}.json")
+            conversation = _read_journal_sync(conversation_file, _replay_conversation)
+            if conversation is not None:
+                yield conversation
+        return
 
+    legacy_file = os.path.join(user_dir, CHAT_JSON_PATH)
+    if os.path.exists(legacy_file):
+        with open(legacy_file, "r") as f:
+            yield from serialization.loads(f.read()).get("conversations", [])
 
 
+def import_json_into_sqlite() -> Dict[str, int]:
+    """Copy the JSON registries and chat data into the configured SQLite store."""
+    if _sqlite_store is None:
+        raise RuntimeError("SQLite storage is not configured")
+    imported = _sqlite_store.import_json_files(
+        REGISTRY_JSON_PATHS, CHAT_DATA_DIR, _iter_json_conversations, _conversation_meta
+    )
+    registry_cache.invalidate()
+    return imported
@@ -0,0 +1,163 @@
+"""
+JSON encoding for storage files, chat history and event lines.
+
+Uses orjson or msgspec when one of them is installed and falls back to the
+standard library otherwise. All backends write UTF-8 text without ASCII
+escaping and accept the same values as ``json.dumps``: anything else
+(datetime, NaN, non-string keys, ...) is handed to the stdlib encoder, which
+raises or encodes it exactly as before. Only whitespace differs: the stdlib
+keeps its default separators, the fast encoders are compact.
+The backend can be forced with ``WILLIAM_TOOLBOX_JSON=orjson|msgspec|json``.
+"""
+import os
+import json
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from loguru import logger
+
+
+def _std_dumps(obj: Any, indent: Optional[int] = None) -> str:
+    return json.dumps(obj, ensure_ascii=False, indent=indent)
+
+
+_SCALAR_TYPES = frozenset({str, int, bool, type(None)})
+
+
+def _is_plain(obj: Any) -> bool:
+    """Only dicts with str keys, lists, tuples, str, int, bool, None and finite floats (exact types)."""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        kind = type(value)
+        if kind is dict:
+            if not all(type(key) is str for key in value):
+                return False
+            stack.extend(v for v in value.values() if type(v) not in _SCALAR_TYPES)
+        elif kind is list or kind is tuple:
+            stack.extend(v for v in value if type(v) not in _SCALAR_TYPES)
+        elif kind is float:
+            # inf - inf 和 nan - nan 都是 nan
+            if value - value != 0:
+                return False
+        elif kind not in _SCALAR_TYPES:
+            return False
+    return True
+
+
+def _has_non_finite(obj: Any) -> bool:
+    """Whether ``obj`` contains NaN or an infinite float."""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(v for v in value.values() if type(v) not in _SCALAR_TYPES)
+        elif isinstance(value, (list, tuple)):
+            stack.extend(v for v in value if type(v) not in _SCALAR_TYPES)
+        elif isinstance(value, float) and value - value != 0:
+            return True
+    return False
+
+
+def _unsupported(obj: Any) -> Any:
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _std_loads(content: Union[str, bytes]) -> Any:
+    return json.loads(content)
+
+
+def _orjson_backend() -> Tuple[Callable, Callable]:
+    import orjson
+
+    # datetime、dataclass 交给 default，和标准库一样拒绝
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def dumps(obj: Any, indent: Optional[int] = None) -> str:
+        if indent not in (None, 2):
+            return _std_dumps(obj, indent)
+        option = options | orjson.OPT_INDENT_2 if indent == 2 else options
+        try:
+            content = orjson.dumps(obj, default=_unsupported, option=option)
+        except TypeError:
+            # e.g. integers beyond 64 bits or non-str keys, which the stdlib
+            # encoder accepts, or types it rejects with the same error
+            return _std_dumps(obj, indent)
+        # orjson 把 NaN / Infinity 写成 null，只有出现 null 时才需要检查
+        if b"null" in content and _has_non_finite(obj):
+            return _std_dumps(obj, indent)
+        return content.decode("utf-8")
+
+    # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+    return dumps, orjson.loads
+
+
+def _msgspec_backend() -> Tuple[Callable, Callable]:
+    import msgspec
+
+    encoder = msgspec.json.Encoder(enc_hook=_unsupported)
+    decoder = msgspec.json.Decoder()
+
+    def dumps(obj: Any, indent: Optional[int] = None) -> str:
+        # msgspec 原生编码 datetime、set 等并把 NaN 写成 null，无法关闭，先检查类型
+        if indent is not None or not _is_plain(obj):
+            return _std_dumps(obj, indent)
+        try:
+            return encoder.encode(obj).decode("utf-8")
+        except (TypeError, OverflowError):
+            return _std_dumps(obj, indent)
+
+    def loads(content: Union[str, bytes]) -> Any:
+        try:
+            return decoder.decode(content)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    return dumps, loads
+
+
+_BACKENDS: Dict[str, Callable[[], Tuple[Callable, Callable]]] = {
+    "orjson": _orjson_backend,
+    "msgspec": _msgspec_backend,
+    "json": lambda: (_std_dumps, _std_loads),
+}
+
+BACKEND = "json"
+_dumps: Callable = _std_dumps
+_loads: Callable = _std_loads
+
+
+def set_backend(name: Optional[str] = None) -> str:
+    """
+    Select the JSON backend. ``None`` picks the fastest installed one.
+    Returns the name of the backend in use.
+    """
+    global BACKEND, _dumps, _loads
+    candidates = [name] if name else ["orjson", "msgspec", "json"]
+    for candidate in candidates:
+        if candidate not in _BACKENDS:
+            raise ValueError(f"Unknown JSON backend: {candidate}")
+        try:
+            _dumps, _loads = _BACKENDS[candidate]()
+        except ImportError:
+            if name:
+                logger.warning(f"JSON backend {name} is not installed, using stdlib json")
+                _dumps, _loads = _std_dumps, _std_loads
+                BACKEND = "json"
+                return BACKEND
+            continue
+        BACKEND = candidate
+        return BACKEND
+    return BACKEND
+
+
+def dumps(obj: Any, indent: Optional[int] = None) -> str:
+    """Encode ``obj`` as JSON text (no ASCII escaping)."""
+    return _dumps(obj, indent)
+
+
+def loads(content: Union[str, bytes]) -> Any:
+    """Decode JSON text or UTF-8 bytes; raises ValueError on malformed input."""
+    return _loads(content)
+
+
+set_backend(os.environ.get("WILLIAM_TOOLBOX_JSON") or None)
@@ -0,0 +1,360 @@
+import os
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+from . import serialization
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS registry_items (
+    registry TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (registry, key)
+);
+CREATE TABLE IF NOT EXISTS registry_versions (
+    registry TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    username TEXT NOT NULL,
+    id TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    display_title TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL DEFAULT '',
+    message_count INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL,
+    PRIMARY KEY (username, id)
+);
+-- 会话列表按 (updated_at, id) 倒序分页
+DROP INDEX IF EXISTS idx_conversations_updated_at;
+CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations (username, updated_at, id);
+"""
+
+
+class SQLiteStore:
+    """
+    SQLite storage engine behind the ``storage.json_file`` function API.
+
+    Every registry (models, rags, config, api keys, ...) is a set of rows keyed
+    by ``(registry, key)``, so lookups are indexed and saves only touch the rows
+    that actually changed. Each registry carries a version number bumped in the
+    same transaction as the change, which callers use for cache invalidation.
+    Chat conversations are one row each.
+
+    The database runs in WAL mode with a busy timeout, so several uvicorn
+    workers can share one file. All queries run on a small thread pool with
+    one connection per thread, never on the event loop.
+    """
+
+    def __init__(self, db_path: str = "williamtoolbox.db", max_workers: int = 4):
+        self.db_path = db_path
+        self.max_workers = max_workers
+        self._start()
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+
+    def _start(self) -> None:
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sqlite-store")
+
+    def _check_fork(self) -> None:
+        # fork 出的子进程继承了父进程的线程池和连接，但线程不会被复制，需重新创建
+        if self.pid != os.getpid():
+            self._start()
+
+    def _conn(self) -> sqlite3.Connection:
+        self._check_fork()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: transactions are managed explicitly below
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    async def _run(self, fn: Callable, *args):
+        self._check_fork()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _transaction(self, fn: Callable, *args, write: bool = True):
+        conn = self._conn()
+        # IMMEDIATE takes the write lock up front so concurrent writers queue
+        # on busy_timeout instead of failing on a lock upgrade.
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    # ---- registries -------------------------------------------------------
+
+    @staticmethod
+    def _version(conn: sqlite3.Connection, registry: str) -> Optional[int]:
+        row = conn.execute(
+            "SELECT version FROM registry_versions WHERE registry = ?", (registry,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _items(conn: sqlite3.Connection, registry: str) -> Dict[str, str]:
+        rows = conn.execute(
+            "SELECT key, value FROM registry_items WHERE registry = ? ORDER BY rowid", (registry,)
+        )
+        return {key: value for key, value in rows}
+
+    def _load(self, conn: sqlite3.Connection, registry: str) -> Tuple[Optional[int], Dict[str, Any]]:
+        version = self._version(conn, registry)
+        items = self._items(conn, registry)
+        return version, {key: serialization.loads(value) for key, value in items.items()}
+
+    def _write(self, conn: sqlite3.Connection, registry: str, data: Dict[str, Any]) -> int:
+        existing = self._items(conn, registry)
+        changed = False
+        for key, value in data.items():
+            content = serialization.dumps(value)
+            if existing.get(key) != content:
+                conn.execute(
+                    "INSERT INTO registry_items (registry, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (registry, key) DO UPDATE SET value = excluded.value",
+                    (registry, key, content),
+                )
+                changed = True
+        removed = [key for key in existing if key not in data]
+        if removed:
+            conn.executemany(
+                "DELETE FROM registry_items WHERE registry = ? AND key = ?",
+                [(registry, key) for key in removed],
+            )
+            changed = True
+        version = self._version(conn, registry)
+        if changed or version is None:
+            conn.execute(
+                "INSERT INTO registry_versions (registry, version) VALUES (?, 1) "
+                "ON CONFLICT (registry) DO UPDATE SET version = version + 1",
+                (registry,),
+            )
+            version = self._version(conn, registry)
+        return version
+
+    async def registry_version(self, registry: str) -> Optional[int]:
+        return await self._run(lambda: self._version(self._conn(), registry))
+
+    async def load_registry(self, registry: str) -> Tuple[Optional[int], Dict[str, Any]]:
+        """Return ``(version, data)``; version is None if the registry was never written."""
+        return await self._run(lambda: self._transaction(self._load, registry, write=False))
+
+    def read_registry(self, registry: str) -> Dict[str, Any]:
+        """Blocking ``load_registry`` (data only), for synchronous callers."""
+        return self._transaction(self._load, registry, write=False)[1]
+
+    def write_registry(self, registry: str, data: Dict[str, Any]) -> int:
+        """Blocking ``save_registry``, for synchronous callers."""
+        return self._transaction(self._write, registry, data)
+
+    async def save_registry(self, registry: str, data: Dict[str, Any]) -> int:
+        """Persist ``data``, writing only rows that changed; returns the new version."""
+        return await self._run(lambda: self._transaction(self._write, registry, data))
+
+    async def update_registry(
+        self, registry: str, update: Callable[[Dict[str, Any]], Any], default: Optional[Dict[str, Any]] = None
+    ) -> Tuple[int, Dict[str, Any], Any]:
+        """Read-modify-write a registry in one transaction; returns ``(version, data, update_result)``."""
+
+        def run(conn):
+            version, data = self._load(conn, registry)
+            if version is None and default is not None:
+                data = default
+            result = update(data)
+            return self._write(conn, registry, data), data, result
+
+        return await self._run(lambda: self._transaction(run))
+
+    # ---- chat -------------------------------------------------------------
+
+    _META_COLUMNS = "id, title, display_title, created_at, updated_at, message_count"
+
+    @staticmethod
+    def _meta(row) -> Dict[str, Any]:
+        return {
+            "id": row[0],
+            "title": row[1],
+            "display_title": row[2],
+            "created_at": row[3],
+            "updated_at": row[4],
+            "message_count": row[5],
+        }
+
+    async def load_chat_index(self, username: str) -> Dict[str, Dict[str, Any]]:
+        def load():
+            rows = self._conn().execute(
+                f"SELECT {self._META_COLUMNS} FROM conversations WHERE username = ? ORDER BY rowid",
+                (username,),
+            )
+            return {row[0]: self._meta(row) for row in rows}
+
+        return await self._run(load)
+
+    async def list_conversations(
+        self, username: str, limit: Optional[int], before: Optional[Tuple[str, str]]
+    ) -> List[Dict[str, Any]]:
+        def load():
+            sql = f"SELECT {self._META_COLUMNS} FROM conversations WHERE username = ?"
+            params: List[Any] = [username]
+            if before is not None:
+                sql += " AND (updated_at < ? OR (updated_at = ? AND id < ?))"
+                params += [before[0], before[0], before[1]]
+            sql += " ORDER BY updated_at DESC, id DESC"
+            if limit is not None:
+                sql += " LIMIT ?"
+                params.append(limit)
+            return [self._meta(row) for row in self._conn().execute(sql, params)]
+
+        return await self._run(load)
+
+    async def load_conversation(self, username: str, conversation_id: str) -> Optional[Dict[str, Any]]:
+        def load():
+            row = self._conn().execute(
+                "SELECT data FROM conversations WHERE username = ? AND id = ?",
+                (username, conversation_id),
+            ).fetchone()
+            return serialization.loads(row[0]) if row else None
+
+        return await self._run(load)
+
+    @staticmethod
+    def _upsert_conversation(conn: sqlite3.Connection, username: str, meta: Dict[str, Any], content: str) -> None:
+        conn.execute(
+            "INSERT INTO conversations "
+            "(username, id, title, display_title, created_at, updated_at, message_count, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (username, id) DO UPDATE SET "
+            "title = excluded.title, display_title = excluded.display_title, "
+            "created_at = excluded.created_at, updated_at = excluded.updated_at, "
+            "message_count = excluded.message_count, data = excluded.data",
+            (
+                username,
+                meta["id"],
+                meta["title"],
+                meta["display_title"],
+                meta["created_at"],
+                meta["updated_at"],
+                meta["message_count"],
+                content,
+            ),
+        )
+
+    async def save_conversation(
+        self,
+        username: str,
+        conversation: Dict[str, Any],
+        conversation_meta: Callable[[Dict[str, Any]], Dict[str, Any]],
+    ) -> None:
+        """Write one conversation in full, bumping the stored ``version`` inside the transaction."""
+
+        def save(conn):
+            row = conn.execute(
+                "SELECT json_extract(data, '$.version') FROM conversations WHERE username = ? AND id = ?",
+                (username, conversation["id"]),
+            ).fetchone()
+            stored = row[0] if row is not None else conversation.get("version")
+            conversation["version"] = (stored or 0) + 1
+            self._upsert_conversation(
+                conn, username, conversation_meta(conversation), serialization.dumps(conversation)
+            )
+
+        await self._run(lambda: self._transaction(save))
+
+    async def update_conversation(
+        self,
+        username: str,
+        conversation_id: str,
+        update: Callable[[Dict[str, Any]], Dict[str, Any]],
+        conversation_meta: Callable[[Dict[str, Any]], Dict[str, Any]],
+    ) -> Optional[Dict[str, Any]]:
+        """Apply ``update`` to one conversation inside a transaction; None if it does not exist."""
+
+        def run(conn):
+            row = conn.execute(
+                "SELECT data FROM conversations WHERE username = ? AND id = ?",
+                (username, conversation_id),
+            ).fetchone()
+            if row is None:
+                return None
+            conversation = update(serialization.loads(row[0]))
+            self._upsert_conversation(
+                conn, username, conversation_meta(conversation), serialization.dumps(conversation)
+            )
+            return conversation
+
+        return await self._run(lambda: self._transaction(run))
+
+    async def delete_conversation(self, username: str, conversation_id: str) -> bool:
+        def delete(conn):
+            cursor = conn.execute(
+                "DELETE FROM conversations WHERE username = ? AND id = ?", (username, conversation_id)
+            )
+            return cursor.rowcount > 0
+
+        return await self._run(lambda: self._transaction(delete))
+
+    # ---- import -----------------------------------------------------------
+
+    def import_json_files(
+        self,
+        registry_files: Dict[str, str],
+        chat_dir: str,
+        iter_conversations: Callable[[str], Iterable[Dict[str, Any]]],
+        conversation_meta: Callable[[Dict[str, Any]], Dict[str, Any]],
+    ) -> Dict[str, int]:
+        """
+        Copy existing JSON storage into the database, overwriting rows with the
+        same key. ``registry_files`` maps registry name to JSON file path;
+        ``iter_conversations`` yields the conversations of one user directory.
+        Returns the number of imported items per registry.
+        """
+        imported = {}
+        for registry, file_path in registry_files.items():
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, "r") as f:
+                data = serialization.loads(f.read())
+
+            def merge(conn, registry=registry, data=data):
+                _, current = self._load(conn, registry)
+                current.update(data)
+                self._write(conn, registry, current)
+
+            self._transaction(merge)
+            imported[registry] = len(data)
+
+        if os.path.isdir(chat_dir):
+            for username in sorted(os.listdir(chat_dir)):
+                conversations = list(iter_conversations(os.path.join(chat_dir, username)))
+                if not conversations:
+                    continue
+
+                def upsert(conn, username=username, conversations=conversations):
+                    for conv in conversations:
+                        self._upsert_conversation(
+                            conn, username, conversation_meta(conv), serialization.dumps(conv)
+                        )
+
+                self._transaction(upsert)
+                imported[f"chat:{username}"] = len(conversations)
+
+        logger.info(f"Imported JSON storage into {self.db_path}: {imported}")
+        return imported
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 未安装时直接从 src 导入
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
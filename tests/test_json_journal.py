@@ -0,0 +1,30 @@
+import asyncio
+
+from williamtoolbox.storage import json_file, serialization
+
+
+def _message(i):
+    return {"id": f"m{i}", "role": "user", "content": f"c{i}", "timestamp": ""}
+
+
+def test_append_after_torn_tail(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    json_file.configure_storage("json")
+
+    async def run():
+        conversation = {"id": "c1", "title": "t", "created_at": "", "updated_at": "", "messages": []}
+        await json_file.save_conversation("u", conversation)
+        await json_file.append_conversation_messages("u", "c1", [_message(1)])
+        journal_path = json_file._conversation_path("u", "c1") + ".journal"
+        # 模拟进程崩溃留下的半行
+        with open(journal_path, "a") as f:
+            f.write('{"op":"mess')
+        await json_file.append_conversation_messages("u", "c1", [_message(2)])
+        json_file.registry_cache.invalidate()
+        return await json_file.load_conversation("u", "c1"), journal_path
+
+    conversation, journal_path = asyncio.run(run())
+    assert [msg["id"] for msg in conversation["messages"]] == ["m1", "m2"]
+    # 残缺的行已被截掉，日志中每一行都是完整的操作
+    with open(journal_path) as f:
+        assert all(serialization.loads(line) for line in f.read().splitlines())
@@ -0,0 +1,19 @@
+from williamtoolbox.routing import _build_routes
+
+
+def test_malformed_lite_model_is_skipped():
+    infer_params = {"saas.base_url": "https://api.example.com/v1", "saas.api_key": "k", "saas.model": "m"}
+    models = {
+        "good": {"product_type": "lite", "status": "running", "deploy_command": {"infer_params": infer_params}},
+        "no_infer_params": {"product_type": "lite", "deploy_command": {}},
+        "no_deploy_command": {"product_type": "lite"},
+        "pro": {"status": "running"},
+    }
+    rags = {"rag": {"host": "0.0.0.0", "port": 8001}}
+
+    routes = _build_routes({}, models, rags, {})
+
+    assert set(routes) == {("models", "good"), ("models", "pro"), ("rags", "rag")}
+    assert routes[("models", "good")].base_url == "https://api.example.com/v1"
+    assert routes[("models", "good")].model == "m"
+    assert routes[("rags", "rag")].base_url == "http://127.0.0.1:8001/v1"